@@ -1,8 +1,8 @@
 import unittest
-from sqlalchemy import create_engine, event
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, func, insert, inspect, select
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, timezone, date, time
 from init_db import (
     Base,
     Goal,
@@ -14,7 +14,48 @@ from init_db import (
     WorkoutRecommendation,
     UserWorkout,
     WorkoutLog,
+    DailyUserSummary,
+    HealthMetricHourly,
+    HealthMetricDaily,
+    DailyMetricSketch,
+    GoalProgress,
 )  # import the models to test
+import os
+import subprocess
+import sys
+import tempfile
+import warnings
+import asyncio
+import threading
+import random
+import json
+import sqlite3
+import init_db
+import db_session
+import async_db
+import plan_audit
+import reports
+import seeding
+import daily_summary
+import report_cache
+from report_cache import ReportCache
+from catalog import Catalog, CatalogSnapshot, RecommendationRecord, catalog_for
+from recommendations import RecommendationIndex, RecommendationSearch
+import sampling
+import partitions
+import retention
+import export
+import analytics
+import quantiles
+import goals
+import numpy as np
+import csv
+import gzip
+from ingest import BufferFull, Ingestor
+from upsert import upsert
+import ingest_server
+from data_generator import DataGenerator
+from parallel_seeding import parallel_seed
 
 # These test classes verify the functionality of the models
 # Tested: CRUD operations, CheckConstraints, Foregin key constraints, and basic queries
@@ -33,7 +74,8 @@ class BaseTestCase(unittest.TestCase):
             cursor.execute("PRAGMA foreign_keys=ON;")
             cursor.close()
 
-        self.Session = sessionmaker(bind=self.engine)
+        # the app's session class, so ORM writes keep the daily summary current
+        self.Session = sessionmaker(bind=self.engine, class_=db_session.AppSession)
         self.session = self.Session()
         Base.metadata.create_all(self.engine)  # Create the tables in the database
 
@@ -978,5 +1020,2440 @@ class TestGoal(BaseTestCase):
         self.assertEqual(len(goals), 1)
 
 
+class TestQueryPlans(BaseTestCase):
+    # test that the declared indexes exist and the report queries use them
+
+    def test_composite_indexes_created(self):
+        inspector = inspect(self.engine)
+        expected = {
+            "health_metrics": "idx_healthmetrics_userid_timestamp",
+            "sleep_log": "idx_sleeplog_userid_date",
+            "food_log": "idx_foodlog_userid_date",
+            "workout_log": "idx_workoutlog_userid_date",
+            "goals": "idx_user_id_end_date",
+        }
+        for table, index in expected.items():
+            names = [i["name"] for i in inspector.get_indexes(table)]
+            self.assertIn(index, names)
+
+    def test_goal_check_constraint_kept(self):
+        # both the check constraint and the index are in __table_args__
+        inspector = inspect(self.engine)
+        names = [c["name"] for c in inspector.get_check_constraints("goals")]
+        self.assertIn("check_start_date_before_end_date", names)
+
+    def test_hot_queries_do_not_scan(self):
+        results = plan_audit.check(self.engine)
+        with self.engine.connect() as connection:
+            queries = plan_audit.report_queries(connection)
+        self.assertEqual(len(results), len(queries))
+
+    def test_full_scan_detected(self):
+        # filtering on an unindexed column has to read the whole table
+        query = select(HealthMetric).where(HealthMetric.heart_rate > 100)
+        with self.assertRaises(plan_audit.PlanRegression):
+            plan_audit.check(self.engine, [("unindexed", query, True)])
+
+
+class TestSeeding(BaseTestCase):
+    # test the bulk seeding engine used by insert_data.py
+
+    def test_seed_row_counts(self):
+        stats = seeding.seed(
+            self.engine, users=3, days=5, readings_per_day=2, report=None
+        )
+        rows = {item.table: item.rows for item in stats}
+        self.assertEqual(rows["users"], 3)
+        self.assertEqual(rows["health_metrics"], 3 * 5 * 2)
+        self.assertEqual(rows["sleep_log"], 3 * 5)
+        self.assertEqual(rows["food_log"], 3 * 5 * 3)
+        self.assertEqual(rows["workout_log"], 3 * 5)
+        self.assertEqual(self.session.query(HealthMetric).count(), 30)
+
+    def test_seed_workout_logs_reference_one_workout(self):
+        seeding.seed(self.engine, users=2, days=10, report=None)
+        logs = self.session.query(WorkoutLog).all()
+        user_workouts = self.session.query(UserWorkout).count()
+        self.assertEqual(
+            user_workouts, len([log for log in logs if log.user_workout_id])
+        )
+        for log in logs:
+            self.assertTrue(log.user_workout is not None or log.workout_recommendation)
+
+    def test_seed_twice_continues_ids(self):
+        seeding.seed(self.engine, users=2, days=2, report=None)
+        seeding.seed(self.engine, users=2, days=2, report=None)
+        self.assertEqual(self.session.query(User).count(), 4)
+        self.assertEqual(self.session.query(HealthMetric).count(), 8)
+
+
+class TestDataGenerator(unittest.TestCase):
+    # test the vectorized data generator (no database needed)
+
+    def test_same_seed_same_data(self):
+        first = DataGenerator(seed=7).health_metrics([1, 2], date(2023, 1, 1), 5, 2)
+        second = DataGenerator(seed=7).health_metrics([1, 2], date(2023, 1, 1), 5, 2)
+        self.assertEqual(first, second)
+
+    def test_health_metric_columns(self):
+        columns = DataGenerator(seed=1).health_metrics(
+            [1, 2, 3], date(2023, 1, 1), 4, 3
+        )
+        for values in columns.values():
+            self.assertEqual(len(values), 3 * 4 * 3)
+        self.assertTrue(all(40 <= value <= 120 for value in columns["heart_rate"]))
+        # each reading falls in its own slot of the day, so timestamps never repeat
+        pairs = set(zip(columns["user_id"], columns["timestamp"]))
+        self.assertEqual(len(pairs), 36)
+        self.assertIsInstance(columns["timestamp"][0], datetime)
+
+    def test_workouts_reference_one_workout(self):
+        user_workouts, logs = DataGenerator(seed=3).workouts(
+            [1, 2], date(2023, 1, 1), 20, [10, 11], first_id=100
+        )
+        self.assertEqual(len(logs["user_id"]), 40)
+        for workout_id, recommendation_id in zip(
+            logs["user_workout_id"], logs["recommendation_id"]
+        ):
+            self.assertTrue((workout_id is None) != (recommendation_id is None))
+        created = [i for i in logs["user_workout_id"] if i is not None]
+        self.assertEqual(created, user_workouts["id"])
+        self.assertEqual(created[0], 100)
+
+
+class TestParallelSeeding(BaseTestCase):
+    # test that the parallel seeder fills the tables like the serial one
+
+    def check_seeded(self):
+        self.assertEqual(self.session.query(User).count(), 5)
+        self.assertEqual(self.session.query(HealthMetric).count(), 5 * 4 * 2)
+        self.assertEqual(self.session.query(WorkoutLog).count(), 5 * 4)
+        with self.engine.connect() as connection:
+            problems = connection.exec_driver_sql("PRAGMA foreign_key_check").all()
+        self.assertEqual(problems, [])
+
+    def test_parallel_writer(self):
+        parallel_seed(
+            self.engine,
+            users=5,
+            days=4,
+            readings_per_day=2,
+            workers=2,
+            users_per_task=2,
+            batch_size=3,
+            random_seed=1,
+            report=None,
+        )
+        self.check_seeded()
+
+    def test_parallel_shards(self):
+        parallel_seed(
+            self.engine,
+            users=5,
+            days=4,
+            readings_per_day=2,
+            workers=2,
+            users_per_task=2,
+            shards=True,
+            random_seed=1,
+            report=None,
+        )
+        self.check_seeded()
+
+
+class TestProfiles(unittest.TestCase):
+    # test the sqlite performance profiles applied by the engine connect hook
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "profile.db")
+
+    def tearDown(self):
+        init_db.set_profile(init_db.DEFAULT_PROFILE)
+        self.directory.cleanup()
+
+    def pragma(self, engine, name):
+        with engine.connect() as connection:
+            return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+    def test_profile_applied(self):
+        engine = init_db.create_health_engine(f"sqlite:///{self.path}", "ingest")
+        self.assertEqual(self.pragma(engine, "journal_mode"), "wal")
+        self.assertEqual(self.pragma(engine, "synchronous"), 0)  # OFF
+        self.assertEqual(self.pragma(engine, "cache_size"), -262144)
+        self.assertEqual(self.pragma(engine, "foreign_keys"), 1)
+        engine.dispose()
+
+    def test_process_profile_used_by_default(self):
+        init_db.set_profile("reporting")
+        engine = init_db.create_health_engine(f"sqlite:///{self.path}")
+        self.assertEqual(self.pragma(engine, "synchronous"), 1)  # NORMAL
+        engine.dispose()
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            init_db.set_profile("fastest")
+
+    def test_profile_change_replaces_async_engine(self):
+        async def synchronous():
+            async with async_db.async_engine.connect() as connection:
+                result = await connection.exec_driver_sql("PRAGMA synchronous")
+                return result.scalar()
+
+        old_engine = async_db.async_engine
+        self.assertEqual(asyncio.run(synchronous()), 2)  # FULL
+        init_db.set_profile("reporting")
+        self.assertIsNot(async_db.async_engine, old_engine)
+        self.assertIs(async_db.AsyncSession.kw["bind"], async_db.async_engine)
+        self.assertEqual(asyncio.run(synchronous()), 1)  # NORMAL
+
+    def test_async_engine_follows_given_profile(self):
+        async def synchronous():
+            async with async_db.async_engine.connect() as connection:
+                result = await connection.exec_driver_sql("PRAGMA synchronous")
+                return result.scalar()
+
+        # the process profile stays "safe", the engine is built for the one passed
+        async_db.reset_engine("reporting")
+        self.assertEqual(init_db.profile, init_db.DEFAULT_PROFILE)
+        self.assertEqual(asyncio.run(synchronous()), 1)  # NORMAL
+        async_db.reset_engine(init_db.profile)
+
+
+class TestSessions(BaseTestCase):
+    # test the session factories in db_session.py (bound to the test engine)
+    def make_user(self, email):
+        return User(name="Scoped", email=email, password="password")
+
+    def test_session_scope_commits(self):
+        with db_session.session_scope(self.Session) as session:
+            session.add(self.make_user("commit@example.com"))
+        self.assertEqual(self.session.query(User).count(), 1)
+
+    def test_session_scope_rolls_back(self):
+        with self.assertRaises(ValueError):
+            with db_session.session_scope(self.Session) as session:
+                session.add(self.make_user("rollback@example.com"))
+                session.flush()
+                raise ValueError("fail the unit of work")
+        self.assertEqual(self.session.query(User).count(), 0)
+
+    def test_read_only_session_blocks_writes(self):
+        factory = sessionmaker(
+            bind=self.engine,
+            class_=db_session.ReadOnlySessionClass,
+            autoflush=False,
+            expire_on_commit=False,
+        )
+        with db_session.read_only_scope(factory) as session:
+            session.add(self.make_user("readonly@example.com"))
+            with self.assertRaises(RuntimeError):
+                session.flush()
+
+    def test_thread_local_sessions(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(db_session.session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], db_session.session())
+        db_session.session.remove()
+
+    def test_task_scoped_sessions(self):
+        async def get_session():
+            current = db_session.TaskScopedSession()
+            db_session.TaskScopedSession.remove()
+            return current
+
+        async def main():
+            return await asyncio.gather(get_session(), get_session())
+
+        first, second = asyncio.run(main())
+        self.assertIsNot(first, second)
+
+
+class TestAsyncReports(unittest.TestCase):
+    # test the async report api against an in memory aiosqlite database
+    def test_async_reports(self):
+        asyncio.run(self.run_reports())
+
+    async def run_reports(self):
+        engine = async_db.create_async_health_engine("sqlite+aiosqlite://")
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        factory = async_db.async_sessionmaker(engine, expire_on_commit=False)
+        today = date.today()
+
+        async with async_db.async_session_scope(factory) as session:
+            user = User(name="Async User", email="async@example.com", password="pw")
+            food = Food(name="Apple", calories=100, category=5)
+            session.add_all([user, food])
+            await session.flush()
+            session.add_all(
+                [
+                    HealthMetric(
+                        user_id=user.id,
+                        heart_rate=60,
+                        steps_taken=1000,
+                        timestamp=datetime.now() - timedelta(days=1),
+                    ),
+                    FoodLog(user_id=user.id, food_id=food.id, date=today),
+                    FoodLog(user_id=user.id, food_id=food.id, date=today),
+                    Goal(
+                        user_id=user.id,
+                        description="Goal",
+                        goal_type=1,
+                        start_date=today - timedelta(days=1),
+                        end_date=today + timedelta(days=1),
+                    ),
+                ]
+            )
+
+        async with async_db.async_session_scope(factory) as session:
+            metrics = await async_db.avg_health_metrics(session, user.id)
+            self.assertEqual(metrics.avg_resting_heart_rate, 60)
+            self.assertEqual(
+                await async_db.calories_per_day(session, user.id), [(today, 200)]
+            )
+            self.assertEqual(await async_db.avg_daily_calories(session, user.id), 200)
+            self.assertEqual(await async_db.workout_count(session, user.id), 0)
+            completed, in_progress = await async_db.goal_status(session, user.id)
+            self.assertEqual(completed, 0)
+            self.assertEqual(len(in_progress), 1)
+        await engine.dispose()
+
+
+class TestMonthlyReport(BaseTestCase):
+    # test the single statement monthly report against the separate queries
+    def setUp(self):
+        super().setUp()
+        seeding.seed(self.engine, users=2, days=40, random_seed=5, report=None)
+
+    def test_matches_separate_queries(self):
+        today = date.today()
+        start = today - timedelta(days=30)
+        report = reports.monthly_report(self.session, 1, window=30)
+        metrics = self.session.execute(
+            reports.avg_health_metrics_query(
+                self.session.connection(), 1, start, precision=2
+            )
+        ).first()
+        sleep = self.session.execute(
+            reports.avg_sleep_query(1, start, today, precision=2)
+        ).first()
+        calories = self.session.execute(
+            reports.avg_daily_calories_query(1, start, precision=2)
+        ).scalar()
+        workouts = self.session.execute(
+            reports.workout_count_query(1, start, today)
+        ).scalar()
+        goals = self.session.execute(
+            reports.goals_completed_between_query(1, start, today)
+        ).scalar()
+        self.assertEqual(report.avg_resting_heart_rate, metrics.avg_resting_heart_rate)
+        self.assertEqual(report.avg_diastolic_bp, metrics.avg_diastolic_bp)
+        self.assertEqual(report.avg_sleep_duration, sleep.avg_sleep_duration)
+        self.assertEqual(report.avg_calories, calories)
+        self.assertEqual(report.workouts_completed, workouts)
+        self.assertEqual(report.goals_completed, goals)
+
+    def test_custom_window(self):
+        report = reports.monthly_report(self.session, 1, window=7)
+        self.assertEqual(report.end_date - report.start_date, timedelta(days=7))
+        self.assertEqual(report.workouts_completed, 7)
+
+    def test_user_without_data(self):
+        report = reports.monthly_report(self.session, 999)
+        self.assertIsNone(report.avg_resting_heart_rate)
+        self.assertEqual(report.workouts_completed, 0)
+
+
+class TestFleetReports(BaseTestCase):
+    # test the batch report api against the per user monthly report
+    def setUp(self):
+        super().setUp()
+        seeding.seed(self.engine, users=4, days=35, random_seed=9, report=None)
+        # a user without any logs still gets a report
+        self.session.add(User(name="Empty", email="empty@example.com", password="pw"))
+        self.session.commit()
+
+    def test_matches_monthly_report(self):
+        fleet = list(reports.fleet_reports(self.session, window=30))
+        self.assertEqual([report.user_id for report in fleet], [1, 2, 3, 4, 5])
+        for report in fleet:
+            self.assertEqual(
+                report, reports.monthly_report(self.session, report.user_id, 30)
+            )
+
+    def test_selected_users_in_order(self):
+        fleet = reports.fleet_reports(
+            self.session, user_ids=[4, 2, 99, 2], chunk_size=1
+        )
+        self.assertEqual([report.user_id for report in fleet], [2, 4])
+
+    def test_user_without_logs(self):
+        (report,) = reports.fleet_reports(self.session, user_ids=[5])
+        self.assertIsNone(report.avg_sleep_duration)
+        self.assertEqual(report.workouts_completed, 0)
+        self.assertEqual(report.goals_completed, 0)
+
+
+class TestDailySummary(BaseTestCase):
+    # test that ORM writes keep the daily summary rollup current
+    def setUp(self):
+        super().setUp()
+        self.user = User(name="Test User", email="test@example.com", password="pw")
+        self.food = Food(name="Apple", calories=100, category=5)
+        self.user_workout = UserWorkout(
+            exercise_type=1, description="Run", duration=1.0, difficulty_level=1
+        )
+        self.session.add_all([self.user, self.food, self.user_workout])
+        self.session.commit()
+        self.day = date(2023, 11, 8)
+        noon = datetime(2023, 11, 8, 12)
+        self.session.add_all(
+            [
+                HealthMetric(
+                    user_id=self.user.id,
+                    heart_rate=60,
+                    steps_taken=1000,
+                    stand_hours=4,
+                    systolic_bp=110,
+                    diastolic_bp=70,
+                    timestamp=noon,
+                ),
+                HealthMetric(
+                    user_id=self.user.id,
+                    heart_rate=80,
+                    steps_taken=3000,
+                    stand_hours=6,
+                    systolic_bp=120,
+                    diastolic_bp=80,
+                    timestamp=noon + timedelta(hours=6),
+                ),
+                SleepLog(
+                    user_id=self.user.id,
+                    duration=8.0,
+                    quality=3,
+                    start_time=datetime(2023, 11, 8, 22).time(),
+                    end_time=datetime(2023, 11, 9, 6).time(),
+                    date=self.day,
+                ),
+                FoodLog(user_id=self.user.id, food_id=self.food.id, date=self.day),
+                FoodLog(user_id=self.user.id, food_id=self.food.id, date=self.day),
+                WorkoutLog(
+                    user_id=self.user.id,
+                    user_workout_id=self.user_workout.id,
+                    calories_burned=300,
+                    heart_rate=150,
+                    date=self.day,
+                ),
+            ]
+        )
+        self.session.commit()
+
+    def summary(self, day=None):
+        return self.session.get(DailyUserSummary, (self.user.id, day or self.day))
+
+    def test_insert_updates_summary(self):
+        summary = self.summary()
+        self.assertEqual(summary.metric_count, 2)
+        self.assertEqual(summary.avg_heart_rate, 70)
+        self.assertEqual(summary.avg_steps_taken, 2000)
+        self.assertEqual(summary.sleep_count, 1)
+        self.assertEqual(summary.sleep_duration, 8.0)
+        self.assertEqual(summary.calories_in, 200)
+        self.assertEqual(summary.calories_burned, 300)
+        self.assertEqual(summary.workout_count, 1)
+
+    def test_moved_log_updates_both_days(self):
+        workout = self.session.query(WorkoutLog).one()
+        workout.date = self.day + timedelta(days=1)
+        self.session.commit()
+        self.session.expire_all()
+        self.assertEqual(self.summary().workout_count, 0)
+        self.assertIsNone(self.summary().calories_burned)
+        self.assertEqual(self.summary(workout.date).workout_count, 1)
+
+    def test_deleted_logs_remove_the_day(self):
+        for model in (HealthMetric, SleepLog, FoodLog, WorkoutLog):
+            for row in self.session.query(model):
+                self.session.delete(row)
+        self.session.commit()
+        self.session.expire_all()
+        self.assertIsNone(self.summary())
+
+    def test_only_app_sessions_are_tracked(self):
+        # a plain SQLAlchemy session (another engine, a shard etc) is left alone
+        other = Session(bind=self.engine)
+        other.add(
+            SleepLog(
+                user_id=self.user.id,
+                duration=6.0,
+                quality=2,
+                start_time=datetime(2023, 11, 9, 22).time(),
+                end_time=datetime(2023, 11, 10, 4).time(),
+                date=self.day + timedelta(days=1),
+            )
+        )
+        other.commit()
+        other.close()
+        self.assertIsNone(self.summary(self.day + timedelta(days=1)))
+
+    def test_food_calorie_change(self):
+        self.food.calories = 150
+        self.session.commit()
+        self.session.expire_all()
+        self.assertEqual(self.summary().calories_in, 300)
+
+    def test_backfill(self):
+        with self.engine.begin() as connection:
+            self.assertEqual(daily_summary.history(connection), (self.day, self.day))
+            connection.execute(DailyUserSummary.__table__.delete())
+        self.assertEqual(daily_summary.backfill(self.engine), 1)
+        summary = self.summary()
+        self.assertEqual((summary.metric_count, summary.calories_in), (2, 200))
+
+    def test_existing_database_backfilled_on_import(self):
+        # a database built before the rollup gets it from init_db
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "health_database.db")
+            engine = create_engine(f"sqlite:///{path}")
+            Base.metadata.create_all(engine)
+            rows = [self.user, self.food, self.user_workout]
+            rows += (
+                self.session.query(SleepLog).all() + self.session.query(FoodLog).all()
+            )
+            with engine.begin() as connection:
+                for row in rows:
+                    table = type(row).__table__
+                    values = {
+                        column.name: getattr(row, column.name)
+                        for column in table.columns
+                    }
+                    connection.execute(table.insert().values(values))
+            DailyUserSummary.__table__.drop(engine)
+            engine.dispose()
+            subprocess.run(
+                [sys.executable, "-c", "import init_db"],
+                cwd=directory,
+                env={
+                    **os.environ,
+                    "PYTHONPATH": os.path.dirname(os.path.abspath(__file__)),
+                },
+                check=True,
+            )
+            with engine.connect() as connection:
+                row = connection.execute(select(DailyUserSummary)).one()
+            engine.dispose()
+        self.assertEqual(
+            (row.date, row.sleep_duration, row.calories_in), (self.day, 8.0, 200)
+        )
+
+    def test_rollback_discards_summary_changes(self):
+        self.session.add(
+            WorkoutLog(
+                user_id=self.user.id,
+                user_workout_id=self.user_workout.id,
+                calories_burned=100,
+                heart_rate=120,
+                date=self.day,
+            )
+        )
+        self.session.flush()
+        self.assertEqual(self.summary().workout_count, 2)
+        self.session.rollback()
+        self.assertEqual(self.summary().workout_count, 1)
+
+    def test_missing_metrics_do_not_weigh_in(self):
+        # a day without any heart rate and a day where one reading left it out: the
+        # rollup averages match the raw readings
+        noon = datetime(2023, 11, 9, 12)
+        self.session.add_all(
+            [
+                HealthMetric(user_id=self.user.id, steps_taken=500, timestamp=noon),
+                HealthMetric(
+                    user_id=self.user.id,
+                    heart_rate=90,
+                    timestamp=noon + timedelta(days=1),
+                ),
+                HealthMetric(
+                    user_id=self.user.id,
+                    steps_taken=700,
+                    timestamp=noon + timedelta(days=1, hours=1),
+                ),
+            ]
+        )
+        self.session.commit()
+        end = self.day + timedelta(days=2)
+        raw = self.session.execute(
+            reports.avg_health_metrics_query(
+                self.session.connection(), self.user.id, self.day, end, precision=2
+            )
+        ).one()
+        summary = self.session.execute(
+            reports.summary_health_query(self.user.id, self.day, end, precision=2)
+        ).one()
+        self.assertEqual(raw.avg_resting_heart_rate, round(230 / 3, 2))
+        self.assertEqual(summary._asdict(), raw._asdict())
+        self.assertEqual(self.summary(self.day + timedelta(days=1)).heart_rate_count, 0)
+
+    def test_rebuild_range(self):
+        with self.engine.begin() as connection:
+            connection.execute(DailyUserSummary.__table__.delete())
+        rows = daily_summary.rebuild_range(self.engine, self.day, self.day)
+        self.assertEqual(rows, 1)
+        self.assertEqual(self.summary().calories_in, 200)
+
+
+class TestSummaryReports(BaseTestCase):
+    # test that the reports read from the rollup match the raw log queries
+    def setUp(self):
+        super().setUp()
+        seeding.seed(
+            self.engine,
+            users=3,
+            days=35,
+            readings_per_day=3,
+            random_seed=3,
+            report=None,
+        )
+        self.end = date.today()
+        self.start = self.end - timedelta(days=30)
+
+    def test_monthly_summary_matches_raw_logs(self):
+        for user_id in (1, 2, 3):
+            summary = self.session.execute(
+                reports.monthly_summary_query(user_id, self.start, self.end)
+            ).one()
+            raw = self.session.execute(
+                reports.monthly_report_query(
+                    self.session.connection(), user_id, self.start, self.end
+                )
+            ).one()
+            self.assertEqual(summary._asdict(), raw._asdict())
+
+    def test_fleet_summary_matches_raw_logs(self):
+        summary = self.session.execute(
+            reports.fleet_summary_query(self.start, self.end)
+        ).all()
+        raw = self.session.execute(
+            reports.fleet_report_query(self.session.connection(), self.start, self.end)
+        ).all()
+        self.assertEqual(summary, raw)
+
+    def test_one_summary_row_per_day(self):
+        rows = self.session.scalars(
+            reports.daily_summary_query(1, self.start, self.end)
+        ).all()
+        self.assertEqual(len(rows), 31)
+        self.assertEqual(rows[0].date, self.start)
+
+
+class TestReportCache(BaseTestCase):
+    # test the eviction rules and the write driven invalidation of the report cache
+    def setUp(self):
+        super().setUp()
+        self.now = 0.0
+        self.cache = ReportCache(max_entries=3, ttl=60, clock=lambda: self.now)
+
+        # a session class of its own, so the test cache does not see other tests
+        class CachedSession(Session):
+            pass
+
+        self.cache.track(CachedSession)
+        self.session = sessionmaker(bind=self.engine, class_=CachedSession)()
+        self.user = User(name="Test User", email="test@example.com", password="pw")
+        self.other = User(name="Other User", email="other@example.com", password="pw")
+        self.session.add_all([self.user, self.other])
+        self.session.commit()
+
+    def add_metric(self, user):
+        self.session.add(
+            HealthMetric(
+                user_id=user.id,
+                heart_rate=70,
+                steps_taken=100,
+                stand_hours=1,
+                systolic_bp=110,
+                diastolic_bp=70,
+                timestamp=datetime.now(),
+            )
+        )
+
+    def test_shared_cache_tracks_app_sessions(self):
+        shared = report_cache.report_cache
+        shared.put("health", self.user.id, 30, "cached")
+        for session_class in (Session, db_session.AppSession):
+            session = session_class(bind=self.engine)
+            session.add(
+                HealthMetric(
+                    user_id=self.user.id, heart_rate=70, timestamp=datetime.now()
+                )
+            )
+            session.commit()
+            session.close()
+            if session_class is Session:
+                # other sessions do not touch the app's cache
+                self.assertEqual(shared.get("health", self.user.id, 30), "cached")
+        self.assertIsNone(shared.get("health", self.user.id, 30))
+        shared.clear()
+
+    def test_hits_and_misses(self):
+        self.assertIsNone(self.cache.get("health", 1, 30))
+        self.cache.put("health", 1, 30, (70.0, 100.0))
+        self.assertEqual(self.cache.get("health", 1, 30), (70.0, 100.0))
+        stats = self.cache.stats()
+        self.assertEqual((stats.hits, stats.misses, stats.entries), (1, 1, 1))
+
+    def test_least_recently_used_evicted(self):
+        for user_id in (1, 2, 3):
+            self.cache.put("health", user_id, 30, user_id)
+        self.cache.get("health", 1, 30)
+        self.cache.put("health", 4, 30, 4)
+        self.assertIsNone(self.cache.get("health", 2, 30))
+        self.assertEqual(self.cache.get("health", 1, 30), 1)
+        self.assertEqual(self.cache.stats().evictions, 1)
+
+    def test_memory_cap(self):
+        cache = ReportCache(max_bytes=200)
+        cache.put("health", 1, 30, (1.0, 2.0))
+        cache.put("health", 2, 30, (1.0, 2.0))
+        self.assertLessEqual(cache.stats().bytes, 200)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats().evictions, 1)
+
+    def test_ttl(self):
+        self.cache.put("health", 1, 30, 1)
+        self.now = 61
+        self.assertIsNone(self.cache.get("health", 1, 30))
+        self.assertEqual(self.cache.stats().expirations, 1)
+
+    def test_flush_invalidates_only_the_user(self):
+        self.cache.put("health", self.user.id, 30, 1)
+        self.cache.put("sleep", self.user.id, 30, 2)
+        self.cache.put("health", self.other.id, 30, 3)
+        self.add_metric(self.user)
+        self.session.flush()
+        self.assertIsNone(self.cache.get("health", self.user.id, 30))
+        self.assertIsNone(self.cache.get("sleep", self.user.id, 30))
+        self.assertEqual(self.cache.get("health", self.other.id, 30), 3)
+        self.assertEqual(self.cache.stats().invalidations, 2)
+
+    def test_commit_and_rollback_invalidate_again(self):
+        self.add_metric(self.user)
+        self.session.flush()
+        # cached by a reader after the flush, before the commit
+        self.cache.put("health", self.user.id, 30, 1)
+        self.session.commit()
+        self.assertIsNone(self.cache.get("health", self.user.id, 30))
+
+        self.add_metric(self.user)
+        self.session.flush()
+        self.cache.put("health", self.user.id, 30, 2)
+        self.session.rollback()
+        self.assertIsNone(self.cache.get("health", self.user.id, 30))
+
+    def test_get_or_compute(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return "report"
+
+        self.assertEqual(self.cache.get_or_compute("r", 1, 30, compute), "report")
+        self.assertEqual(self.cache.get_or_compute("r", 1, 30, compute), "report")
+        self.assertEqual(len(calls), 1)
+
+
+class TestCatalog(BaseTestCase):
+    # test the in memory catalog of foods and workout recommendations
+    def setUp(self):
+        super().setUp()
+        self.session.add_all(
+            [
+                Food(name="Apple", calories=95, category=5),
+                Food(name="Pear", calories=100, category=5),
+                Food(name="Steak", calories=500, category=1),
+                WorkoutRecommendation(
+                    workout_name="Run",
+                    exercise_type=1,
+                    duration=0.5,
+                    difficulty_level=1,
+                ),
+            ]
+        )
+        self.session.commit()
+        self.now = 0.0
+        self.catalog = Catalog(self.engine, check_interval=5, clock=lambda: self.now)
+
+    def add_food(self, name):
+        with self.engine.begin() as connection:
+            connection.execute(
+                Food.__table__.insert(), {"name": name, "calories": 10, "category": 4}
+            )
+
+    def test_lookups(self):
+        foods = self.catalog.foods()
+        apple = foods.by_name("Apple")[0]
+        self.assertEqual(foods.get(apple.id), apple)
+        self.assertEqual(apple.calories, 95)
+        self.assertEqual(
+            [food.name for food in foods.in_category(5)], ["Apple", "Pear"]
+        )
+        self.assertEqual(len(foods), 3)
+        self.assertIn(apple.id, foods)
+        self.assertEqual(self.catalog.recommendations().in_category(1)[0].duration, 0.5)
+
+    def test_records_are_immutable(self):
+        apple = self.catalog.foods().by_name("Apple")[0]
+        with self.assertRaises(AttributeError):
+            apple.calories = 0
+
+    def test_reloads_when_the_version_moves(self):
+        foods = self.catalog.foods()
+        self.add_food("Carrot")
+        # still inside the check interval
+        self.assertIs(self.catalog.foods(), foods)
+        self.now = 10
+        self.assertEqual(len(self.catalog.foods()), 4)
+        self.assertEqual(self.catalog.loads, 2)
+
+    def test_unchanged_version_keeps_the_snapshot(self):
+        foods = self.catalog.foods()
+        self.catalog.recommendations()
+        self.now = 10
+        self.assertIs(self.catalog.foods(), foods)
+        self.assertEqual(self.catalog.loads, 2)
+
+    def test_updates_and_deletes_move_the_version(self):
+        version = self.catalog.foods().version
+        food = self.session.query(Food).filter_by(name="Pear").one()
+        food.calories = 90
+        self.session.commit()
+        self.session.delete(food)
+        self.session.commit()
+        self.catalog.invalidate()
+        self.assertEqual(self.catalog.foods().version, version + 2)
+
+    def test_commit_invalidates_the_shared_catalog(self):
+        catalog = catalog_for(self.engine)
+        self.assertEqual(len(catalog.foods()), 3)
+        self.session.add(Food(name="Carrot", calories=25, category=4))
+        self.session.commit()
+        self.assertEqual(len(catalog.foods()), 4)
+
+
+class TestRecommendationIndex(unittest.TestCase):
+    # test the in memory recommendation search against a plain filter
+    def setUp(self):
+        rng = random.Random(1)
+        self.records = [
+            RecommendationRecord(
+                i, f"Workout {i}", None, rng.randint(1, 3), rng.uniform(0, 2), 1
+            )
+            for i in range(1, 501)
+        ]
+        self.index = RecommendationIndex(
+            CatalogSnapshot(0, self.records, "workout_name", "exercise_type")
+        )
+
+    def matches(self, exercise_type, difficulty_level, max_duration):
+        return {
+            record.id
+            for record in self.records
+            if record.exercise_type == exercise_type
+            and record.difficulty_level == difficulty_level
+            and record.duration <= max_duration
+        }
+
+    def test_results_match_the_filter(self):
+        expected = self.matches(2, 1, 0.75)
+        results = self.index.search(2, 1, 0.75, k=10)
+        self.assertEqual(len(results), 10)
+        self.assertEqual(len({record.id for record in results}), 10)
+        self.assertTrue({record.id for record in results} <= expected)
+        self.assertEqual(self.index.count(2, 1, 0.75), len(expected))
+
+    def test_fewer_matches_than_k(self):
+        expected = self.matches(1, 1, 0.05)
+        results = self.index.search(1, 1, 0.05, k=1000)
+        self.assertEqual({record.id for record in results}, expected)
+
+    def test_no_bucket(self):
+        self.assertEqual(self.index.search(3, 3, 2.0, k=5), [])
+        self.assertEqual(self.index.count(3, 3, 2.0), 0)
+
+    def test_duration_bound_is_inclusive(self):
+        record = self.records[0]
+        results = self.index.search(record.exercise_type, 1, record.duration, k=None)
+        self.assertIn(record, results)
+
+
+class TestRecommendationSearch(BaseTestCase):
+    # test that the search follows changes to the recommendation table
+    def test_refresh_on_table_change(self):
+        search = RecommendationSearch(Catalog(self.engine, check_interval=0))
+        self.assertEqual(search.recommend(1, 1, 1.0), [])
+        self.session.add(
+            WorkoutRecommendation(
+                workout_name="Run", exercise_type=1, duration=0.5, difficulty_level=1
+            )
+        )
+        self.session.commit()
+        (record,) = search.recommend(1, 1, 1.0)
+        self.assertEqual(record.workout_name, "Run")
+
+
+class TestSampling(BaseTestCase):
+    # test random sampling by id probing
+    def setUp(self):
+        super().setUp()
+        with self.engine.begin() as connection:
+            connection.execute(
+                Food.__table__.insert(),
+                [
+                    {"id": i, "name": f"Food {i}", "calories": i, "category": i % 5 + 1}
+                    for i in range(1, 1001)
+                ],
+            )
+        self.rng = random.Random(3)
+
+    def test_distinct_rows(self):
+        ids = sampling.sample_ids(self.session, Food, 50, rng=self.rng)
+        self.assertEqual(len(set(ids)), 50)
+        self.assertTrue(all(1 <= id_ <= 1000 for id_ in ids))
+
+    def test_filters(self):
+        foods = sampling.sample(
+            self.session, Food, 20, Food.category == 2, rng=self.rng
+        )
+        self.assertEqual(len(foods), 20)
+        self.assertTrue(all(food.category == 2 for food in foods))
+
+    def test_gaps_in_the_ids(self):
+        # only every 100th id is left, below the hit rate that probing needs
+        self.session.query(Food).filter(Food.id % 100 != 0).delete()
+        self.session.commit()
+        ids = sampling.sample_ids(self.session, Food, 5, rng=self.rng)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertTrue(all(id_ % 100 == 0 for id_ in ids))
+
+    def test_fewer_rows_than_k(self):
+        ids = sampling.sample_ids(self.session, Food, 10, Food.calories > 995)
+        self.assertEqual(sorted(ids), [996, 997, 998, 999, 1000])
+
+    def test_empty_table(self):
+        self.assertEqual(sampling.sample(self.session, Goal, 3), [])
+
+    def test_composite_primary_key(self):
+        # no id column, the rows are probed through their rowid
+        self.session.add(User(name="Sample", email="sample@example.com", password="pw"))
+        self.session.commit()
+        start = date(2023, 11, 1)
+        for i in range(30):
+            self.session.add(
+                DailyUserSummary(user_id=1, date=start + timedelta(days=i))
+            )
+        self.session.commit()
+        rows = sampling.sample(
+            self.session,
+            DailyUserSummary,
+            5,
+            DailyUserSummary.date >= date(2023, 11, 11),
+            rng=self.rng,
+        )
+        self.assertEqual(len({row.date for row in rows}), 5)
+        self.assertTrue(all(row.date >= date(2023, 11, 11) for row in rows))
+        self.assertEqual(sampling.sample(self.session, GoalProgress, 3), [])
+
+    def test_uniform(self):
+        # every matching row should be picked about equally often
+        counts = {}
+        for _ in range(2000):
+            for id_ in sampling.sample_ids(
+                self.session, Food, 2, Food.id <= 10, rng=self.rng
+            ):
+                counts[id_] = counts.get(id_, 0) + 1
+        self.assertEqual(sorted(counts), list(range(1, 11)))
+        self.assertLess(max(counts.values()) - min(counts.values()), 120)
+
+
+class TestPartitions(BaseTestCase):
+    # test moving health metrics into monthly partitions and reading them back
+    def setUp(self):
+        super().setUp()
+        seeding.seed(
+            self.engine,
+            users=2,
+            days=70,
+            readings_per_day=2,
+            random_seed=4,
+            report=None,
+        )
+        self.today = date.today()
+        self.start = self.today - timedelta(days=30)
+        self.total = self.session.query(HealthMetric).count()
+
+    def tearDown(self):
+        # the partitions reference the users, so they go first
+        with self.engine.connect() as connection:
+            months = partitions.list_partitions(connection)
+        for month in months:
+            partitions.drop_partition(self.engine, month)
+        super().tearDown()
+
+    def partition_counts(self):
+        with self.engine.connect() as connection:
+            return {
+                month: connection.execute(
+                    select(func.count()).select_from(partitions.partition_table(month))
+                ).scalar()
+                for month in partitions.list_partitions(connection)
+            }
+
+    def test_archive_moves_old_months(self):
+        moved = partitions.archive(self.engine)
+        self.assertEqual(self.partition_counts(), moved)
+        self.assertEqual(len(moved), 3 if self.today.day < 10 else 2)
+        remaining = self.session.query(HealthMetric).all()
+        self.assertEqual(len(remaining) + sum(moved.values()), self.total)
+        first_of_month = partitions.month_start(self.today)
+        self.assertTrue(
+            all(row.timestamp.date() >= first_of_month for row in remaining)
+        )
+
+    def test_router_reads_the_same_rows(self):
+        end = datetime.combine(self.today, datetime.min.time())
+        with self.engine.connect() as connection:
+            before = retention.avg_health_metrics(connection, 1, self.start, end)
+        partitions.archive(self.engine)
+        with self.engine.connect() as connection:
+            after = retention.avg_health_metrics(connection, 1, self.start, end)
+            tables = partitions.tables_between(connection, self.start, end)
+        self.assertEqual(before, after)
+        self.assertLessEqual(len(tables), 3)
+        self.assertEqual(tables[0].name, "health_metrics")
+
+    def test_raw_reports_read_partitions(self):
+        # the report builders over the raw readings see the archived months too
+        def run():
+            connection = self.session.connection()
+            results = [
+                self.session.execute(
+                    reports.avg_health_metrics_query(connection, 1, self.start, None, 2)
+                ).one(),
+                self.session.execute(
+                    reports.avg_steps_query(connection, 1, self.start)
+                ).scalar(),
+                self.session.execute(
+                    reports.monthly_report_query(connection, 1, self.start, self.today)
+                ).one(),
+                self.session.execute(
+                    reports.fleet_report_query(connection, self.start, self.today)
+                ).all(),
+            ]
+            self.session.commit()
+            return results
+
+        before = run()
+        self.assertIsNotNone(before[0].avg_resting_heart_rate)
+        partitions.archive(self.engine)
+        self.assertEqual(run(), before)
+
+    def test_summary_rebuild_reads_partitions(self):
+        before = self.session.execute(
+            reports.monthly_summary_query(1, self.start, self.today)
+        ).one()
+        partitions.archive(self.engine)
+        daily_summary.rebuild_range(self.engine, self.today - timedelta(days=70))
+        after = self.session.execute(
+            reports.monthly_summary_query(1, self.start, self.today)
+        ).one()
+        self.assertEqual(before, after)
+
+    def test_archive_same_month_twice(self):
+        moved = partitions.archive(self.engine)
+        month = min(moved)
+        table = partitions.partition_table(month)
+        with self.engine.begin() as connection:
+            archived = connection.execute(
+                select(table).order_by(table.c.id).limit(2)
+            ).all()
+            # a re-sent reading of an archived month (under an id the partition
+            # already uses) and a late reading of that month
+            connection.execute(
+                insert(HealthMetric),
+                [
+                    {
+                        "id": archived[1].id,
+                        "user_id": archived[0].user_id,
+                        "timestamp": archived[0].timestamp,
+                        "heart_rate": 199,
+                    },
+                    {
+                        "id": archived[0].id,
+                        "user_id": archived[0].user_id,
+                        "timestamp": archived[0].timestamp + timedelta(seconds=1),
+                        "heart_rate": 198,
+                    },
+                ],
+            )
+        self.assertEqual(partitions.archive_month(self.engine, month), 2)
+        self.assertEqual(self.partition_counts()[month], moved[month] + 1)
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(table.c.id, table.c.heart_rate)
+                .where(
+                    table.c.user_id == archived[0].user_id,
+                    table.c.timestamp.in_(
+                        [
+                            archived[0].timestamp,
+                            archived[0].timestamp + timedelta(seconds=1),
+                        ]
+                    ),
+                )
+                .order_by(table.c.timestamp)
+            ).all()
+        # the archived reading was updated in place, the late one got a new id
+        self.assertEqual(rows[0], (archived[0].id, 199))
+        self.assertEqual(rows[1].heart_rate, 198)
+        self.assertNotIn(rows[1].id, [row.id for row in archived])
+        self.assertEqual(
+            self.session.query(HealthMetric).count(), self.total - sum(moved.values())
+        )
+
+    def test_router_between_archives(self):
+        # a reading re-sent through upsert.py after its month was archived is read
+        # once by the router, before the month is archived again
+        moved = partitions.archive(self.engine)
+        month = min(moved)
+        table = partitions.partition_table(month)
+        start, end = partitions._month_bounds(month)
+        with self.engine.begin() as connection:
+            archived = connection.execute(select(table).limit(1)).one()
+            row = {
+                column: value
+                for column, value in archived._mapping.items()
+                if column != "id"
+            }
+            self.assertEqual(upsert(connection, HealthMetric, [row]), 0)
+            window = partitions.health_metrics_between(connection, start, end)
+            count = connection.execute(select(func.count()).select_from(window))
+            self.assertEqual(count.scalar(), moved[month])
+
+    def test_create_compact_drop(self):
+        month = date(2020, 1, 1)
+        partitions.create_partition(self.engine, month)
+        partitions.create_partition(self.engine, month)
+        self.assertEqual(self.partition_counts(), {month: 0})
+        moved = partitions.archive(self.engine)
+        old_month = min(moved)
+        self.assertEqual(
+            partitions.compact_partition(self.engine, old_month), moved[old_month]
+        )
+        partitions.drop_partition(self.engine, old_month)
+        self.assertNotIn(old_month, self.partition_counts())
+
+
+class TestRetention(BaseTestCase):
+    # test rolling old health metrics into hourly and daily aggregates
+    def setUp(self):
+        super().setUp()
+        seeding.seed(
+            self.engine,
+            users=2,
+            days=100,
+            readings_per_day=3,
+            random_seed=6,
+            report=None,
+        )
+        self.today = date.today()
+        self.start = self.today - timedelta(days=100)
+        self.end = self.today + timedelta(days=1)
+
+    def tearDown(self):
+        with self.engine.connect() as connection:
+            months = partitions.list_partitions(connection)
+        for month in months:
+            partitions.drop_partition(self.engine, month)
+        super().tearDown()
+
+    def stats(self, user_id):
+        with self.engine.connect() as connection:
+            row = retention.health_stats(connection, user_id, self.start, self.end)
+        return {key: round(value, 6) for key, value in row._mapping.items()}
+
+    def test_apply_keeps_the_statistics(self):
+        before = [self.stats(1), self.stats(2)]
+        result = retention.apply(
+            self.engine, raw_days=20, hourly_days=50, batch_size=50, today=self.today
+        )
+        self.assertEqual([self.stats(1), self.stats(2)], before)
+        self.assertGreater(result.raw_rolled, 0)
+        self.assertGreater(result.hourly_rolled, 0)
+        cutoff = datetime.combine(self.today - timedelta(days=20), datetime.min.time())
+        oldest = self.session.query(func.min(HealthMetric.timestamp)).scalar()
+        self.assertGreaterEqual(oldest, cutoff)
+        oldest_hour = self.session.query(func.min(HealthMetricHourly.hour)).scalar()
+        self.assertGreaterEqual(oldest_hour, cutoff - timedelta(days=30))
+        self.assertGreater(self.session.query(HealthMetricDaily).count(), 0)
+        # nothing is left to roll on the second run
+        self.assertEqual(
+            retention.apply(self.engine, raw_days=20, hourly_days=50),
+            retention.RetentionStats(0, 0, 0),
+        )
+
+    def test_late_reading_merges_into_its_hour(self):
+        retention.apply(self.engine, raw_days=20, hourly_days=50)
+        bucket = self.session.query(HealthMetricHourly).filter_by(user_id=1).first()
+        count, heart_rate_max = bucket.reading_count, bucket.heart_rate_max
+        self.session.add(
+            HealthMetric(
+                user_id=1,
+                heart_rate=heart_rate_max + 10,
+                steps_taken=None,
+                stand_hours=1,
+                systolic_bp=120,
+                diastolic_bp=80,
+                timestamp=bucket.hour + timedelta(minutes=30),
+            )
+        )
+        self.session.commit()
+        retention.apply(self.engine, raw_days=20, hourly_days=50)
+        self.session.refresh(bucket)
+        self.assertEqual(bucket.reading_count, count + 1)
+        self.assertEqual(bucket.heart_rate_max, heart_rate_max + 10)
+        self.assertEqual(bucket.steps_taken_count, count)
+
+    def test_summary_rebuild_reads_every_tier(self):
+        before = self.session.execute(
+            reports.monthly_summary_query(1, self.start, self.today)
+        ).one()
+        partitions.archive(self.engine)
+        retention.apply(self.engine, raw_days=20, hourly_days=50, batch_size=100)
+        daily_summary.rebuild_range(self.engine, self.start, self.today)
+        after = self.session.execute(
+            reports.monthly_summary_query(1, self.start, self.today)
+        ).one()
+        self.assertEqual(before, after)
+        # the partitions before the raw cutoff were emptied and dropped
+        with self.engine.connect() as connection:
+            self.assertLessEqual(len(partitions.list_partitions(connection)), 1)
+
+    def test_hourly_days_before_raw_days(self):
+        with self.assertRaises(ValueError):
+            retention.apply(self.engine, raw_days=30, hourly_days=7)
+
+
+class TestIngest(unittest.TestCase):
+    # test the buffered ingest against a database file (the writer is another thread)
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "ingest.db")
+        self.engine = init_db.create_health_engine(f"sqlite:///{path}", "ingest")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.session.add_all(
+            [
+                User(name="Device One", email="one@example.com", password="pw"),
+                User(name="Device Two", email="two@example.com", password="pw"),
+            ]
+        )
+        self.session.commit()
+        self.now = datetime.now().replace(microsecond=0)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def reading(self, user_id=1, minutes=0, heart_rate=60):
+        return HealthMetric(
+            user_id=user_id,
+            heart_rate=heart_rate,
+            steps_taken=100,
+            stand_hours=1,
+            systolic_bp=120,
+            diastolic_bp=80,
+            timestamp=self.now - timedelta(minutes=minutes),
+        )
+
+    def test_group_commit(self):
+        with Ingestor(self.engine, max_batch=50, max_delay=10) as ingestor:
+            ingestor.submit([self.reading(1 + i % 2, i) for i in range(120)])
+            ingestor.submit(
+                [
+                    SleepLog(
+                        user_id=1,
+                        duration=8,
+                        quality=4,
+                        start_time=time(23),
+                        end_time=time(7),
+                        date=self.now.date(),
+                    )
+                ]
+            )
+            ingestor.flush()
+            stats = ingestor.stats()
+        self.assertEqual(stats.rows, 121)
+        self.assertLessEqual(stats.flushes, 3)
+        self.assertEqual(stats.buffered, 0)
+        self.assertGreater(stats.rows_per_second, 0)
+        self.assertEqual(self.session.query(HealthMetric).count(), 120)
+        # the daily summary is refreshed in the same transaction
+        counts = dict(
+            self.session.query(
+                DailyUserSummary.user_id, func.sum(DailyUserSummary.metric_count)
+            ).group_by(DailyUserSummary.user_id)
+        )
+        self.assertEqual(counts, {1: 60, 2: 60})
+        self.assertEqual(
+            self.session.query(func.sum(DailyUserSummary.sleep_count)).scalar(), 1
+        )
+
+    def test_flushes_after_max_delay(self):
+        with Ingestor(self.engine, max_batch=1000, max_delay=0.05) as ingestor:
+            ingestor.submit([self.reading(minutes=i) for i in range(3)])
+            deadline = datetime.now() + timedelta(seconds=5)
+            while ingestor.stats().rows < 3 and datetime.now() < deadline:
+                threading.Event().wait(0.01)
+            self.assertEqual(ingestor.stats().rows, 3)
+
+    def test_backpressure(self):
+        # another connection holds the write lock, so the first flush cannot finish
+        blocker = self.engine.raw_connection()
+        blocker.cursor().execute("BEGIN IMMEDIATE")
+        ingestor = Ingestor(self.engine, max_batch=10, max_buffered=10)
+        try:
+            ingestor.submit([self.reading(minutes=i) for i in range(10)])
+            with self.assertRaises(BufferFull):
+                ingestor.submit([self.reading()], timeout=0.1)
+            self.assertEqual(ingestor.stats().waits, 1)
+        finally:
+            blocker.rollback()
+            blocker.close()
+        ingestor.submit([self.reading(minutes=10)], timeout=5)
+        ingestor.close()
+        self.assertEqual(self.session.query(HealthMetric).count(), 11)
+
+    def test_resent_upload_is_skipped(self):
+        with Ingestor(self.engine, max_delay=10) as ingestor:
+            ingestor.submit([self.reading(minutes=i) for i in range(5)])
+            ingestor.flush()
+            ingestor.submit([self.reading(minutes=i) for i in range(6)])
+            ingestor.flush()
+            stats = ingestor.stats()
+        self.assertEqual((stats.rows, stats.duplicates), (6, 5))
+        self.assertEqual(self.session.query(HealthMetric).count(), 6)
+        self.assertEqual(
+            self.session.query(func.sum(DailyUserSummary.metric_count)).scalar(), 6
+        )
+
+    def test_bad_records(self):
+        cache = ReportCache()
+        cache.put("avg_health_metrics", 1, 30, (60,))
+        ingestor = Ingestor(self.engine, cache=cache)
+        with self.assertRaises(TypeError):
+            ingestor.submit([Food(name="Apple", calories=50, category=5)])
+        with self.assertRaises(ValueError):
+            ingestor.submit([HealthMetric(heart_rate=60, timestamp=self.now)])
+        ingestor.submit([self.reading()])
+        ingestor.flush()
+        self.assertIsNone(cache.get("avg_health_metrics", 1, 30))
+        # rows that break a constraint are rejected, the rest of the flush commits
+        good = ingestor.submit([self.reading(minutes=1), self.reading(minutes=2)])
+        bad = ingestor.submit(
+            [self.reading(minutes=3, heart_rate=-1), self.reading(2, minutes=3)]
+        )
+        unknown_user = ingestor.submit([self.reading(99, minutes=4)])
+        ingestor.flush()
+        ingestor.close()
+        self.assertTrue(good.done())
+        self.assertEqual((good.accepted, good.rejected), (2, []))
+        self.assertEqual(bad.accepted, 1)
+        self.assertEqual([row.row["heart_rate"] for row in bad.rejected], [-1])
+        self.assertIsInstance(bad.rejected[0].error, sqlite3.IntegrityError)
+        self.assertEqual(unknown_user.rejected[0].row["user_id"], 99)
+        self.assertIsNone(bad.error)
+        stats = ingestor.stats()
+        self.assertEqual((stats.rows, stats.failed_rows), (4, 2))
+        self.assertEqual(self.session.query(HealthMetric).count(), 4)
+        self.assertEqual(
+            self.session.query(func.sum(DailyUserSummary.metric_count)).scalar(), 4
+        )
+
+    def test_values_that_cannot_be_sorted_or_written(self):
+        # a timestamp with an offset among naive ones cannot be sorted, a string
+        # cannot be written to a DateTime column: only the string row is rejected
+        row = {
+            column.name: getattr(self.reading(), column.name)
+            for column in HealthMetric.__table__.columns
+            if column.name != "id"
+        }
+        # (a minute earlier, the same time would be a re-sent reading)
+        earlier = self.now - timedelta(minutes=1)
+        aware = dict(row, timestamp=earlier.replace(tzinfo=timezone.utc))
+        with Ingestor(self.engine, max_delay=10) as ingestor:
+            first = ingestor.submit_rows(HealthMetric, [row])
+            second = ingestor.submit_rows(HealthMetric, [aware, dict(row, user_id=2)])
+            bad = ingestor.submit_rows(HealthMetric, [dict(row, timestamp="soon")])
+            ingestor.flush()
+            stats = ingestor.stats()
+        self.assertIsNone(first.error)
+        self.assertEqual((first.accepted, second.accepted, bad.accepted), (1, 2, 0))
+        self.assertEqual(bad.rejected[0].row["timestamp"], "soon")
+        self.assertEqual((stats.rows, stats.failed_rows), (3, 1))
+
+
+class TestIngestServer(unittest.TestCase):
+    # test parsing uploads and a round trip through the line delimited JSON server
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "server.db")
+        self.engine = init_db.create_health_engine(f"sqlite:///{path}", "ingest")
+        Base.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(
+                User.__table__.insert(),
+                [{"name": "Device", "email": "device@example.com", "password": "pw"}],
+            )
+        self.record = {
+            "user_id": 1,
+            "heart_rate": 62,
+            "steps_taken": 340,
+            "timestamp": "2023-11-20T08:15:00",
+        }
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_parse_record(self):
+        row = ingest_server.parse_record("health_metrics", self.record)
+        self.assertEqual(row["timestamp"], datetime(2023, 11, 20, 8, 15))
+        self.assertIsNone(row["systolic_bp"])
+        self.assertNotIn("id", row)
+        bad_records = [
+            dict(self.record, heart_rate=-1),
+            dict(self.record, heart_rate="fast"),
+            dict(self.record, heart_rate=True),
+            dict(self.record, timestamp=None),
+            dict(self.record, timestamp="2023-11-20T08:15:00+02:00"),
+            dict(self.record, mood="happy"),
+        ]
+        for record in bad_records:
+            with self.assertRaises(ValueError):
+                ingest_server.parse_record("health_metrics", record)
+        with self.assertRaises(ValueError):
+            ingest_server.parse_record(
+                "workout_log",
+                {"user_id": 1, "date": "2023-11-20", "calories_burned": 300},
+            )
+
+    def test_round_trip(self):
+        replies = asyncio.run(self.upload())
+        self.assertEqual(replies[0], {"ok": True, "accepted": 2})
+        self.assertIn("record 1: heart_rate", replies[1]["error"])
+        self.assertIn("unknown user_id 7", replies[2]["error"])
+        self.assertIn("invalid JSON", replies[3]["error"])
+        # the second copy of the record is a re-sent reading, it is not written
+        self.assertEqual(replies[4]["stats"]["rows"], 1)
+        self.assertEqual(replies[4]["stats"]["duplicates"], 1)
+        with self.engine.connect() as connection:
+            count = connection.execute(
+                select(func.count()).select_from(HealthMetric)
+            ).scalar()
+        self.assertEqual(count, 1)
+
+    def test_workout_references(self):
+        with self.engine.begin() as connection:
+            connection.execute(
+                UserWorkout.__table__.insert(),
+                [
+                    {
+                        "exercise_type": 1,
+                        "description": "Run",
+                        "duration": 1,
+                        "difficulty_level": 2,
+                    }
+                ],
+            )
+            connection.execute(
+                WorkoutRecommendation.__table__.insert(),
+                [
+                    {
+                        "workout_name": "Yoga",
+                        "exercise_type": 3,
+                        "duration": 1,
+                        "difficulty_level": 1,
+                    }
+                ],
+            )
+        workout = {
+            "user_id": 1,
+            "calories_burned": 300,
+            "heart_rate": 120,
+            "date": "2023-11-20",
+        }
+        batches = [
+            [dict(workout, recommendation_id=1)],
+            [dict(workout, user_workout_id=1), dict(workout, recommendation_id=99)],
+            [dict(workout, user_workout_id=42)],
+            [dict(workout, user_workout_id=1)],
+        ]
+        ingestor = Ingestor(self.engine, max_delay=10)
+        server = ingest_server.IngestServer(ingestor)
+        replies = [
+            asyncio.run(
+                server.handle_line(
+                    json.dumps({"table": "workout_log", "records": records})
+                )
+            )
+            for records in batches
+        ]
+        ingestor.close()
+        self.assertIn("record 1: unknown recommendation_id 99", replies[1]["error"])
+        self.assertIn("record 0: unknown user_workout_id 42", replies[2]["error"])
+        self.assertEqual([reply["ok"] for reply in replies], [True, False, False, True])
+        # the good batches commit, the bad references never reached the writer
+        self.assertEqual(ingestor.stats().failed_rows, 0)
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(WorkoutLog.user_workout_id, WorkoutLog.recommendation_id)
+            ).all()
+        self.assertEqual({tuple(row) for row in rows}, {(None, 1), (1, None)})
+        # a batch that cannot be queued gets an error reply
+        reply = asyncio.run(
+            server.handle_line(
+                json.dumps({"table": "workout_log", "records": batches[0]})
+            )
+        )
+        self.assertEqual(
+            reply, {"ok": False, "error": "not queued: the ingestor is closed"}
+        )
+        self.assertEqual(server.errors, 1)
+
+    async def upload(self):
+        ingestor = Ingestor(self.engine, max_delay=0.01)
+        server = await ingest_server.IngestServer(ingestor).start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        lines = [
+            {"table": "health_metrics", "records": [self.record, self.record]},
+            {
+                "table": "health_metrics",
+                "records": [self.record, dict(self.record, heart_rate=-5)],
+            },
+            {"table": "health_metrics", "records": [dict(self.record, user_id=7)]},
+        ]
+        replies = []
+        for line in lines:
+            writer.write(json.dumps(line).encode() + b"\n")
+            replies.append(json.loads(await reader.readline()))
+        writer.write(b"{not json\n")
+        replies.append(json.loads(await reader.readline()))
+        await asyncio.get_running_loop().run_in_executor(None, ingestor.flush)
+        writer.write(b'{"stats": true}\n')
+        replies.append(json.loads(await reader.readline()))
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        ingestor.close()
+        return replies
+
+
+class TestUpsert(BaseTestCase):
+    # test the natural unique keys and the bulk upsert for re-sent uploads
+    def setUp(self):
+        super().setUp()
+        self.session.add(User(name="Device", email="device@example.com", password="pw"))
+        self.session.commit()
+        self.start = datetime(2023, 11, 20, 8)
+        self.rows = [
+            {
+                "user_id": 1,
+                "heart_rate": 60 + i,
+                "steps_taken": 100,
+                "stand_hours": 1,
+                "systolic_bp": 120,
+                "diastolic_bp": 80,
+                "timestamp": self.start + timedelta(minutes=i),
+            }
+            for i in range(3)
+        ]
+
+    def tearDown(self):
+        # the partitions reference the users, so they go first
+        with self.engine.connect() as connection:
+            months = partitions.list_partitions(connection)
+        for month in months:
+            partitions.drop_partition(self.engine, month)
+        super().tearDown()
+
+    def test_unique_keys(self):
+        self.session.add_all(
+            [
+                HealthMetric(user_id=1, heart_rate=60, timestamp=self.start),
+                HealthMetric(user_id=1, heart_rate=61, timestamp=self.start),
+            ]
+        )
+        with self.assertRaises(IntegrityError):
+            self.session.commit()
+        self.session.rollback()
+        sleep = {
+            "user_id": 1,
+            "duration": 8,
+            "quality": 3,
+            "start_time": time(23),
+            "end_time": time(7),
+            "date": self.start.date(),
+        }
+        self.session.add_all([SleepLog(**sleep), SleepLog(**sleep)])
+        with self.assertRaises(IntegrityError):
+            self.session.commit()
+
+    def test_upsert(self):
+        with self.engine.begin() as connection:
+            self.assertEqual(upsert(connection, HealthMetric, self.rows), 3)
+            # a re-sent batch is skipped
+            self.assertEqual(upsert(connection, HealthMetric, self.rows), 0)
+            changed = [dict(row, heart_rate=90) for row in self.rows]
+            self.assertEqual(upsert(connection, HealthMetric, changed, update=True), 3)
+            self.assertEqual(upsert(connection, HealthMetric, []), 0)
+        rates = [metric.heart_rate for metric in self.session.query(HealthMetric)]
+        self.assertEqual(rates, [90, 90, 90])
+
+    def test_resent_after_archive_and_rollup(self):
+        # a reading re-sent after its month was archived or rolled up is a duplicate
+        day = self.start.date()
+
+        def resend(rows, update=False):
+            with self.engine.begin() as connection:
+                written = upsert(connection, HealthMetric, rows, update)
+                daily_summary.refresh(connection, {(1, day)})
+            return written
+
+        def count(table):
+            with self.engine.connect() as connection:
+                return connection.execute(
+                    select(func.count()).select_from(table)
+                ).scalar()
+
+        def metric_count():
+            self.session.expire_all()
+            return self.session.get(DailyUserSummary, (1, day)).metric_count
+
+        self.assertEqual(resend(self.rows), 3)
+        partitions.archive(self.engine, before=date(2023, 12, 1))
+        partition = partitions.partition_table(date(2023, 11, 1))
+        self.assertEqual(resend(self.rows), 0)
+        self.assertEqual(count(HealthMetric.__table__), 0)
+        self.assertEqual(count(partition), 3)
+        self.assertEqual(metric_count(), 3)
+        # with update=True the archived readings are overwritten in the partition
+        changed = [dict(row, heart_rate=90) for row in self.rows]
+        self.assertEqual(resend(changed, update=True), 3)
+        self.assertEqual(count(HealthMetric.__table__), 0)
+        with self.engine.connect() as connection:
+            rates = connection.execute(select(partition.c.heart_rate)).scalars()
+            self.assertEqual(list(rates), [90, 90, 90])
+
+        # rolled into hourly aggregates, then into a daily one
+        retention.apply(
+            self.engine, raw_days=1, hourly_days=30, today=date(2023, 11, 22)
+        )
+        self.assertEqual(count(partition), 0)
+        self.assertEqual(resend(self.rows), 0)
+        self.assertEqual(count(HealthMetric.__table__), 0)
+        self.assertEqual(metric_count(), 3)
+        retention.apply(
+            self.engine, raw_days=1, hourly_days=1, today=date(2023, 11, 22)
+        )
+        self.assertEqual(count(HealthMetricHourly.__table__), 0)
+        self.assertEqual(resend(changed, update=True), 0)
+        self.assertEqual(count(HealthMetric.__table__), 0)
+        self.assertEqual(metric_count(), 3)
+
+    def test_upgrade_unique_indexes(self):
+        index = next(
+            index
+            for index in SleepLog.__table__.indexes
+            if index.name == "idx_sleeplog_userid_date"
+        )
+
+        def replace_with_plain_index():
+            with self.engine.begin() as connection:
+                index.drop(connection)
+                connection.exec_driver_sql(
+                    f"CREATE INDEX {index.name} ON sleep_log (user_id, date)"
+                )
+
+        def unique():
+            indexes = inspect(self.engine).get_indexes("sleep_log")
+            return {item["name"]: item["unique"] for item in indexes}[index.name]
+
+        # every index is already unique: one look at the schema, no table scans
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", record)
+        init_db.upgrade_unique_indexes(self.engine)
+        event.remove(self.engine, "before_cursor_execute", record)
+        self.assertEqual(len(statements), 1)
+        self.assertIn("sqlite_master", statements[0])
+
+        replace_with_plain_index()
+        init_db.upgrade_unique_indexes(self.engine)
+        self.assertTrue(unique())
+        # duplicates keep the old index
+        replace_with_plain_index()
+        sleep = {
+            "user_id": 1,
+            "duration": 8,
+            "quality": 3,
+            "start_time": time(23),
+            "end_time": time(7),
+            "date": self.start.date(),
+        }
+        with self.engine.begin() as connection:
+            connection.execute(SleepLog.__table__.insert(), [sleep, sleep])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            init_db.upgrade_unique_indexes(self.engine)
+        self.assertFalse(unique())
+        self.assertEqual(len(caught), 1)
+
+
+class TestExport(BaseTestCase):
+    # test streaming users' history to CSV and JSONL files
+    def setUp(self):
+        super().setUp()
+        seeding.seed(
+            self.engine,
+            users=3,
+            days=40,
+            readings_per_day=2,
+            random_seed=5,
+            report=None,
+        )
+        partitions.archive(self.engine)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        with self.engine.connect() as connection:
+            months = partitions.list_partitions(connection)
+        for month in months:
+            partitions.drop_partition(self.engine, month)
+        super().tearDown()
+
+    def count(self, model, user_id):
+        return self.session.query(model).filter(model.user_id == user_id).count()
+
+    def test_export_user_csv(self):
+        counts = export.export_user(
+            2, self.directory, "csv", engine=self.engine, chunk_size=7
+        )
+        # readings come back from the partitions and health_metrics
+        with self.engine.connect() as connection:
+            window = partitions.health_metrics_between(
+                connection, date(2000, 1, 1), date.today() + timedelta(days=1), [2]
+            )
+            readings = connection.execute(
+                select(func.count()).select_from(window)
+            ).scalar()
+        self.assertEqual(counts["health_metrics"], readings)
+        self.assertEqual(counts["sleep_log"], self.count(SleepLog, 2))
+        self.assertEqual(counts["food_log"], self.count(FoodLog, 2))
+        self.assertEqual(counts["workout_log"], self.count(WorkoutLog, 2))
+        with open(os.path.join(self.directory, "food_log.csv"), newline="") as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual(len(rows), counts["food_log"])
+        self.assertTrue(all(row["user_id"] == "2" for row in rows))
+        self.assertTrue(all(row["food_name"] and row["calories"] for row in rows))
+        with open(
+            os.path.join(self.directory, "health_metrics.csv"), newline=""
+        ) as file:
+            timestamps = [row["timestamp"] for row in csv.DictReader(file)]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_export_reads_one_snapshot(self):
+        # a sleep log written while the export runs is not in the files
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, "export.db")
+        engine = init_db.create_health_engine(f"sqlite:///{path}", "safe")
+        Base.metadata.create_all(engine)
+        sleep = {
+            "user_id": 1,
+            "duration": 8,
+            "quality": 4,
+            "start_time": time(23),
+            "end_time": time(7),
+            "date": date(2023, 11, 20),
+        }
+        with engine.begin() as connection:
+            connection.execute(
+                User.__table__.insert(),
+                [{"name": "A", "email": "a@example.com", "password": "pw"}],
+            )
+            connection.execute(SleepLog.__table__.insert(), [sleep])
+
+        written = []
+
+        def write_during_export(conn, cursor, statement, *args):
+            if "FROM sleep_log" in statement and not written:
+                written.append(statement)
+                with engine.begin() as other:
+                    other.execute(
+                        SleepLog.__table__.insert(),
+                        [dict(sleep, date=date(2023, 11, 21))],
+                    )
+
+        event.listen(engine, "before_cursor_execute", write_during_export)
+        counts = export.export_all(self.directory, engine=engine)
+        self.assertEqual(len(written), 1)
+        self.assertEqual(counts["sleep_log"], 1)
+        with engine.connect() as connection:
+            total = connection.execute(
+                select(func.count()).select_from(SleepLog)
+            ).scalar()
+        self.assertEqual(total, 2)
+        engine.dispose()
+        directory.cleanup()
+
+    def test_export_all_jsonl_gz(self):
+        counts = export.export_all(self.directory, "jsonl.gz", engine=self.engine)
+        self.assertEqual(counts["sleep_log"], self.session.query(SleepLog).count())
+        path = os.path.join(self.directory, "workout_log.jsonl.gz")
+        with gzip.open(path, "rt") as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(len(records), self.session.query(WorkoutLog).count())
+        self.assertEqual(
+            [record["user_id"] for record in records],
+            sorted(record["user_id"] for record in records),
+        )
+        self.assertTrue(all(record["workout"] for record in records))
+        date.fromisoformat(records[0]["date"])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            export.export_all(self.directory, "xml", engine=self.engine)
+
+
+class TestAnalytics(BaseTestCase):
+    # test loading readings into NumPy arrays and the vectorized analytics
+    def setUp(self):
+        super().setUp()
+        self.session.add_all(
+            [
+                User(name="First", email="first@example.com", password="pw"),
+                User(name="Second", email="second@example.com", password="pw"),
+            ]
+        )
+        self.start = datetime(2023, 9, 1)
+        # user 1: one reading an hour for 30 days, heart rate rising 1 bpm a day
+        for hour in range(30 * 24):
+            self.session.add(
+                HealthMetric(
+                    user_id=1,
+                    heart_rate=60 + hour // 24 + hour % 3,
+                    steps_taken=None if hour % 5 == 0 else 100 * hour,
+                    timestamp=self.start + timedelta(hours=hour),
+                )
+            )
+        self.session.add(HealthMetric(user_id=2, heart_rate=70, timestamp=self.start))
+        self.session.add(
+            SleepLog(
+                user_id=1,
+                duration=7.5,
+                quality=4,
+                start_time=time(23, 30),
+                end_time=time(7),
+                date=self.start.date(),
+            )
+        )
+        self.session.commit()
+        self.end = self.start + timedelta(days=30)
+
+    def tearDown(self):
+        with self.engine.connect() as connection:
+            months = partitions.list_partitions(connection)
+        for month in months:
+            partitions.drop_partition(self.engine, month)
+        super().tearDown()
+
+    def load(self, user_ids=None):
+        with self.engine.connect() as connection:
+            return analytics.load_health_metrics(
+                connection, self.start, self.end, user_ids
+            )
+
+    def test_load_health_metrics(self):
+        health = self.load()
+        self.assertEqual(len(health.user_id), 30 * 24 + 1)
+        self.assertEqual(health.timestamp.dtype, np.int64)
+        # naive timestamps are taken as UTC
+        epoch = (self.start - datetime(1970, 1, 1)).total_seconds()
+        self.assertEqual(health.timestamp[0], epoch)
+        self.assertTrue(np.isnan(health.steps_taken[0]))
+        self.assertTrue(np.all(np.isnan(health.stand_hours)))
+        self.assertEqual(list(np.unique(health.user_id)), [1, 2])
+        self.assertEqual(len(self.load([2]).user_id), 1)
+        # readings moved into monthly partitions load the same, in the same order
+        partitions.archive(self.engine, before=date(2023, 10, 1))
+        archived = self.load()
+        for before, after in zip(health, archived):
+            np.testing.assert_array_equal(before, after)
+
+    def test_load_sleep(self):
+        with self.engine.connect() as connection:
+            sleep = analytics.load_sleep(connection, self.start, self.end)
+        self.assertEqual(list(sleep.user_id), [1])
+        self.assertEqual(sleep.date[0] % analytics.SECONDS_PER_DAY, 0)
+        self.assertEqual(sleep.start_time[0], 23 * 3600 + 30 * 60)
+        self.assertEqual(sleep.end_time[0], 7 * 3600)
+        self.assertEqual(sleep.duration[0], 7.5)
+
+    def test_statistics(self):
+        health = self.load([1])
+        steps = health.steps_taken[~np.isnan(health.steps_taken)]
+        stats = analytics.summary(health.steps_taken)
+        self.assertEqual(stats.count, len(steps))
+        self.assertAlmostEqual(stats.median, float(np.median(steps)))
+        self.assertAlmostEqual(stats.std, float(steps.std()))
+        np.testing.assert_allclose(
+            analytics.percentiles(health.steps_taken, (5, 95)),
+            np.percentile(steps, (5, 95)),
+        )
+        scores = analytics.zscores(health.heart_rate)
+        self.assertAlmostEqual(float(scores.mean()), 0.0)
+        self.assertAlmostEqual(float(scores.std()), 1.0)
+        self.assertTrue(np.all(analytics.zscores(np.array([3.0, 3.0])) == 0))
+        self.assertTrue(np.isnan(analytics.summary(np.array([np.nan])).mean))
+
+    def test_trends(self):
+        health = self.load()
+        # 100 steps an hour is 2400 steps a day
+        slopes = analytics.by_user(
+            health, analytics.trend_slope, "timestamp", "steps_taken"
+        )
+        self.assertAlmostEqual(slopes[1], 2400.0)
+        self.assertTrue(np.isnan(slopes[2]))
+        first = health.user_id == 1
+        days, resting = analytics.resting_heart_rate(
+            health.timestamp[first], health.heart_rate[first]
+        )
+        self.assertEqual(len(days), 30)
+        self.assertEqual(resting[0], 60)
+        drift = analytics.by_user(
+            health, analytics.resting_hr_drift, "timestamp", "heart_rate"
+        )
+        self.assertAlmostEqual(drift[1], 1.0)
+
+    def test_rolling(self):
+        health = self.load([1])
+        window = 6 * 3600
+        stats = analytics.rolling(health.timestamp, health.steps_taken, window)
+        for i in (0, 5, 100, len(health.timestamp) - 1):
+            inside = (health.timestamp > health.timestamp[i] - window) & (
+                health.timestamp <= health.timestamp[i]
+            )
+            values = health.steps_taken[inside]
+            values = values[~np.isnan(values)]
+            self.assertEqual(stats.count[i], len(values))
+            if len(values):
+                self.assertAlmostEqual(stats.mean[i], values.mean())
+                self.assertAlmostEqual(stats.std[i], values.std(), places=6)
+        self.assertTrue(np.isnan(stats.mean[0]))
+
+
+class TestTrend(BaseTestCase):
+    # test the daily trend lines with moving averages from window functions
+    def setUp(self):
+        super().setUp()
+        self.session.add(User(name="Trend", email="trend@example.com", password="pw"))
+        self.session.add(User(name="Other", email="other@example.com", password="pw"))
+        self.session.commit()
+        self.end = date(2023, 11, 30)
+        # a summary row every other day for 60 days, and other user's rows every day
+        self.steps = {}
+        for i in range(60):
+            day = self.end - timedelta(days=i)
+            if i % 2 == 0:
+                self.steps[day] = 100.0 * i
+                self.session.add(
+                    DailyUserSummary(
+                        user_id=1,
+                        date=day,
+                        avg_steps_taken=100.0 * i,
+                        sleep_duration=7.0,
+                        calories_in=2000,
+                    )
+                )
+            self.session.add(DailyUserSummary(user_id=2, date=day, avg_steps_taken=1.0))
+        self.session.commit()
+
+    def moving_avg(self, day, days):
+        # the average of the values in the `days` calendar days up to `day`
+        values = [
+            self.steps[day - timedelta(days=i)]
+            for i in range(days)
+            if day - timedelta(days=i) in self.steps
+        ]
+        return round(sum(values) / len(values), 2) if values else None
+
+    def test_trend(self):
+        rows = reports.trend(self.session, 1, 14, self.end)
+        self.assertEqual(len(rows), 14)
+        self.assertEqual(rows[0].date, self.end - timedelta(days=13))
+        self.assertEqual(rows[-1].date, self.end)
+        for row in rows:
+            self.assertEqual(row.steps, self.steps.get(row.date))
+            self.assertEqual(row.steps_7d, self.moving_avg(row.date, 7))
+            self.assertEqual(row.steps_30d, self.moving_avg(row.date, 30))
+            self.assertEqual(row.sleep_duration_7d, 7.0)
+            self.assertEqual(row.calories_30d, 2000)
+            self.assertIsNone(row.resting_heart_rate_7d)
+
+    def test_no_data(self):
+        rows = reports.trend(self.session, 1, 7, date(2020, 1, 7))
+        self.assertEqual(
+            [row.date for row in rows],
+            [date(2020, 1, day) for day in range(1, 8)],
+        )
+        self.assertTrue(all(row.steps_30d is None for row in rows))
+
+    def test_trend_is_cached(self):
+        cache = ReportCache()
+        trend = report_cache.trend(self.session, 1, window=30, cache=cache)
+        self.assertEqual(len(trend), 30)
+        report_cache.trend(self.session, 1, window=30, cache=cache)
+        self.assertEqual(cache.stats().hits, 1)
+
+
+class TestQuantiles(BaseTestCase):
+    # test the t-digest sketches and the per day quantile sketches
+    def test_digest(self):
+        rng = np.random.default_rng(1)
+        values = rng.normal(75, 12, 20000).round()
+        digest = quantiles.TDigest.of(values)
+        self.assertEqual(digest.count, len(values))
+        self.assertLessEqual(len(digest), quantiles.COMPRESSION // 2 + 2)
+        q = np.array([0.01, 0.05, 0.5, 0.95, 0.99])
+        # rank error: the share of values below the estimate is close to q
+        ranks = np.searchsorted(np.sort(values), digest.quantile(q)) / len(values)
+        np.testing.assert_allclose(ranks, q, atol=0.02)
+        self.assertEqual(digest.quantile(0), values.min())
+        self.assertEqual(digest.quantile(1), values.max())
+        self.assertTrue(np.isnan(quantiles.TDigest.of([np.nan]).quantile(0.5)))
+
+    def test_merge_and_bytes(self):
+        rng = np.random.default_rng(2)
+        parts = [rng.integers(50, 120, 500) for _ in range(30)]
+        merged = quantiles.TDigest.merge(
+            quantiles.TDigest.from_bytes(quantiles.TDigest.of(part).to_bytes())
+            for part in parts
+        )
+        values = np.concatenate(parts)
+        self.assertEqual(merged.count, len(values))
+        self.assertLessEqual(len(merged), quantiles.COMPRESSION // 2 + 2)
+        self.assertAlmostEqual(merged.quantile(0.5), np.median(values), delta=1)
+        self.assertAlmostEqual(
+            merged.quantile(0.95), np.percentile(values, 95), delta=1
+        )
+        with self.assertRaises(ValueError):
+            quantiles.TDigest.from_bytes(b"\x09" + bytes(16))
+
+    def test_sketches_follow_the_readings(self):
+        seeding.seed(
+            self.engine,
+            users=3,
+            days=20,
+            readings_per_day=24,
+            random_seed=3,
+            report=None,
+        )
+        end = date.today()
+        start = end - timedelta(days=19)
+        with self.engine.connect() as connection:
+            health = analytics.load_health_metrics(
+                connection, start, end + timedelta(days=1)
+            )
+            everything = analytics.load_health_metrics(
+                connection, date(2000, 1, 1), end + timedelta(days=1)
+            )
+            estimate = quantiles.quantiles(
+                connection, "systolic_bp", start, end, q=[0.5, 0.95]
+            )
+            per_user = quantiles.user_quantiles(
+                connection, "heart_rate", start, end, [1, 2], q=[0.5]
+            )
+        # one row per user and day with readings
+        rows = self.session.query(DailyMetricSketch).count()
+        days = everything.timestamp // analytics.SECONDS_PER_DAY
+        self.assertEqual(rows, len(set(zip(everything.user_id, days))))
+        np.testing.assert_allclose(
+            estimate, np.percentile(health.systolic_bp, [50, 95]), atol=1.5
+        )
+        self.assertEqual(sorted(per_user), [1, 2])
+        mine = health.heart_rate[health.user_id == 2]
+        self.assertAlmostEqual(per_user[2][0], np.median(mine), delta=1.5)
+
+        # an ORM write recomputes its day's sketch
+        self.session.add(
+            HealthMetric(user_id=1, heart_rate=250, timestamp=datetime(2020, 1, 1, 8))
+        )
+        self.session.commit()
+        with self.engine.connect() as connection:
+            digest = quantiles.sketch(
+                connection, "heart_rate", date(2020, 1, 1), date(2020, 1, 1)
+            )
+        self.assertEqual((digest.count, digest.max), (1, 250))
+
+        # rolled up days keep their sketches
+        retention.apply(self.engine, raw_days=10, hourly_days=10)
+        self.assertEqual(self.session.query(DailyMetricSketch).count(), rows + 1)
+        with self.engine.connect() as connection:
+            old = quantiles.sketch(connection, "heart_rate", start, end, [1])
+        self.assertEqual(old.count, len(health.heart_rate[health.user_id == 1]))
+
+    def test_rebuild_chunks_late_readings_and_empty_days(self):
+        seeding.seed(
+            self.engine,
+            users=3,
+            days=20,
+            readings_per_day=6,
+            random_seed=4,
+            report=None,
+        )
+        day = date.today() - timedelta(days=15)
+
+        def stored():
+            return {
+                (row.user_id, row.date): row.heart_rate
+                for row in self.session.query(DailyMetricSketch)
+            }
+
+        def day_count():
+            with self.engine.connect() as connection:
+                return quantiles.sketch(connection, "heart_rate", day, day, [1]).count
+
+        # chunks of one user write the same sketches
+        before = stored()
+        with self.engine.begin() as connection:
+            quantiles.rebuild(connection, day - timedelta(days=5), day, chunk_size=1)
+        self.assertEqual(stored(), before)
+
+        # late readings of a rolled up day are added to its sketch, once each
+        count = day_count()
+        retention.apply(self.engine, raw_days=10, hourly_days=10)
+        self.assertEqual(day_count(), count)
+        for minute in range(3):
+            self.session.add(
+                HealthMetric(
+                    user_id=1,
+                    heart_rate=200 + minute,
+                    timestamp=datetime.combine(day, time(23, minute)),
+                )
+            )
+            self.session.commit()
+            self.assertEqual(day_count(), count + minute + 1)
+            if minute == 1:
+                # the late readings so far are rolled up too
+                retention.apply(self.engine, raw_days=10, hourly_days=10)
+                self.assertEqual(day_count(), count + 2)
+        with self.engine.connect() as connection:
+            self.assertEqual(
+                quantiles.sketch(connection, "heart_rate", day, day, [1]).max, 202
+            )
+
+        # a day left without readings loses its sketch
+        reading = HealthMetric(user_id=2, heart_rate=70, timestamp=datetime(2020, 1, 1))
+        self.session.add(reading)
+        self.session.commit()
+        self.assertIn((2, date(2020, 1, 1)), stored())
+        self.session.delete(reading)
+        self.session.commit()
+        self.assertNotIn((2, date(2020, 1, 1)), stored())
+
+
+class TestGoals(BaseTestCase):
+    # test the set based goal progress evaluation
+    def setUp(self):
+        super().setUp()
+        self.user = User(name="Goals", email="goals@example.com", password="pw")
+        self.food = Food(name="Bread", calories=600, category=2)
+        self.user_workout = UserWorkout(
+            exercise_type=1, description="Run", duration=1.0, difficulty_level=1
+        )
+        self.session.add_all([self.user, self.food, self.user_workout])
+        self.session.commit()
+        self.start = date(2023, 11, 1)
+        self.day = date(2023, 11, 10)
+        # 10 days of 6 then 8 hours of sleep, 3 breads a day and a workout every
+        # other day
+        for i in range(10):
+            day = self.start + timedelta(days=i)
+            self.session.add(
+                SleepLog(
+                    user_id=self.user.id,
+                    duration=6.0 if i < 5 else 8.0,
+                    quality=3,
+                    start_time=time(23),
+                    end_time=time(6),
+                    date=day,
+                )
+            )
+            self.session.add_all(
+                [
+                    FoodLog(user_id=self.user.id, food_id=self.food.id, date=day)
+                    for _ in range(3)
+                ]
+            )
+            if i % 2 == 0:
+                self.session.add(
+                    WorkoutLog(
+                        user_id=self.user.id,
+                        user_workout_id=self.user_workout.id,
+                        calories_burned=300,
+                        heart_rate=150,
+                        date=day,
+                    )
+                )
+        self.session.commit()
+
+    def add_goal(self, goal_type, target=None, start=None, end=None):
+        goal = Goal(
+            user_id=self.user.id,
+            description="Goal",
+            start_date=start or self.start,
+            end_date=end or date(2023, 11, 30),
+            goal_type=goal_type,
+            target=target,
+        )
+        self.session.add(goal)
+        self.session.commit()
+        return goal
+
+    def progress(self, goal):
+        self.session.expire_all()
+        return self.session.get(GoalProgress, goal.id)
+
+    def test_progress_by_goal_type(self):
+        sleep = self.add_goal(goals.SLEEP)
+        sleep_high = self.add_goal(goals.SLEEP, target=7.5)
+        nutrition = self.add_goal(goals.NUTRITION)
+        nutrition_low = self.add_goal(goals.NUTRITION, target=1500)
+        workout = self.add_goal(goals.WORKOUT)
+        workout_high = self.add_goal(goals.WORKOUT, target=4)
+        stats = goals.evaluate(self.engine, self.day)
+        self.assertEqual((stats.goals, stats.met), (6, 3))
+
+        progress = self.progress(sleep)
+        self.assertEqual((progress.as_of, progress.days), (self.day, 10))
+        self.assertAlmostEqual(progress.value, 7.0)
+        self.assertEqual(progress.target, goals.DEFAULT_TARGETS[goals.SLEEP])
+        self.assertTrue(progress.met)
+        self.assertFalse(self.progress(sleep_high).met)
+
+        self.assertAlmostEqual(self.progress(nutrition).value, 1800)
+        self.assertTrue(self.progress(nutrition).met)
+        self.assertFalse(self.progress(nutrition_low).met)
+
+        # 5 workouts in 10 days
+        self.assertAlmostEqual(self.progress(workout).value, 3.5)
+        self.assertTrue(self.progress(workout).met)
+        self.assertFalse(self.progress(workout_high).met)
+
+    def test_goal_without_type(self):
+        # nothing to measure: no progress row, and the other goals are still written
+        untyped = self.add_goal(None)
+        sleep = self.add_goal(goals.SLEEP)
+        stats = goals.evaluate(self.engine, self.day)
+        self.assertEqual(stats.goals, 1)
+        self.assertIsNone(self.progress(untyped))
+        self.assertIsNotNone(self.progress(sleep))
+
+    def test_nights_without_duration_are_left_out(self):
+        # a sleep record without a duration does not count as a night of 0 hours
+        self.session.add(
+            SleepLog(
+                user_id=self.user.id,
+                quality=3,
+                start_time=time(23),
+                end_time=time(6),
+                date=self.day + timedelta(days=1),
+            )
+        )
+        self.session.commit()
+        sleep = self.add_goal(goals.SLEEP)
+        goals.evaluate(self.engine, self.day + timedelta(days=1))
+        self.assertAlmostEqual(self.progress(sleep).value, 7.0)
+
+    def test_counts_only_days_up_to_the_evaluation(self):
+        goal = self.add_goal(goals.SLEEP, start=date(2023, 11, 3))
+        goals.evaluate(self.engine, date(2023, 11, 5))
+        progress = self.progress(goal)
+        self.assertEqual((progress.days, progress.value), (3, 6.0))
+        self.assertFalse(progress.met)
+        # evaluating again moves the same row forward
+        goals.evaluate(self.engine, self.day)
+        self.assertEqual(self.progress(goal).days, 8)
+        self.assertAlmostEqual(self.progress(goal).value, 58 / 8)
+        self.assertEqual(self.session.query(GoalProgress).count(), 1)
+
+    def test_nothing_logged(self):
+        goal = self.add_goal(goals.NUTRITION, start=date(2023, 11, 20))
+        goals.evaluate(self.engine, date(2023, 11, 21))
+        progress = self.progress(goal)
+        self.assertIsNone(progress.value)
+        self.assertFalse(progress.met)
+
+    def test_only_goals_in_progress(self):
+        ended = self.add_goal(goals.SLEEP, end=date(2023, 11, 5))
+        future = self.add_goal(
+            goals.SLEEP, start=date(2023, 12, 1), end=date(2023, 12, 9)
+        )
+        current = self.add_goal(goals.SLEEP)
+        stats = goals.evaluate(self.engine, self.day)
+        self.assertEqual(stats.goals, 1)
+        self.assertIsNone(self.progress(ended))
+        self.assertIsNone(self.progress(future))
+        self.assertIsNotNone(self.progress(current))
+
+    def test_batches(self):
+        for _ in range(7):
+            self.add_goal(goals.WORKOUT)
+        stats = goals.evaluate(self.engine, self.day, batch_size=3)
+        self.assertEqual((stats.goals, stats.batches), (7, 3))
+        self.assertEqual(goals.evaluate(self.engine, self.day).goals, 7)
+        self.assertEqual(self.session.query(GoalProgress).count(), 7)
+
+    def test_evaluate_goal_and_user_progress(self):
+        goal = self.add_goal(goals.WORKOUT)
+        self.add_goal(goals.SLEEP)
+        with self.engine.begin() as connection:
+            self.assertEqual(goals.evaluate_goal(connection, goal.id, self.day), (1, 1))
+        rows = self.session.execute(goals.user_progress_query(self.user.id)).all()
+        self.assertEqual([(row[0].id, row[1].days) for row in rows], [(goal.id, 10)])
+
+    def test_deleting_a_goal_deletes_its_progress(self):
+        goal = self.add_goal(goals.SLEEP)
+        goals.evaluate(self.engine, self.day)
+        self.session.delete(goal)
+        self.session.commit()
+        self.assertEqual(self.session.query(GoalProgress).count(), 0)
+
+    def test_seeding_evaluates_goals(self):
+        stats = seeding.seed(self.engine, users=3, days=5, report=None)
+        rows = {item.table: item.rows for item in stats}
+        in_progress = (
+            self.session.query(Goal)
+            .filter(Goal.start_date <= date.today(), Goal.end_date >= date.today())
+            .count()
+        )
+        self.assertEqual(rows["goal_progress"], in_progress)
+        self.assertTrue(all(goal.target > 0 for goal in self.session.query(Goal)))
+
+
+class TestGoalIntervals(BaseTestCase):
+    # test the interval index queries for goals active on a day or in a range
+    def setUp(self):
+        super().setUp()
+        self.session.add_all(
+            [
+                User(name=f"User {i}", email=f"user{i}@example.com", password="pw")
+                for i in range(3)
+            ]
+        )
+        self.session.commit()
+        # goals of every length class (and longer), spread over two years
+        rng = random.Random(4)
+        first = date(2022, 1, 1)
+        for i in range(300):
+            start = first + timedelta(days=rng.randrange(730))
+            days = rng.choice([1, 8, 9, 20, 60, 200, 700, 1024, 1025, 3000])
+            self.session.add(
+                Goal(
+                    user_id=i % 3 + 1,
+                    description="Goal",
+                    start_date=start,
+                    end_date=start + timedelta(days=days),
+                    goal_type=i % 3 + 1,
+                )
+            )
+        self.session.commit()
+        self.goals = self.session.query(Goal).all()
+
+    def expected(self, start, end):
+        return sorted(
+            goal.id
+            for goal in self.goals
+            if goal.start_date <= end and goal.end_date >= start
+        )
+
+    def test_span_class(self):
+        for goal in self.goals:
+            days = (goal.end_date - goal.start_date).days
+            spans = [span for span in init_db.GOAL_SPANS if days <= span]
+            expected = init_db.GOAL_SPANS.index(spans[0]) if spans else 8  # no bound
+            self.assertEqual(goal.span_class, expected)
+        # moving the dates moves the goal to its new class
+        goal = self.goals[0]
+        goal.end_date = goal.start_date + timedelta(days=3)
+        self.session.commit()
+        self.session.refresh(goal)
+        self.assertEqual(goal.span_class, 0)
+
+    def test_active_on_day(self):
+        for day in [date(2021, 12, 31), date(2022, 1, 1), date(2023, 3, 15)]:
+            goals_on_day = self.session.scalars(goals.active_goals_query(day)).all()
+            self.assertEqual(
+                [goal.id for goal in goals_on_day], self.expected(day, day)
+            )
+        # the first and last day of a goal count
+        goal = self.goals[0]
+        for day in (goal.start_date, goal.end_date):
+            active = self.session.scalars(goals.active_goals_query(day)).all()
+            self.assertIn(goal, active)
+
+    def test_overlapping_range(self):
+        start, end = date(2023, 6, 1), date(2023, 6, 30)
+        ids = self.session.scalars(
+            select(Goal.id).where(goals.overlapping(start, end)).order_by(Goal.id)
+        ).all()
+        self.assertEqual(ids, self.expected(start, end))
+        sleep = self.session.scalars(
+            goals.active_goals_query(start, end, goal_type=1)
+        ).all()
+        self.assertTrue(sleep)
+        self.assertTrue(all(goal.goal_type == 1 for goal in sleep))
+
+    def test_counts(self):
+        day = date(2023, 1, 1)
+        counts = dict(self.session.execute(goals.active_goal_count_query(day)).all())
+        self.assertEqual(sum(counts.values()), len(self.expected(day, day)))
+        for goal_type, count in counts.items():
+            self.assertEqual(
+                count,
+                len(
+                    [
+                        goal
+                        for goal in self.goals
+                        if goal.goal_type == goal_type
+                        and goal.id in self.expected(day, day)
+                    ]
+                ),
+            )
+
+    def test_queries_use_the_interval_index(self):
+        with self.engine.connect() as connection:
+            plan = plan_audit.explain(
+                connection, goals.active_goals_query(date(2023, 1, 1))
+            )
+        self.assertEqual(plan_audit.full_scans(plan), [])
+        self.assertTrue(any("idx_goals_span_class" in detail for detail in plan))
+
+
 if __name__ == "__main__":
     unittest.main()
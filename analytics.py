@@ -0,0 +1,327 @@
+import argparse
+import time
+import warnings
+from collections import namedtuple
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import Integer, String, cast, func, select, type_coerce
+from sqlalchemy.orm import Session
+import partitions
+from helpers import as_datetime, for_users, user_id_range
+from init_db import engine as default_engine, HealthMetric, SleepLog
+
+"""
+Columnar loading and vectorized analytics of the health metrics and sleep logs.
+
+The statistics in query_data.py are SQL averages. Anything richer (medians,
+percentiles, standard deviation, trends) would need a query per statistic or a loop
+over ORM objects, and building a HealthMetric object per reading costs far more than
+the arithmetic. Here a user's (or a cohort's) readings are read with one Core select
+per table straight into NumPy arrays, a chunk of cursor rows at a time:
+
+- the result is a namedtuple of arrays (HealthColumns, SleepColumns), one entry per
+  row, sorted by user and time
+- timestamps are int64 seconds since 1970-01-01: the stored ISO strings are parsed
+  by NumPy a chunk at a time, no datetime object is built per row; the timestamps are
+  naive local times taken as UTC, so timestamp // SECONDS_PER_DAY is the calendar day
+- metrics are float64 with NaN for a missing value (NULL)
+
+The analytics functions work on the arrays of one user (by_user() runs one for every
+user of a cohort): percentiles, summary (count, mean, std, min, median, max),
+zscores, trend_slope (least squares, units per day), rolling (trailing time window
+count, mean and std), daily (one value per calendar day) and resting_hr_drift (the
+trend of the daily resting heart rate, the low percentile of the day's readings).
+
+Readings come from health_metrics and its monthly partitions (partitions.py); the
+hourly and daily aggregates of the retention job (retention.py) are not readings and
+are not loaded.
+
+python3 analytics.py --user 1 --days 90
+python3 analytics.py --users 1-25 --days 30 --compare   (against loading ORM objects)
+"""
+
+SECONDS_PER_DAY = 86400
+METRICS = ("heart_rate", "steps_taken", "stand_hours", "systolic_bp", "diastolic_bp")
+
+HealthColumns = namedtuple("HealthColumns", ("user_id", "timestamp") + METRICS)
+SleepColumns = namedtuple(
+    "SleepColumns",
+    ["user_id", "date", "duration", "quality", "start_time", "end_time"],
+)
+MetricSummary = namedtuple(
+    "MetricSummary", ["count", "mean", "std", "min", "median", "max"]
+)
+RollingStats = namedtuple("RollingStats", ["count", "mean", "std"])
+
+
+### LOADING ###
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _raw(column):
+    # the stored ISO string of a date or time column, not a datetime object per row
+    return type_coerce(column, String)
+
+
+def _seconds_of_day(column):
+    # seconds since midnight of a Time column, computed by SQLite
+    return cast(func.strftime("%s", column), Integer) - cast(
+        func.strftime("%s", "00:00:00"), Integer
+    )
+
+
+def _epoch_seconds(stamps):
+    # datetime64 array -> int64 seconds since 1970-01-01
+    return stamps.astype("datetime64[s]").astype(np.int64)
+
+
+def _columns(connection, queries, dtypes, chunk_size):
+    """
+    Runs the queries (same columns, in order) and returns one array per column with
+    the given dtypes, built a chunk of cursor rows at a time. Float columns get NaN for
+    None, datetime64 columns are parsed from the stored ISO strings by NumPy.
+    """
+    streaming = connection.execution_options(yield_per=chunk_size)
+    chunks = [[] for _ in dtypes]
+    for query in queries:
+        for rows in streaming.execute(query).partitions():
+            for chunk, dtype, values in zip(chunks, dtypes, zip(*rows)):
+                chunk.append(np.array(values, dtype=dtype))
+    return [
+        np.concatenate(chunk) if chunk else np.empty(0, dtype=dtype)
+        for chunk, dtype in zip(chunks, dtypes)
+    ]
+
+
+def load_health_metrics(connection, start, end, user_ids=None, chunk_size=10000):
+    """
+    The readings with start <= timestamp < end of every user (or the given user ids)
+    as HealthColumns, sorted by user and timestamp.
+    """
+    start, end = as_datetime(start), as_datetime(end)
+    queries = []
+    # one query per table in index order, so SQLite never sorts
+    for table in partitions.tables_between(connection, start, end):
+        query = select(
+            table.c.user_id,
+            _raw(table.c.timestamp),
+            *[table.c[metric] for metric in METRICS],
+        ).where(table.c.timestamp >= start, table.c.timestamp < end)
+        queries.append(
+            for_users(query, table.c.user_id, user_ids).order_by(
+                table.c.user_id, table.c.timestamp
+            )
+        )
+    dtypes = [np.int64, "datetime64[us]"] + [np.float64] * len(METRICS)
+    columns = _columns(connection, queries, dtypes, chunk_size)
+    columns[1] = _epoch_seconds(columns[1])
+    health = HealthColumns(*columns)
+    if len(queries) > 1:
+        # the tables are read one after the other, merge them by user and time
+        order = np.lexsort((health.timestamp, health.user_id))
+        health = HealthColumns(*[column[order] for column in health])
+    return health
+
+
+def load_sleep(connection, start, end, user_ids=None, chunk_size=10000):
+    """
+    The sleep logs with start <= date < end as SleepColumns, sorted by user and date.
+    date is the epoch seconds of the night's date, start_time and end_time are
+    seconds since midnight.
+    """
+    start, end = _as_date(start), _as_date(end)
+    query = select(
+        SleepLog.user_id,
+        _raw(SleepLog.date),
+        SleepLog.duration,
+        SleepLog.quality,
+        _seconds_of_day(SleepLog.start_time),
+        _seconds_of_day(SleepLog.end_time),
+    ).where(SleepLog.date >= start, SleepLog.date < end)
+    query = for_users(query, SleepLog.user_id, user_ids).order_by(
+        SleepLog.user_id, SleepLog.date
+    )
+    dtypes = [np.int64, "datetime64[D]", np.float64, np.float64, np.int64, np.int64]
+    columns = _columns(connection, [query], dtypes, chunk_size)
+    columns[1] = _epoch_seconds(columns[1])
+    return SleepColumns(*columns)
+
+
+### GROUPING ###
+def _runs(keys):
+    # [start, stop) offsets of the runs of equal values in a sorted array
+    if not len(keys):
+        return []
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return list(zip(starts, np.r_[starts[1:], len(keys)]))
+
+
+def by_user(columns, function, *fields, **options):
+    """
+    Runs function on the arrays (fields) of every user in a cohort's columns:
+    by_user(health, trend_slope, "timestamp", "steps_taken") -> {user_id: slope}
+    """
+    results = {}
+    for start, stop in _runs(columns.user_id):
+        arrays = [getattr(columns, field)[start:stop] for field in fields]
+        results[int(columns.user_id[start])] = function(*arrays, **options)
+    return results
+
+
+### ANALYTICS ###
+# every function below ignores NaN values and returns NaN when nothing is left
+def percentiles(values, q=(5, 25, 50, 75, 95)):
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return np.full(len(q), np.nan)
+    return np.percentile(values, q)
+
+
+def summary(values):
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return MetricSummary(0, np.nan, np.nan, np.nan, np.nan, np.nan)
+    return MetricSummary(
+        len(values),
+        float(values.mean()),
+        float(values.std()),
+        float(values.min()),
+        float(np.median(values)),
+        float(values.max()),
+    )
+
+
+def zscores(values):
+    # how many standard deviations each value is from the mean (0 when all are equal)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all NaN
+        mean, std = np.nanmean(values), np.nanstd(values)
+    if not std:
+        return np.where(np.isnan(values), np.nan, 0.0)
+    return (values - mean) / std
+
+
+def trend_slope(times, values, per=SECONDS_PER_DAY):
+    """
+    Least squares slope of values over times (epoch seconds), in units per `per`
+    seconds (by default per day). NaN with fewer than two distinct times.
+    """
+    known = ~np.isnan(values)
+    x = times[known].astype(np.float64) / per
+    y = values[known]
+    if len(x) < 2:
+        return np.nan
+    x = x - x.mean()  # centred, so the sums stay small and exact
+    spread = np.dot(x, x)
+    if not spread:
+        return np.nan
+    return float(np.dot(x, y - y.mean()) / spread)
+
+
+def rolling(times, values, window):
+    """
+    Count, mean and std of the values in the trailing window (window seconds, the
+    readings with time - window < t <= time) ending at every reading. times must be
+    sorted. Computed from cumulative sums, no loop over the readings.
+    """
+    known = ~np.isnan(values)
+    # centred on the mean, so the sum of squares does not lose precision
+    shift = values[known].mean() if known.any() else 0.0
+    centred = np.where(known, values - shift, 0.0)
+    counts = np.r_[0, np.cumsum(known)]
+    sums = np.r_[0.0, np.cumsum(centred)]
+    squares = np.r_[0.0, np.cumsum(centred * centred)]
+    stop = np.searchsorted(times, times, side="right")
+    start = np.searchsorted(times, times - window, side="right")
+    count = counts[stop] - counts[start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (sums[stop] - sums[start]) / count
+        variance = (squares[stop] - squares[start]) / count - mean * mean
+    std = np.sqrt(np.maximum(variance, 0))
+    return RollingStats(count, mean + shift, std)
+
+
+def daily(times, values, statistic=np.median):
+    """
+    One value per calendar day: (days as epoch seconds of midnight, statistic of the
+    day's values). times must be sorted.
+    """
+    known = ~np.isnan(values)
+    times, values = times[known], values[known]
+    days = times // SECONDS_PER_DAY
+    runs = _runs(days)
+    return (
+        np.array([days[start] * SECONDS_PER_DAY for start, _ in runs], dtype=np.int64),
+        np.array([statistic(values[start:stop]) for start, stop in runs]),
+    )
+
+
+def resting_heart_rate(times, heart_rate, percentile=10):
+    # the resting heart rate of each day: a low percentile of the day's readings
+    return daily(times, heart_rate, lambda day: np.percentile(day, percentile))
+
+
+def resting_hr_drift(times, heart_rate, percentile=10):
+    """
+    Trend of the daily resting heart rate in beats per minute per day. A resting heart
+    rate that keeps rising (overtraining, illness, poor sleep) shows up as a positive
+    drift long before the averages move.
+    """
+    days, resting = resting_heart_rate(times, heart_rate, percentile)
+    return trend_slope(days, resting)
+
+
+### CLI ###
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Health metric analytics")
+    users = parser.add_mutually_exclusive_group()
+    users.add_argument("--user", type=int, default=1)
+    users.add_argument("--users", type=user_id_range, help="a range of ids, eg. 1-25")
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument(
+        "--compare", action="store_true", help="time loading ORM objects too"
+    )
+    args = parser.parse_args()
+    user_ids = args.users or [args.user]
+    end = datetime.now()
+    start = end - timedelta(days=args.days)
+
+    with default_engine.connect() as connection:
+        loading = time.perf_counter()
+        health = load_health_metrics(connection, start, end, user_ids)
+        seconds = time.perf_counter() - loading
+        print(f"Loaded {len(health.user_id):,} readings in {seconds * 1000:.1f} ms")
+        if args.compare:
+            loading = time.perf_counter()
+            # the ORM way (health_metrics only, no partitions): one object per row
+            query = for_users(
+                select(HealthMetric).where(
+                    HealthMetric.timestamp >= start, HealthMetric.timestamp < end
+                ),
+                HealthMetric.user_id,
+                user_ids,
+            )
+            readings = Session(bind=connection).scalars(query).all()
+            seconds = time.perf_counter() - loading
+            print(f"ORM objects: {len(readings):,} in {seconds * 1000:.1f} ms")
+
+    drift = by_user(health, resting_hr_drift, "timestamp", "heart_rate")
+    summaries = {metric: by_user(health, summary, metric) for metric in METRICS}
+    ranges = {
+        metric: by_user(health, percentiles, metric, q=(5, 95)) for metric in METRICS
+    }
+    trends = {
+        metric: by_user(health, trend_slope, "timestamp", metric) for metric in METRICS
+    }
+    for user_id in drift:
+        print(f"\nUser {user_id}, last {args.days} days:")
+        for metric in METRICS:
+            stats = summaries[metric][user_id]
+            p5, p95 = ranges[metric][user_id]
+            print(
+                f"{metric}: median {stats.median:.1f}, mean {stats.mean:.1f} "
+                f"(std {stats.std:.1f}), p5-p95 {p5:.1f}-{p95:.1f}, "
+                f"trend {trends[metric][user_id]:+.3f}/day"
+            )
+        print(f"resting heart rate drift: {drift[user_id]:+.3f} bpm/day")
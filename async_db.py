@@ -0,0 +1,161 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+import init_db
+from db_session import AppSession
+import reports
+
+"""
+Asyncio counterpart of db_session.py for the async device ingest and dashboard code.
+
+The engine uses the aiosqlite driver, so queries run without blocking the event loop
+(and without a thread hop in the calling code). Connections get the same foreign key
+setting and performance profile as the engine in init_db.py.
+
+The report functions run the same statements as query_data.py (built in reports.py),
+so the sync and async reports can never drift apart. Each one takes an AsyncSession:
+
+    async with async_session_scope() as session:
+        metrics = await avg_health_metrics(session, user_id)
+"""
+
+
+def create_async_health_engine(url, profile_name=None):
+    # async engine with foreign keys enabled and a performance profile applied
+    new_engine = create_async_engine(url)
+
+    # enable foreign key support for sqlite (the hook runs on the sync engine)
+    @event.listens_for(new_engine.sync_engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON;")
+        cursor.close()
+        init_db.apply_profile(dbapi_connection, profile_name or init_db.profile)
+
+    return new_engine
+
+
+DATABASE_URL = "sqlite+aiosqlite:///health_database.db"
+async_engine = create_async_health_engine(DATABASE_URL)
+# objects are not expired on commit, lazy reloads are not possible in async code
+# the sync sessions underneath are the app's session class, so async writes keep the
+# daily summary current like the sync ones
+AsyncSession = async_sessionmaker(
+    async_engine, expire_on_commit=False, sync_session_class=AppSession
+)
+# disposals of replaced engines still running on an event loop
+_disposals = set()
+
+
+def _dispose(old_engine):
+    # closing aiosqlite connections has to be awaited, on the running loop if there
+    # is one (set_profile() called from async code) or on a loop of its own
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(old_engine.dispose())
+        return
+    task = loop.create_task(old_engine.dispose())
+    _disposals.add(task)
+    task.add_done_callback(_disposals.discard)
+
+
+def reset_engine(profile_name):
+    """
+    Replaces the async engine with one for `profile_name` on a new pool and disposes
+    the old one. init_db.set_profile() calls it with the new profile, because the
+    pooled connections still run the old profile's PRAGMAs. AsyncSession is rebound,
+    so new sessions use the new engine.
+    """
+    global async_engine
+    old_engine = async_engine
+    async_engine = create_async_health_engine(DATABASE_URL, profile_name)
+    AsyncSession.configure(bind=async_engine)
+    _dispose(old_engine)
+
+
+init_db.profile_listeners.append(reset_engine)
+
+
+@asynccontextmanager
+async def async_session_scope(session_factory=AsyncSession):
+    # unit of work: commits if the block succeeds, rolls back if it raises
+    session = session_factory()
+    try:
+        yield session
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+def _since(days, today=None):
+    return (today or date.today()) - timedelta(days=days)
+
+
+### REPORTS ###
+# average health metrics (heart rate, steps, stand hours, BP) over the last `days` days
+async def avg_health_metrics(session, user_id, days=30, today=None):
+    # the statement is built on the sync connection, which looks up the partitions
+    statement = await session.run_sync(
+        lambda sync_session: reports.avg_health_metrics_query(
+            sync_session.connection(), user_id, _since(days, today), precision=2
+        )
+    )
+    result = await session.execute(statement)
+    return result.first()
+
+
+# average sleep duration and quality over the last `days` days
+async def avg_sleep(session, user_id, days=30, today=None):
+    result = await session.execute(
+        reports.avg_sleep_query(user_id, _since(days, today), precision=2)
+    )
+    return result.first()
+
+
+# (date, calories) for each day with food logged in the last `days` days
+async def calories_per_day(session, user_id, days=30, today=None):
+    result = await session.execute(
+        reports.daily_calories_query(user_id, _since(days, today))
+    )
+    return result.all()
+
+
+# average calories per day over the last `days` days
+async def avg_daily_calories(session, user_id, days=30, today=None):
+    result = await session.execute(
+        reports.avg_daily_calories_query(user_id, _since(days, today), precision=2)
+    )
+    return result.scalar()
+
+
+# number of workouts logged over the last `days` days
+async def workout_count(session, user_id, days=7, today=None):
+    result = await session.execute(
+        reports.workout_count_query(user_id, _since(days, today))
+    )
+    return result.scalar()
+
+
+# completed goal count and the goals in progress today
+async def goal_status(session, user_id, today=None):
+    today = today or date.today()
+    completed = await session.execute(
+        reports.completed_goal_count_query(user_id, today)
+    )
+    in_progress = await session.scalars(reports.in_progress_goals_query(user_id, today))
+    return completed.scalar(), in_progress.all()
+
+
+# the whole health report in one statement from the daily summary rollup,
+# see reports.monthly_report
+async def monthly_report(session, user_id, window=30, end=None):
+    end = end or date.today()
+    start = end - timedelta(days=window)
+    result = await session.execute(reports.monthly_summary_query(user_id, start, end))
+    return reports.MonthlyReport(user_id, start, end, **result.one()._asdict())
@@ -0,0 +1,76 @@
+import argparse
+import os
+import tempfile
+import time
+from init_db import Base, PROFILES, create_health_engine
+from plan_audit import report_queries
+from seeding import seed
+
+"""
+Compares the SQLite performance profiles in init_db.py on the two workloads the app
+has: seeding (bulk inserts, like device uploads) and reports (the per user report
+queries from query_data.py). Every profile gets its own fresh database file.
+
+python3 benchmark_profiles.py --users 500 --days 30
+"""
+
+
+def benchmark_profile(name, directory, users, days, readings_per_day, report_users):
+    engine = create_health_engine(f"sqlite:///{os.path.join(directory, name)}.db", name)
+    Base.metadata.create_all(engine)
+
+    start = time.perf_counter()
+    stats = seed(
+        engine,
+        users=users,
+        days=days,
+        readings_per_day=readings_per_day,
+        random_seed=0,
+        report=None,
+    )
+    seed_seconds = time.perf_counter() - start
+    rows = sum(item.rows for item in stats)
+
+    # run every report query for the first report_users users
+    start = time.perf_counter()
+    query_count = 0
+    with engine.connect() as connection:
+        for user_id in range(1, report_users + 1):
+            for _, statement, _ in report_queries(user_id):
+                connection.execute(statement).all()
+                query_count += 1
+    report_seconds = time.perf_counter() - start
+    engine.dispose()
+    return rows, seed_seconds, query_count, report_seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the database profiles")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--readings-per-day", type=int, default=4)
+    parser.add_argument(
+        "--report-users", type=int, default=100, help="users to run reports for"
+    )
+    args = parser.parse_args()
+
+    # build the cached Faker pools first so the first profile is not charged for them
+    warm_up = create_health_engine("sqlite://")
+    Base.metadata.create_all(warm_up)
+    seed(warm_up, users=1, days=1, random_seed=0, report=None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'profile':<10} {'seed rows/sec':>15} {'report queries/sec':>20}")
+        for name in PROFILES:
+            rows, seed_seconds, queries, report_seconds = benchmark_profile(
+                name,
+                directory,
+                args.users,
+                args.days,
+                args.readings_per_day,
+                min(args.report_users, args.users),
+            )
+            print(
+                f"{name:<10} {rows / seed_seconds:>15,.0f} "
+                f"{queries / report_seconds:>20,.0f}"
+            )
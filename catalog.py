@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import event, select
+from init_db import (
+    engine as default_engine,
+    Food,
+    WorkoutRecommendation,
+    CatalogVersion,
+)
+
+"""
+Process wide, read mostly cache of the reference tables: Food and
+WorkoutRecommendation. These tables are small and almost never change, but the
+ingest and report code looks them up all the time (a food's calories or name for
+every food log entry, the recommendation ids for every generated workout...).
+
+Each table is loaded once into a CatalogSnapshot of immutable namedtuple records with
+lookups by id, name and category (exercise type for recommendations). A snapshot is
+never changed after it is built, so it can be shared by every thread without locks.
+
+The catalog_version table (see init_db.py) counts the changes to each table through
+triggers, so any writer is noticed, including bulk inserts and other processes. A
+catalog checks the counter at most once every check_interval seconds and loads a new
+snapshot when it has moved. invalidate() forces the check on the next lookup: the
+seeders call it after writing the catalogs, and sessions registered with track() call
+it when they commit a change to them, so this process never reads a stale catalog.
+
+    foods = catalog_for(engine).foods()
+    foods.get(food_id).calories
+"""
+
+FoodRecord = namedtuple("FoodRecord", ["id", "name", "calories", "category"])
+RecommendationRecord = namedtuple(
+    "RecommendationRecord",
+    [
+        "id",
+        "workout_name",
+        "description",
+        "exercise_type",
+        "duration",
+        "difficulty_level",
+    ],
+)
+
+
+class CatalogSnapshot:
+    """
+    Immutable view of one reference table at one version.
+    `name_field` and `category_field` pick the record fields the lookups use.
+    """
+
+    def __init__(self, version, records, name_field, category_field):
+        self.version = version
+        self.records = tuple(records)
+        self.ids = tuple(record.id for record in self.records)
+        self._by_id = {record.id: record for record in self.records}
+        self._by_name = {}
+        self._by_category = {}
+        for record in self.records:
+            self._by_name.setdefault(getattr(record, name_field), []).append(record)
+            self._by_category.setdefault(getattr(record, category_field), []).append(
+                record
+            )
+        self._by_name = {key: tuple(value) for key, value in self._by_name.items()}
+        self._by_category = {
+            key: tuple(value) for key, value in self._by_category.items()
+        }
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __contains__(self, record_id):
+        return record_id in self._by_id
+
+    def get(self, record_id, default=None):
+        return self._by_id.get(record_id, default)
+
+    def by_name(self, name):
+        # every record with the name (food names are unique, workout names are not)
+        return self._by_name.get(name, ())
+
+    def in_category(self, category):
+        return self._by_category.get(category, ())
+
+
+# how each catalog table is loaded: (model, record type, name field, category field)
+_TABLES = {
+    "foods": (Food, FoodRecord, "name", "category"),
+    "recommendations": (
+        WorkoutRecommendation,
+        RecommendationRecord,
+        "workout_name",
+        "exercise_type",
+    ),
+}
+
+
+class Catalog:
+    def __init__(self, engine=None, check_interval=1.0, clock=None):
+        self.engine = engine or default_engine
+        self.check_interval = check_interval  # seconds between version checks
+        self.clock = clock or time.monotonic
+        self._snapshots = {}
+        self._checked = {}  # kind -> clock time of the last version check
+        self._lock = threading.Lock()
+        self.loads = 0  # snapshots built, to see how often the catalog reloads
+
+    def _version(self, connection, model):
+        version = connection.execute(
+            select(CatalogVersion.version).where(
+                CatalogVersion.name == model.__tablename__
+            )
+        ).scalar()
+        return version or 0
+
+    def _fresh(self, kind, now):
+        checked = self._checked.get(kind)
+        return checked is not None and now - checked < self.check_interval
+
+    def _snapshot(self, kind):
+        now = self.clock()
+        # the common case: a fresh snapshot, no lock and no query
+        if self._fresh(kind, now):
+            return self._snapshots[kind]
+        with self._lock:
+            snapshot = self._snapshots.get(kind)
+            if self._fresh(kind, now):
+                return snapshot
+            model, record, name_field, category_field = _TABLES[kind]
+            with self.engine.connect() as connection:
+                version = self._version(connection, model)
+                if snapshot is None or snapshot.version != version:
+                    # the version is read first: a change that lands in between
+                    # only makes the next check load the table again
+                    columns = [getattr(model, field) for field in record._fields]
+                    rows = connection.execute(select(*columns).order_by(model.id))
+                    snapshot = CatalogSnapshot(
+                        version,
+                        (record(*row) for row in rows),
+                        name_field,
+                        category_field,
+                    )
+                    self._snapshots[kind] = snapshot
+                    self.loads += 1
+            self._checked[kind] = now
+            return snapshot
+
+    def foods(self):
+        # the current CatalogSnapshot of FoodRecords
+        return self._snapshot("foods")
+
+    def recommendations(self):
+        # the current CatalogSnapshot of RecommendationRecords
+        return self._snapshot("recommendations")
+
+    def invalidate(self):
+        # check the versions again on the next lookup
+        with self._lock:
+            self._checked.clear()
+
+
+# one catalog per engine, so every caller in the process shares it
+# (engines live as long as the process, so the catalogs do too)
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def catalog_for(engine=None):
+    engine = engine or default_engine
+    with _catalogs_lock:
+        catalog = _catalogs.get(engine)
+        if catalog is None:
+            catalog = _catalogs[engine] = Catalog(engine)
+        return catalog
+
+
+def invalidate_all():
+    with _catalogs_lock:
+        catalogs = list(_catalogs.values())
+    for catalog in catalogs:
+        catalog.invalidate()
+
+
+def _flushed_catalog_change(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Food, WorkoutRecommendation)):
+            session.info["catalog_changed"] = True
+            return
+
+
+def _invalidate_committed(session):
+    if session.info.pop("catalog_changed", False):
+        invalidate_all()
+
+
+def track(session_class):
+    """
+    Reloads the catalogs after every session of session_class (and its subclasses)
+    commits a change to Food or WorkoutRecommendation.
+    db_session.py calls this for the app's session class.
+    """
+    if not event.contains(session_class, "after_flush", _flushed_catalog_change):
+        event.listen(session_class, "after_flush", _flushed_catalog_change)
+        event.listen(session_class, "after_commit", _invalidate_committed)
@@ -0,0 +1,311 @@
+import argparse
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import delete, event, func, insert, inspect, null, select, union_all
+from retention import health_buckets, reading_buckets
+import quantiles
+import partitions
+import helpers
+from helpers import for_users
+from init_db import (
+    engine as default_engine,
+    HealthMetric,
+    SleepLog,
+    Food,
+    FoodLog,
+    WorkoutLog,
+    DailyUserSummary,
+    HealthMetricHourly,
+    HealthMetricDaily,
+)
+
+"""
+Maintains the daily_user_summary rollup (DailyUserSummary in init_db.py): one row per
+user per day with that day's health metric averages, sleep, calories eaten and
+burned and the number of workouts. The reports in reports.py read these rows, so a
+30 day report reads 30 small rows instead of scanning and joining the raw logs.
+
+The rollup is kept current in two ways:
+- bulk loads (seeding.py, parallel_seeding.py) call rebuild() for the users and
+  days they wrote, which recomputes those rows with one INSERT ... SELECT
+- ORM writes are picked up by an after_flush listener (see track()). It collects the
+  (user, day) pairs touched by the flush, including the old day of a log that was
+  moved or deleted, and recomputes just those rows in the same transaction, so the
+  rollup commits or rolls back together with the logs.
+
+Both also recompute the quantile sketches of the same days (quantiles.py).
+
+Every day is recomputed from its raw rows rather than adjusted by a delta, so a
+refresh can never drift from the logs. A day only has a few rows per user, so this
+costs about the same as applying a delta.
+
+Rebuild a range from the command line (default: the last 30 days):
+python3 daily_summary.py --start 2023-11-01 --end 2023-11-30
+"""
+
+# summary columns filled from the logs, in table order
+_FIELDS = [
+    column.name
+    for column in DailyUserSummary.__table__.columns
+    if column.name not in ("user_id", "date")
+]
+_COUNTS = (
+    "metric_count",
+    "sleep_count",
+    "workout_count",
+    *[f"{metric}_count" for metric, _ in helpers.AVERAGES],
+)
+
+
+def _part(user_id, day, **values):
+    # one log table's contribution, the columns it does not fill are NULL
+    return select(
+        user_id.label("user_id"),
+        day.label("date"),
+        *[values.get(name, null()).label(name) for name in _FIELDS],
+    )
+
+
+def summary_query(start, end, user_ids=None, health=None):
+    """
+    Builds the summary rows for the days from start to end (inclusive) from the raw
+    logs: each log table is grouped by (user_id, day) and the groups are combined into
+    one row per (user_id, day) that has any log.
+    `health` is where the health metrics are read from, as retention.py buckets
+    (default: the health_metrics table, rebuild() passes every retention tier).
+    """
+    end_of_range = datetime.combine(end + timedelta(days=1), time.min)
+    if health is None:
+        readings = HealthMetric.__table__
+        health = (
+            reading_buckets(readings)
+            .where(
+                readings.c.timestamp >= datetime.combine(start, time.min),
+                readings.c.timestamp < end_of_range,
+            )
+            .subquery("health_buckets")
+        )
+    # DATE() gives the same 'YYYY-MM-DD' text the Date columns store
+    health_day = func.date(health.c.start)
+
+    def average(metric):
+        # weighted by the number of readings in each bucket that have the metric
+        return func.sum(
+            health.c[f"{metric}_avg"] * health.c[f"{metric}_count"]
+        ) / func.sum(health.c[f"{metric}_count"])
+
+    health_part = for_users(
+        _part(
+            health.c.user_id,
+            health_day,
+            metric_count=func.sum(health.c.reading_count),
+            avg_heart_rate=average("heart_rate"),
+            avg_steps_taken=average("steps_taken"),
+            avg_stand_hours=average("stand_hours"),
+            avg_systolic_bp=average("systolic_bp"),
+            avg_diastolic_bp=average("diastolic_bp"),
+            **{
+                f"{metric}_count": func.sum(health.c[f"{metric}_count"])
+                for metric, _ in helpers.AVERAGES
+            },
+        ),
+        health.c.user_id,
+        user_ids,
+    ).group_by(health.c.user_id, health_day)
+    sleep = for_users(
+        _part(
+            SleepLog.user_id,
+            SleepLog.date,
+            sleep_count=func.count(SleepLog.id),
+            sleep_duration=func.avg(SleepLog.duration),
+            sleep_quality=func.avg(SleepLog.quality),
+        ).where(SleepLog.date.between(start, end)),
+        SleepLog.user_id,
+        user_ids,
+    ).group_by(SleepLog.user_id, SleepLog.date)
+    food = for_users(
+        _part(FoodLog.user_id, FoodLog.date, calories_in=func.sum(Food.calories))
+        .join(Food, FoodLog.food_id == Food.id)
+        .where(FoodLog.date.between(start, end)),
+        FoodLog.user_id,
+        user_ids,
+    ).group_by(FoodLog.user_id, FoodLog.date)
+    workouts = for_users(
+        _part(
+            WorkoutLog.user_id,
+            WorkoutLog.date,
+            calories_burned=func.sum(WorkoutLog.calories_burned),
+            workout_count=func.count(WorkoutLog.id),
+        ).where(WorkoutLog.date.between(start, end)),
+        WorkoutLog.user_id,
+        user_ids,
+    ).group_by(WorkoutLog.user_id, WorkoutLog.date)
+
+    # every table adds at most one row per (user_id, day), so MAX() picks its value
+    parts = union_all(health_part, sleep, food, workouts).subquery("parts")
+    values = []
+    for name in _FIELDS:
+        value = func.max(parts.c[name])
+        if name in _COUNTS:
+            value = func.coalesce(value, 0)
+        values.append(value.label(name))
+    return select(parts.c.user_id, parts.c.date, *values).group_by(
+        parts.c.user_id, parts.c.date
+    )
+
+
+def rebuild(connection, start, end, user_ids=None):
+    """
+    Recomputes the summary rows of every user (or the given user ids) for the days
+    from start to end on an open connection, in the caller's transaction.
+    Returns the number of summary rows written.
+    """
+    connection.execute(
+        for_users(
+            delete(DailyUserSummary).where(DailyUserSummary.date.between(start, end)),
+            DailyUserSummary.user_id,
+            user_ids,
+        )
+    )
+    # old readings are in the monthly partitions (partitions.py) or already rolled
+    # into hourly and daily aggregates (retention.py)
+    health = health_buckets(
+        connection,
+        datetime.combine(start, time.min),
+        datetime.combine(end + timedelta(days=1), time.min),
+        user_ids,
+    )
+    result = connection.execute(
+        insert(DailyUserSummary).from_select(
+            ["user_id", "date"] + _FIELDS,
+            summary_query(start, end, user_ids, health),
+        )
+    )
+    # the quantile sketches of the same days are recomputed with the summary rows
+    quantiles.rebuild(connection, start, end, user_ids)
+    return result.rowcount
+
+
+def rebuild_range(engine=None, start=None, end=None, user_ids=None):
+    # rebuild() in its own transaction, by default the last 30 days
+    return helpers.rebuild_range(
+        rebuild, engine or default_engine, start, end, user_ids
+    )
+
+
+def history(connection):
+    """
+    (first day, last day) of everything the rollup is built from: the logs, the
+    health metric partitions and aggregates. (None, None) for an empty database.
+    """
+    days = []
+    for column in (SleepLog.date, FoodLog.date, WorkoutLog.date, HealthMetricDaily.day):
+        days += connection.execute(select(func.min(column), func.max(column))).one()
+    for column in (HealthMetric.timestamp, HealthMetricHourly.hour):
+        days += [
+            _as_day(value)
+            for value in connection.execute(
+                select(func.min(column), func.max(column))
+            ).one()
+            if value is not None
+        ]
+    months = partitions.list_partitions(connection)
+    if months:
+        days += [months[0], partitions.next_month(months[-1]) - timedelta(days=1)]
+    days = [day for day in days if day is not None]
+    return (min(days), max(days)) if days else (None, None)
+
+
+def backfill(engine=None):
+    """
+    Builds the rollup (and the quantile sketches) of the whole history in one
+    transaction. init_db.py runs it once for a database built before these tables.
+    Returns the number of summary rows written.
+    """
+    engine = engine or default_engine
+    with engine.begin() as connection:
+        start, end = history(connection)
+        if start is None:
+            return 0
+        return rebuild(connection, start, end)
+
+
+def refresh(connection, keys, chunk_size=500):
+    # recomputes the summary rows for a set of (user_id, day) pairs, one day at a time
+    users_by_day = {}
+    for user_id, day in keys:
+        users_by_day.setdefault(day, set()).add(user_id)
+    for day, user_ids in users_by_day.items():
+        user_ids = sorted(user_ids)
+        for i in range(0, len(user_ids), chunk_size):
+            rebuild(connection, day, day, user_ids[i : i + chunk_size])
+
+
+### INCREMENTAL MAINTENANCE ###
+# the log models and the attribute that decides the summary day of a row
+_DAY_ATTRIBUTES = {
+    HealthMetric: "timestamp",
+    SleepLog: "date",
+    FoodLog: "date",
+    WorkoutLog: "date",
+}
+
+
+def _values(state, key):
+    # current and previous values of an attribute, without loading anything
+    history = state.attrs[key].history
+    return [value for value in history.sum() if value is not None]
+
+
+def _as_day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _touched_days(session):
+    keys = set()
+    changed_foods = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        state = inspect(obj)
+        if isinstance(obj, Food):
+            # a new calorie count changes every day the food was eaten on
+            if obj in session.dirty and state.attrs.calories.history.has_changes():
+                changed_foods.append(obj.id)
+            continue
+        day_attribute = _DAY_ATTRIBUTES.get(type(obj))
+        if day_attribute is None:
+            continue
+        for user_id in _values(state, "user_id"):
+            for value in _values(state, day_attribute):
+                keys.add((user_id, _as_day(value)))
+    if changed_foods:
+        rows = session.connection().execute(
+            select(FoodLog.user_id, FoodLog.date)
+            .where(FoodLog.food_id.in_(changed_foods))
+            .distinct()
+        )
+        keys.update((row.user_id, row.date) for row in rows)
+    return keys
+
+
+def refresh_flushed(session, flush_context):
+    # after_flush listener: brings the summary rows of the flushed logs up to date
+    keys = _touched_days(session)
+    if keys:
+        refresh(session.connection(), keys)
+
+
+def track(session_class):
+    """
+    Keeps the rollup current for every session of session_class (and its
+    subclasses). db_session.py calls this for the app's session class.
+    """
+    if not event.contains(session_class, "after_flush", refresh_flushed):
+        event.listen(session_class, "after_flush", refresh_flushed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the daily user summary")
+    parser.add_argument("--start", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD")
+    args = parser.parse_args()
+    rows = rebuild_range(start=args.start, end=args.end)
+    print(f"Rebuilt {rows} daily summary rows")
@@ -0,0 +1,276 @@
+from datetime import datetime
+from functools import lru_cache
+import numpy as np
+
+"""
+Vectorized fake data generator used by the seeding engine (seeding.py).
+
+Calling random.randint / fake.sentence() once per value is the slowest part of
+building a large database. This generator builds whole columns at once with NumPy:
+one call produces the heart rates of every row in a batch, another all of the food
+picks etc. Strings that only Faker can make (names, passwords, descriptions) are
+generated once into a cached pool and then picked from with NumPy indexes.
+
+Every method returns a column batch: a dict of column name -> list of python values
+(ints, floats, datetimes...) with one entry per row, ready for rows() and a bulk
+insert. The generator is seedable, so the same seed always builds the same data,
+which keeps benchmark runs reproducible.
+"""
+
+SECONDS_PER_DAY = 86400
+
+
+@lru_cache(maxsize=None)
+def faker_pool(kind, size=1000, seed=0):
+    """
+    A tuple of `size` Faker strings of one kind ("name", "password" or "sentence").
+    Faker is only imported and instantiated the first time a pool is needed, and each
+    pool is built once per process.
+    """
+    from faker import Faker
+
+    fake = Faker()
+    fake.seed_instance(seed)
+    generate = getattr(fake, kind)
+    return tuple(generate() for _ in range(size))
+
+
+@lru_cache(maxsize=None)
+def food_names(count, seed=0):
+    """
+    Unique (name, category) pairs for the food table. Vegetables and fruits come
+    from the FoodProvider lists, dishes fill the other categories (faked dishes are
+    not aligned with the food categories but this is the closest approximation).
+    """
+    from faker import Faker
+    from faker_food import FoodProvider
+
+    fake = Faker()
+    fake.add_provider(FoodProvider)
+    fake.seed_instance(seed)
+    rng = np.random.default_rng(seed)
+    pools = {4: fake.vegetable, 5: fake.fruit, 0: fake.dish}
+    names = {key: [] for key in pools}
+    # the providers only know a few dozen names each, so stop trying after a while
+    for key, generate in pools.items():
+        seen = set()
+        for _ in range(count * 50):
+            if len(seen) >= count:
+                break
+            name = generate()
+            if name not in seen:
+                seen.add(name)
+                names[key].append(name)
+
+    foods = []
+    for category in rng.integers(1, 6, size=count).tolist():
+        pool = names[category] if category in (4, 5) else names[0]
+        # skip when the category has run out of unique names
+        if pool:
+            foods.append((pool.pop(), category))
+    return tuple(foods)
+
+
+def rows(columns):
+    # turns a column batch into the list of row dictionaries executemany expects
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+
+def _datetimes(base, seconds):
+    # datetime objects for second offsets from a base datetime
+    start = np.datetime64(base, "s")
+    return (
+        (start + np.asarray(seconds, dtype="timedelta64[s]"))
+        .astype("datetime64[us]")
+        .tolist()
+    )
+
+
+def _times(seconds):
+    # time of day objects for second offsets from midnight
+    return [value.time() for value in _datetimes(datetime(2000, 1, 1), seconds)]
+
+
+class DataGenerator:
+    def __init__(self, seed=None, pool_size=1000, pool_seed=None):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.pool_size = pool_size
+        # the string pools are shared by every generator with the same pool seed
+        # (by default the seed itself)
+        if pool_seed is None:
+            pool_seed = seed if isinstance(seed, int) else 0
+        self._pool_seed = pool_seed
+
+    def _pick(self, kind, n):
+        pool = faker_pool(kind, self.pool_size, self._pool_seed)
+        return [pool[i] for i in self.rng.integers(0, len(pool), size=n).tolist()]
+
+    ### USER INDEPENDENT TABLES ###
+    def foods(self, count):
+        pairs = food_names(count, self._pool_seed)
+        return {
+            "name": [name for name, _ in pairs],
+            "calories": self.rng.integers(50, 701, size=len(pairs)).tolist(),
+            "category": [category for _, category in pairs],
+        }
+
+    def workout_recommendations(self, first_id, count):
+        ids = list(range(first_id, first_id + count))
+        return {
+            "id": ids,
+            "exercise_type": self.rng.integers(1, 4, size=count).tolist(),
+            "workout_name": [f"Workout {i}" for i in ids],
+            "description": self._pick("sentence", count),
+            "duration": self.rng.uniform(0.05, 2.0, size=count).tolist(),  # hours
+            "difficulty_level": self.rng.integers(1, 4, size=count).tolist(),
+        }
+
+    ### USER TABLES ###
+    def users(self, user_ids):
+        user_ids = list(user_ids)
+        n = len(user_ids)
+        names = self._pick("name", n)
+        return {
+            "id": user_ids,
+            "name": names,
+            "age": self.rng.integers(18, 71, size=n).tolist(),
+            "gender": self.rng.integers(1, 4, size=n).tolist(),  # M, F, NonBinary
+            "weight": self.rng.uniform(80.0, 100.0, size=n).tolist(),  # kg
+            "height": self.rng.uniform(150.0, 200.0, size=n).tolist(),  # cm
+            # the id keeps the email unique no matter how many users share a name
+            "email": [
+                f"{name.replace(' ', '').lower()}{user_id}@example.com"
+                for name, user_id in zip(names, user_ids)
+            ],
+            "password": self._pick("password", n),
+        }
+
+    def health_metrics(self, user_ids, start_date, days, readings_per_day=1):
+        # readings are spread over the day, one random time inside each time slot
+        user_ids = np.asarray(user_ids)
+        per_user = days * readings_per_day
+        n = len(user_ids) * per_user
+        slot = SECONDS_PER_DAY // readings_per_day
+        day = np.tile(np.repeat(np.arange(days), readings_per_day), len(user_ids))
+        reading = np.tile(np.arange(readings_per_day), len(user_ids) * days)
+        offset = (
+            day * SECONDS_PER_DAY + reading * slot + self.rng.integers(0, slot, size=n)
+        )
+        return {
+            "user_id": np.repeat(user_ids, per_user).tolist(),
+            # resting heart rate (workout log gives active rate)
+            "heart_rate": self.rng.integers(40, 121, size=n).tolist(),
+            "steps_taken": self.rng.integers(0, 20001, size=n).tolist(),
+            "stand_hours": self.rng.integers(0, 21, size=n).tolist(),
+            "systolic_bp": self.rng.integers(90, 131, size=n).tolist(),
+            "diastolic_bp": self.rng.integers(20, 91, size=n).tolist(),
+            "timestamp": _datetimes(start_date, offset),
+        }
+
+    def sleep(self, user_ids, start_date, days):
+        # one sleep record a night
+        user_ids = np.asarray(user_ids)
+        n = len(user_ids) * days
+        start = np.tile(np.arange(days), len(user_ids)) * SECONDS_PER_DAY
+        start = start + self.rng.integers(0, SECONDS_PER_DAY, size=n)
+        hours = np.round(self.rng.uniform(3, 13, size=n), 2)  # rounded to 100ths
+        end = start + np.round(hours * 3600).astype(np.int64)
+        starts = _datetimes(start_date, start)
+        return {
+            "user_id": np.repeat(user_ids, days).tolist(),
+            "duration": hours.tolist(),
+            "quality": self.rng.integers(1, 5, size=n).tolist(),  # 1 poor, 4 excellent
+            "start_time": [value.time() for value in starts],
+            "end_time": _times(end % SECONDS_PER_DAY),
+            "date": [value.date() for value in starts],
+        }
+
+    def food_log(self, user_ids, start_date, days, entries_per_day, food_ids):
+        user_ids = np.asarray(user_ids)
+        per_user = days * entries_per_day
+        n = len(user_ids) * per_user
+        day = np.tile(np.repeat(np.arange(1, days + 1), entries_per_day), len(user_ids))
+        first_day = np.datetime64(start_date, "D")
+        return {
+            "user_id": np.repeat(user_ids, per_user).tolist(),
+            "food_id": self.rng.choice(np.asarray(food_ids), size=n).tolist(),
+            "date": (first_day + day.astype("timedelta64[D]")).tolist(),
+            "time": _times(self.rng.integers(0, SECONDS_PER_DAY, size=n)),
+        }
+
+    def workouts(self, user_ids, start_date, days, recommendation_ids, first_id):
+        """
+        One workout a day per user. 30% of the time the user picks a recommendation,
+        otherwise they create a workout and log it immediately. Returns the column
+        batches for (user_workout, workout_log); the user workouts get ids starting
+        at first_id so the logs can reference them without a flush.
+        """
+        user_ids = np.asarray(user_ids)
+        n = len(user_ids) * days
+        if len(recommendation_ids):
+            use_recommendation = self.rng.random(n) < 0.3
+        else:
+            use_recommendation = np.zeros(n, dtype=bool)
+        created = int(n - use_recommendation.sum())
+        workout_ids = np.arange(first_id, first_id + created)
+
+        user_workout_id = np.full(n, None, dtype=object)
+        user_workout_id[~use_recommendation] = workout_ids.tolist()
+        recommendation_id = np.full(n, None, dtype=object)
+        if use_recommendation.any():
+            recommendation_id[use_recommendation] = self.rng.choice(
+                np.asarray(recommendation_ids), size=int(use_recommendation.sum())
+            ).tolist()
+
+        first_day = np.datetime64(start_date, "D")
+        day = np.tile(np.arange(days), len(user_ids)).astype("timedelta64[D]")
+        user_workouts = {
+            "id": workout_ids.tolist(),
+            "exercise_type": self.rng.integers(1, 4, size=created).tolist(),
+            "description": self._pick("sentence", created),
+            "duration": self.rng.uniform(0.05, 2.0, size=created).tolist(),  # hours
+            "difficulty_level": self.rng.integers(1, 4, size=created).tolist(),
+        }
+        logs = {
+            "user_id": np.repeat(user_ids, days).tolist(),
+            "user_workout_id": user_workout_id.tolist(),
+            "recommendation_id": recommendation_id.tolist(),
+            "calories_burned": self.rng.uniform(100.0, 500.0, size=n).tolist(),
+            "heart_rate": self.rng.integers(90, 251, size=n).tolist(),
+            "date": (first_day + day).tolist(),
+        }
+        return user_workouts, logs
+
+    def goals(self, user_ids, goals_per_user, today=None):
+        # goals begin in the past month and last between 7 and 30 days
+        today = today or datetime.now().date()
+        user_ids = np.asarray(user_ids)
+        n = len(user_ids) * goals_per_user
+        start = np.datetime64(today, "D") - self.rng.integers(0, 31, size=n).astype(
+            "timedelta64[D]"
+        )
+        end = start + self.rng.integers(7, 31, size=n).astype("timedelta64[D]")
+        goal_type = self.rng.integers(1, 4, size=n)  # 1 sleep, 2 nutrition, 3 workout
+        # sleep hours per night, calories per day or workouts per week (see goals.py)
+        target = np.select(
+            [goal_type == 1, goal_type == 2],
+            [
+                self.rng.integers(13, 18, size=n) / 2,  # 6.5 to 8.5 hours
+                self.rng.integers(15, 26, size=n) * 100.0,  # 1500 to 2500 calories
+            ],
+            self.rng.integers(2, 6, size=n).astype(float),  # 2 to 5 workouts
+        )
+        number = np.tile(np.arange(goals_per_user), len(user_ids))
+        return {
+            "user_id": np.repeat(user_ids, goals_per_user).tolist(),
+            "description": [
+                f"Goal {i}, type {t}"
+                for i, t in zip(number.tolist(), goal_type.tolist())
+            ],
+            "start_date": start.tolist(),
+            "end_date": end.tolist(),
+            "goal_type": goal_type.tolist(),
+            "target": target.tolist(),
+        }
@@ -1,16 +1,100 @@
+import asyncio
+import threading
+from contextlib import contextmanager
 from init_db import engine
-from sqlalchemy.orm import sessionmaker
+import catalog
+import daily_summary
+from report_cache import report_cache
+from sqlalchemy import event
+from sqlalchemy.orm import Session as BaseSession, scoped_session, sessionmaker
 
 """
-This module is responsible for creating a SQLAlchemy Session using the engine from init_db.py.
+This module is responsible for creating SQLAlchemy Sessions using the engine from init_db.py.
 By abstracting the session creation to this module, we ensure that all files 
 that need to interact with the database use the same session configuration (eg. engine)
 It also avoids duplicating the session creation code in multiple places. 
 
 I used this abstraction because it allows me to control the scope of the session. 
-We might want to use a new session for each request, or share a session across multiple
-requests. Managing it here helps me easily implement the desired session scope.
+A single shared session would keep every object it ever loaded in its identity map
+and cannot be used from two threads at once. Instead:
+- session is a thread local session (each thread gets its own, created on first use)
+- TaskScopedSession gives each asyncio task its own session
+- session_scope() is a unit of work: commit on success, rollback on error, then close
+- ReadOnlySession / read_only_scope() are for reports: no autoflush and objects are
+  not expired on commit, so reading them again does not reload them. Flushing any
+  change from a read only session raises an error.
+The connection pool behind these sessions is configured in init_db.py (POOL_OPTIONS).
 """
 
-Session = sessionmaker(bind=engine)
-session = Session()
+
+class AppSession(BaseSession):
+    # session class of the app's writing sessions, the listeners below are registered
+    # on it (not on every SQLAlchemy session in the process)
+    pass
+
+
+class ReadOnlySessionClass(BaseSession):
+    # session class for reports, see the before_flush listener below
+    pass
+
+
+@event.listens_for(ReadOnlySessionClass, "before_flush")
+def block_writes(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        raise RuntimeError("read only sessions cannot write to the database")
+
+
+# the app's sessions keep the daily summary rollup current when they flush log rows,
+# drop the cached reports of the users they write and reload the catalogs they change
+daily_summary.track(AppSession)
+report_cache.track(AppSession)
+catalog.track(AppSession)
+
+Session = sessionmaker(bind=engine, class_=AppSession)
+ReadOnlySession = sessionmaker(
+    bind=engine,
+    class_=ReadOnlySessionClass,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+
+def _current_task_or_thread():
+    # the running asyncio task, or the current thread outside of an event loop
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return task if task is not None else threading.get_ident()
+
+
+# thread local sessions, call session.remove() when a thread (or request) is done
+session = scoped_session(Session)
+read_only_session = scoped_session(ReadOnlySession)
+# task local sessions, call TaskScopedSession.remove() before the task finishes
+TaskScopedSession = scoped_session(Session, scopefunc=_current_task_or_thread)
+
+
+@contextmanager
+def session_scope(session_factory=Session):
+    # unit of work: commits if the block succeeds, rolls back if it raises
+    new_session = session_factory()
+    try:
+        yield new_session
+        new_session.commit()
+    except Exception:
+        new_session.rollback()
+        raise
+    finally:
+        new_session.close()
+
+
+@contextmanager
+def read_only_scope(session_factory=ReadOnlySession):
+    # read only unit of work: nothing is committed, the session is always closed
+    new_session = session_factory()
+    try:
+        yield new_session
+    finally:
+        new_session.rollback()
+        new_session.close()
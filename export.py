@@ -0,0 +1,245 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+import time
+from datetime import date, datetime, time as time_of_day
+from sqlalchemy import func, select
+import partitions
+from helpers import for_users
+from init_db import (
+    engine as default_engine,
+    HealthMetric,
+    HealthMetricHourly,
+    HealthMetricDaily,
+    SleepLog,
+    Food,
+    FoodLog,
+    WorkoutLog,
+    WorkoutRecommendation,
+    UserWorkout,
+)
+
+"""
+Streaming export of users' full history (data export requests).
+
+Loading user.health_metrics through the relationship in init_db.User builds an ORM
+object for every reading of the user and keeps them all in the identity map, so
+memory grows with the history. Here every table is read with a plain Core select
+and yield_per, and the rows are written out chunk_size at a time, so memory stays
+the same whether a user has a week or ten years of data.
+
+Each table goes to its own file in the output directory, as CSV, JSONL or gzipped
+JSONL (dates and times as ISO strings):
+- health_metrics: the raw readings, from the monthly partitions (partitions.py)
+  oldest first and then health_metrics
+- health_metrics_hourly, health_metrics_daily: readings already rolled up by the
+  retention job (retention.py)
+- sleep_log
+- food_log with the food's name and calories
+- workout_log with the name of the recommended workout or the description of the
+  user's own workout
+
+export_user() writes one user. export_all() writes every user in one pass over each
+table (in user order), instead of one query per user.
+
+python3 export.py --user 1 --format csv --out exports/user_1
+python3 export.py --all --format jsonl.gz --out exports/all
+"""
+
+FORMATS = ("csv", "jsonl", "jsonl.gz")
+
+
+def _json_value(value):
+    # json.dumps default: dates and times become ISO strings
+    if isinstance(value, (date, datetime, time_of_day)):
+        return value.isoformat()
+    raise TypeError(f"cannot export {type(value).__name__}")
+
+
+class _Writer:
+    # writes the rows of one table to a file, a chunk at a time
+    def __init__(self, path, fmt, columns):
+        self.columns = list(columns)
+        if fmt == "csv":
+            self.file = open(path, "w", newline="")
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(self.columns)
+        elif fmt == "jsonl":
+            self.file = open(path, "w")
+        elif fmt == "jsonl.gz":
+            self.file = gzip.open(path, "wt")
+        else:
+            raise ValueError(f"format must be one of {FORMATS}")
+        self.fmt = fmt
+
+    def write(self, rows):
+        if self.fmt == "csv":
+            self.csv.writerows(rows)
+        else:
+            self.file.write(
+                "".join(
+                    json.dumps(dict(zip(self.columns, row)), default=_json_value) + "\n"
+                    for row in rows
+                )
+            )
+
+    def close(self):
+        self.file.close()
+
+
+### QUERIES ###
+# each one selects a table's rows for some users (None = everyone) in user and
+# time order, which the (user_id, date/timestamp) indexes return without a sort
+def health_metric_queries(connection, user_ids=None):
+    # one query per table that holds readings, oldest partition first
+    months = partitions.list_partitions(connection)
+    tables = [partitions.partition_table(month) for month in months]
+    tables.append(HealthMetric.__table__)
+    return [
+        for_users(
+            select(*table.columns).order_by(table.c.user_id, table.c.timestamp),
+            table.c.user_id,
+            user_ids,
+        )
+        for table in tables
+    ]
+
+
+def _aggregate_query(model, time_column, user_ids):
+    table = model.__table__
+    columns = [column for column in table.columns if column.name != "id"]
+    return for_users(
+        select(*columns).order_by(table.c.user_id, time_column),
+        table.c.user_id,
+        user_ids,
+    )
+
+
+def sleep_query(user_ids=None):
+    return for_users(
+        select(*SleepLog.__table__.columns).order_by(SleepLog.user_id, SleepLog.date),
+        SleepLog.user_id,
+        user_ids,
+    )
+
+
+def food_log_query(user_ids=None):
+    return for_users(
+        select(
+            FoodLog.id,
+            FoodLog.user_id,
+            FoodLog.date,
+            FoodLog.time,
+            FoodLog.food_id,
+            Food.name.label("food_name"),
+            Food.calories,
+        )
+        .join(Food, FoodLog.food_id == Food.id)
+        .order_by(FoodLog.user_id, FoodLog.date),
+        FoodLog.user_id,
+        user_ids,
+    )
+
+
+def workout_log_query(user_ids=None):
+    return for_users(
+        select(
+            *WorkoutLog.__table__.columns,
+            func.coalesce(
+                WorkoutRecommendation.workout_name, UserWorkout.description
+            ).label("workout"),
+        )
+        .outerjoin(
+            WorkoutRecommendation,
+            WorkoutLog.recommendation_id == WorkoutRecommendation.id,
+        )
+        .outerjoin(UserWorkout, WorkoutLog.user_workout_id == UserWorkout.id)
+        .order_by(WorkoutLog.user_id, WorkoutLog.date),
+        WorkoutLog.user_id,
+        user_ids,
+    )
+
+
+def export_queries(connection, user_ids=None):
+    # file name -> the queries whose rows go into it, in order
+    return {
+        "health_metrics": health_metric_queries(connection, user_ids),
+        "health_metrics_hourly": [
+            _aggregate_query(HealthMetricHourly, HealthMetricHourly.hour, user_ids)
+        ],
+        "health_metrics_daily": [
+            _aggregate_query(HealthMetricDaily, HealthMetricDaily.day, user_ids)
+        ],
+        "sleep_log": [sleep_query(user_ids)],
+        "food_log": [food_log_query(user_ids)],
+        "workout_log": [workout_log_query(user_ids)],
+    }
+
+
+### EXPORT ###
+def export(
+    engine=None, directory="export", fmt="jsonl", user_ids=None, chunk_size=1000
+):
+    """
+    Streams the history of the given users (None = every user) into one file per
+    table in `directory`. Returns {file name: rows written}.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {FORMATS}")
+    engine = engine or default_engine
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    with engine.connect() as connection:
+        # one read transaction, so every file comes from the same snapshot: the
+        # sqlite3 driver only opens a transaction before a write, without BEGIN
+        # every query would read the database as it is at that moment
+        connection.exec_driver_sql("BEGIN")
+        # yield_per: rows are fetched chunk_size at a time instead of all at once
+        streaming = connection.execution_options(yield_per=chunk_size)
+        for name, queries in export_queries(connection, user_ids).items():
+            path = os.path.join(directory, f"{name}.{fmt}")
+            writer = None
+            counts[name] = 0
+            try:
+                for query in queries:
+                    result = streaming.execute(query)
+                    if writer is None:
+                        writer = _Writer(path, fmt, result.keys())
+                    for chunk in result.partitions():
+                        writer.write(chunk)
+                        counts[name] += len(chunk)
+            finally:
+                if writer is not None:
+                    writer.close()
+    return counts
+
+
+def export_user(user_id, directory, fmt="jsonl", engine=None, chunk_size=1000):
+    # every table's rows of one user
+    return export(engine, directory, fmt, [user_id], chunk_size)
+
+
+def export_all(directory, fmt="jsonl", engine=None, chunk_size=1000):
+    # every user's rows, one pass over each table
+    return export(engine, directory, fmt, None, chunk_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export users' full history")
+    users = parser.add_mutually_exclusive_group(required=True)
+    users.add_argument("--user", type=int, help="user id")
+    users.add_argument("--all", action="store_true", help="every user")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--out", default="export", help="output directory")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    user_ids = None if args.all else [args.user]
+    counts = export(None, args.out, args.format, user_ids, args.chunk_size)
+    seconds = time.perf_counter() - start
+    for name, rows in counts.items():
+        print(f"{name}: {rows} rows")
+    print(f"Exported {sum(counts.values())} rows in {seconds:.2f}s to {args.out}")
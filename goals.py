@@ -0,0 +1,242 @@
+import argparse
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+from sqlalchemy import and_, case, func, literal, or_, select
+from sqlalchemy.dialects.sqlite import insert
+from helpers import weighted_avg
+from init_db import (
+    engine as default_engine,
+    Goal,
+    GoalProgress,
+    DailyUserSummary,
+    GOAL_SPANS,
+)
+
+"""
+Goal progress evaluation.
+
+Every goal has a measurable target (Goal.target, NULL means the default of its
+type below):
+- sleep (1): average hours of sleep per night, at least the target
+- nutrition (2): average calories eaten per day (days with food logged), at most the
+  target
+- workout (3): workouts per week, at least the target
+
+A goal without a type (goal_type is nullable) has nothing to measure, it gets no
+progress row.
+
+evaluate() computes the progress of every goal in progress on a day (start_date <=
+day <= end_date) from the goal's start up to that day, and writes it to goal_progress
+(GoalProgress in init_db.py): the value so far, the target and whether it is met.
+Instead of a few queries per goal, each batch of goals is one INSERT ... SELECT: the
+goals are joined to their users' daily_user_summary rows (sleep hours, calories and
+workout counts per day, see daily_summary.py) through the (user_id, date) primary
+key, grouped by goal and upserted on goal_id. The goals are walked in id ranges of
+batch_size, so a nightly run over millions of goals is one pass over the goals table
+in short transactions. A goal that ended keeps the progress of its last evaluation.
+
+The goals active on a day, or overlapping a date range, of every user are found
+through the interval index on goals (Goal.span_class in init_db.py): goals are
+grouped by length class, and a goal of a class no longer than N days can only
+overlap the range if it starts at most N days before it. overlapping() turns that
+into one bounded range of the (span_class, start_date) index per class, so the
+query reads the goals that start near the range instead of the whole table.
+
+python3 goals.py                    (the goals in progress today)
+python3 goals.py --date 2023-11-30 --batch-size 50000
+python3 goals.py active --date 2023-11-30      (goals active on a day, by type)
+python3 goals.py active --date 2023-11-01 --end 2023-11-30
+"""
+
+SLEEP, NUTRITION, WORKOUT = 1, 2, 3
+# the target of a goal without one
+DEFAULT_TARGETS = {SLEEP: 7.0, NUTRITION: 2000.0, WORKOUT: 3.0}
+
+EvaluationStats = namedtuple("EvaluationStats", ["goals", "met", "batches", "seconds"])
+
+
+def overlapping(start, end=None):
+    """
+    Where clause for the goals that overlap start..end (inclusive), or that are
+    active on `start` without an end. Reads the interval index, see the docstring.
+    """
+    end = end or start
+    # a goal of class k ends at most GOAL_SPANS[k] days after it starts, the longest
+    # class has no bound
+    classes = [
+        and_(
+            Goal.span_class == k,
+            Goal.start_date.between(start - timedelta(days=span), end),
+        )
+        for k, span in enumerate(GOAL_SPANS)
+    ]
+    classes.append(and_(Goal.span_class == len(GOAL_SPANS), Goal.start_date <= end))
+    return and_(or_(*classes), Goal.start_date <= end, Goal.end_date >= start)
+
+
+# the goals of every user active on a day (or overlapping start..end)
+def active_goals_query(start, end=None, goal_type=None):
+    query = select(Goal).where(overlapping(start, end)).order_by(Goal.id)
+    if goal_type is not None:
+        query = query.where(Goal.goal_type == goal_type)
+    return query
+
+
+# number of goals of each type active on a day (or overlapping start..end)
+def active_goal_count_query(start, end=None):
+    return (
+        select(Goal.goal_type, func.count(Goal.id).label("goals"))
+        .where(overlapping(start, end))
+        .group_by(Goal.goal_type)
+        .order_by(Goal.goal_type)
+    )
+
+
+def _value(days):
+    # the measured value of a goal from its summary rows, by goal type
+    summary = DailyUserSummary
+    hours_per_night = weighted_avg(summary.sleep_duration, summary.sleep_count)
+    calories_per_day = func.avg(summary.calories_in)
+    workouts_per_week = func.coalesce(func.sum(summary.workout_count), 0) * 7.0 / days
+    return case(
+        (Goal.goal_type == SLEEP, hours_per_night),
+        (Goal.goal_type == NUTRITION, calories_per_day),
+        (Goal.goal_type == WORKOUT, workouts_per_week),
+    )
+
+
+def _target():
+    return func.coalesce(
+        Goal.target,
+        case(
+            *[
+                (Goal.goal_type == goal_type, target)
+                for goal_type, target in DEFAULT_TARGETS.items()
+            ]
+        ),
+    )
+
+
+def progress_query(day, first_id=None, last_id=None):
+    """
+    The progress rows (goal_progress columns) of the goals in progress on `day`,
+    optionally only the goals with first_id <= id <= last_id. Goals without a type
+    are left out.
+    """
+    # the days counted: from the start of the goal up to `day`
+    days = (func.julianday(day) - func.julianday(Goal.start_date) + 1).label("days")
+    value = _value(days)
+    target = _target()
+    met = case(
+        (value.is_(None), False),
+        (Goal.goal_type == NUTRITION, value <= target),
+        else_=value >= target,
+    )
+    query = (
+        select(
+            Goal.id.label("goal_id"),
+            Goal.user_id,
+            literal(day).label("as_of"),
+            days,
+            value.label("value"),
+            target.label("target"),
+            met.label("met"),
+        )
+        .select_from(Goal)
+        .outerjoin(
+            DailyUserSummary,
+            and_(
+                DailyUserSummary.user_id == Goal.user_id,
+                DailyUserSummary.date.between(Goal.start_date, day),
+            ),
+        )
+        .where(
+            Goal.start_date <= day,
+            Goal.end_date >= day,
+            Goal.goal_type.in_(DEFAULT_TARGETS),
+        )
+        .group_by(Goal.id)
+    )
+    if first_id is not None:
+        query = query.where(Goal.id >= first_id)
+    if last_id is not None:
+        query = query.where(Goal.id <= last_id)
+    return query
+
+
+def _write_progress(connection, query):
+    # upserts the progress rows of a query, returns (rows, rows that met the target)
+    columns = ["goal_id", "user_id", "as_of", "days", "value", "target", "met"]
+    statement = insert(GoalProgress).from_select(columns, query)
+    statement = statement.on_conflict_do_update(
+        index_elements=["goal_id"],
+        set_={name: statement.excluded[name] for name in columns[1:]},
+    ).returning(GoalProgress.met)
+    met = connection.execute(statement).scalars().all()
+    return len(met), sum(met)
+
+
+def evaluate(engine=None, day=None, batch_size=10000):
+    """
+    Evaluates every goal in progress on `day` (default today) and writes its progress,
+    batch_size goal ids per transaction. Returns EvaluationStats.
+    """
+    engine = engine or default_engine
+    day = day or date.today()
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        first, last = connection.execute(
+            select(func.min(Goal.id), func.max(Goal.id))
+        ).one()
+    goals = met = batches = 0
+    if first is not None:
+        for first_id in range(first, last + 1, batch_size):
+            with engine.begin() as connection:
+                written, written_met = _write_progress(
+                    connection, progress_query(day, first_id, first_id + batch_size - 1)
+                )
+            goals += written
+            met += written_met
+            batches += 1
+    return EvaluationStats(goals, met, batches, time.perf_counter() - start)
+
+
+def evaluate_goal(connection, goal_id, day=None):
+    # re-evaluates one goal now (eg. after its user logged something), in the
+    # caller's transaction
+    return _write_progress(
+        connection, progress_query(day or date.today(), goal_id, goal_id)
+    )
+
+
+# the progress of a user's goals, newest goal first
+def user_progress_query(user_id):
+    return (
+        select(Goal, GoalProgress)
+        .join(GoalProgress, GoalProgress.goal_id == Goal.id)
+        .where(GoalProgress.user_id == user_id)
+        .order_by(Goal.start_date.desc())
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate goal progress")
+    parser.add_argument("command", nargs="?", choices=["evaluate", "active"])
+    parser.add_argument("--date", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+    if args.command == "active":
+        day = args.date or date.today()
+        with default_engine.connect() as connection:
+            counts = connection.execute(active_goal_count_query(day, args.end)).all()
+        print(f"Goals active {day}{f' to {args.end}' if args.end else ''}:")
+        for goal_type, count in counts:
+            print(f"type {goal_type}: {count}")
+    else:
+        stats = evaluate(day=args.date, batch_size=args.batch_size)
+        print(
+            f"Evaluated {stats.goals} goals in {stats.batches} batches "
+            f"({stats.met} on target) in {stats.seconds:.2f}s"
+        )
@@ -0,0 +1,57 @@
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import case, func
+
+"""
+Small helpers shared by the query modules (reports, daily summary, partitions,
+retention, analytics, quantiles, export), kept in one place so they cannot drift.
+"""
+
+# (metric, label) of the average health metrics, the same labels as
+# reports.avg_health_metrics_query
+AVERAGES = [
+    ("heart_rate", "avg_resting_heart_rate"),
+    ("steps_taken", "avg_steps_taken"),
+    ("stand_hours", "avg_stand_hours"),
+    ("systolic_bp", "avg_systolic_bp"),
+    ("diastolic_bp", "avg_diastolic_bp"),
+]
+
+
+def weighted_avg(value, count):
+    # the average over the raw rows of per day (or per bucket) averages, each weighted
+    # by its row count. An average that is NULL (no row had the value) adds nothing
+    # to the total count either
+    weight = case((value.is_(None), 0), else_=count)
+    return func.sum(value * count) / func.sum(weight)
+
+
+def for_users(query, column, user_ids):
+    # filters a query to some users (None = everyone)
+    # a range of ids (what the seeders write) becomes a BETWEEN instead of a long IN
+    if user_ids is None:
+        return query
+    if isinstance(user_ids, range) and user_ids.step == 1:
+        return query.where(column.between(user_ids.start, user_ids.stop - 1))
+    return query.where(column.in_(list(user_ids)))
+
+
+def as_datetime(value):
+    # a date as the datetime of its midnight, the form timestamps are compared in
+    if isinstance(value, datetime):
+        return value
+    return datetime.combine(value, time.min)
+
+
+def rebuild_range(rebuild, engine, start=None, end=None, user_ids=None):
+    # rebuild(connection, start, end, user_ids) in its own transaction, by default
+    # the last 30 days
+    end = end or date.today()
+    start = start or end - timedelta(days=30)
+    with engine.begin() as connection:
+        return rebuild(connection, start, end, user_ids)
+
+
+def user_id_range(text):
+    # command line user ids: "3" or "1-25"
+    first, _, last = text.partition("-")
+    return range(int(first), int(last or first) + 1)
@@ -0,0 +1,375 @@
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, IntegrityError, StatementError
+from daily_summary import refresh
+from upsert import UNIQUE_KEYS, upsert
+from report_cache import report_cache
+from init_db import engine as default_engine, HealthMetric, SleepLog, WorkoutLog
+
+"""
+Buffered ingest for the device uploads (health metrics, sleep and workout logs).
+
+Adding one ORM object and committing per upload means one transaction, and one
+fsync, per reading: thousands of devices uploading all day would spend SQLite's
+whole write budget on commits. An Ingestor takes records from any number of
+threads with submit() and a single writer thread writes them in group commits:
+
+- records are buffered per table
+- the writer flushes when max_batch records are waiting or the oldest one has
+  waited max_delay seconds, whichever comes first
+- a flush inserts every buffered table with one executemany per table (rows sorted
+  by user and time, the order of the indexes), health metrics and sleep logs as an
+  upsert on their natural key (upsert.py) so a re-sent upload is skipped (or
+  overwrites the old values with update_existing=True), and refreshes the daily
+  summary rows
+  of the users and days it wrote (daily_summary.py), all in one transaction; the
+  report cache entries of those users are dropped after the commit
+- when max_buffered records are waiting or being written, submit() blocks until a
+  flush makes room (backpressure), or raises BufferFull after its timeout
+
+submit() checks that every record has its user and date, and returns a Receipt
+that tells its caller what became of those records. When a row of a flush breaks a
+constraint (eg. a reading with a negative heart rate or an unknown user), the flush
+is written again one row at a time: the other rows still commit and only the bad
+ones are rejected, on the Receipt of the submit() they came from. A flush that fails
+as a whole (eg. the disk is full) sets the error of every Receipt in it. Nothing is
+raised into the callers that come after.
+
+stats() reports the rows written, flush latency and rows/sec. Run ingest processes
+with the "ingest" SQLite profile (HEALTH_DB_PROFILE=ingest, see init_db.py).
+
+    with Ingestor() as ingestor:
+        receipt = ingestor.submit([HealthMetric(user_id=1, heart_rate=60, timestamp=now)])
+        receipt.wait()  # optional: until the records are committed or rejected
+"""
+
+# the tables that take uploads and the column with the time of each record
+INGEST_MODELS = {HealthMetric: "timestamp", SleepLog: "date", WorkoutLog: "date"}
+
+# rows written, flushes and flush latency of an Ingestor
+# rows_per_second is the write rate while flushing (rows / seconds spent in flushes)
+IngestStats = namedtuple(
+    "IngestStats",
+    [
+        "rows",
+        "flushes",
+        "failed_rows",
+        "duplicates",
+        "buffered",
+        "waits",
+        "avg_flush_ms",
+        "p95_flush_ms",
+        "max_flush_ms",
+        "rows_per_second",
+    ],
+)
+
+
+# a row the database refused, with the error (eg. sqlite3.IntegrityError, or the
+# TypeError of a value that cannot be written)
+Rejected = namedtuple("Rejected", ["model", "row", "error"])
+
+
+def _bad_row(exc):
+    # errors caused by the values of the rows, not by the database (a locked or full
+    # database fails the whole flush instead)
+    if isinstance(exc, IntegrityError):
+        return True
+    if isinstance(exc, DBAPIError):
+        return False
+    # (a value of the wrong type fails in Python before it gets to the database)
+    return isinstance(exc, (StatementError, AttributeError, TypeError, ValueError))
+
+
+class BufferFull(Exception):
+    # raised by submit() when the buffer stayed full for its whole timeout
+    pass
+
+
+def _as_day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _row(record):
+    # the column values of an ORM object, without its id (the database assigns it)
+    time_column = INGEST_MODELS.get(type(record))
+    if time_column is None:
+        raise TypeError(f"cannot ingest {type(record).__name__} records")
+    if record.user_id is None or getattr(record, time_column) is None:
+        raise ValueError(f"{type(record).__name__} needs user_id and {time_column}")
+    return {
+        column.name: getattr(record, column.name)
+        for column in type(record).__table__.columns
+        if column.name != "id"
+    }
+
+
+class Receipt:
+    """
+    What became of the records of one submit(). wait() blocks until their flush is
+    over, then `rejected` lists the rows the database refused (Rejected tuples) and
+    `error` is the exception of a flush that failed as a whole (None if it committed).
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.rejected = []
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def accepted(self):
+        # records that were committed (re-sent records skipped by the upsert included)
+        return 0 if self.error is not None else self.count - len(self.rejected)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        # True once the flush is over, False if timeout seconds passed first
+        return self._done.wait(timeout)
+
+
+class Ingestor:
+    def __init__(
+        self,
+        engine=None,
+        max_batch=1000,
+        max_delay=0.5,
+        max_buffered=20000,
+        cache=report_cache,
+        update_existing=False,
+    ):
+        if max_buffered < max_batch:
+            raise ValueError("max_buffered must be at least max_batch")
+        self.engine = engine or default_engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay  # seconds a record can wait for its flush
+        self.max_buffered = max_buffered
+        self.cache = cache
+        self.update_existing = update_existing
+        self._buffers = {model: [] for model in INGEST_MODELS}  # (row, receipt)
+        self._receipts = []  # receipts of the buffered records
+        self._pending = 0  # records in the buffers
+        self._writing = 0  # records of the flush in progress
+        self._oldest = None  # clock time of the oldest pending record
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self.rows = self.flushes = self.failed_rows = self.waits = 0
+        self.duplicates = 0  # re-sent records that were skipped
+        self._flush_seconds = 0.0
+        self._latencies = deque(maxlen=1000)  # seconds of the last flushes
+        self._writer = threading.Thread(
+            target=self._run, name="ingest-writer", daemon=True
+        )
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, records, timeout=None):
+        """
+        Buffers HealthMetric, SleepLog and WorkoutLog objects (not added to any
+        session) for the next flush. Blocks while the buffer is full, up to timeout
+        seconds (None waits as long as it takes). Returns the Receipt of the records.
+        """
+        rows = {}
+        for record in records:
+            rows.setdefault(type(record), []).append(_row(record))
+        return self._enqueue(rows, timeout)
+
+    def submit_rows(self, model, rows, timeout=None):
+        """
+        submit() for rows that are already dictionaries, for callers that parse and
+        validate uploads themselves (ingest_server.py): every row has a value (or
+        None) for every column of the model but id.
+        """
+        if model not in INGEST_MODELS:
+            raise TypeError(f"cannot ingest {model.__name__} records")
+        return self._enqueue({model: list(rows)}, timeout)
+
+    def _enqueue(self, rows, timeout):
+        count = sum(len(model_rows) for model_rows in rows.values())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            waited = False
+            # a submit bigger than the whole buffer waits until it is empty
+            while self._pending + self._writing > 0 and (
+                self._pending + self._writing + count > self.max_buffered
+            ):
+                if self._closed:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise BufferFull(
+                        f"{self._pending + self._writing} records are waiting"
+                    )
+                if not waited:
+                    self.waits += 1  # submits that had to wait
+                    waited = True
+                self._condition.wait(remaining)
+            if self._closed:
+                raise RuntimeError("the ingestor is closed")
+            receipt = Receipt(count)
+            for model, model_rows in rows.items():
+                self._buffers[model].extend((row, receipt) for row in model_rows)
+            self._receipts.append(receipt)
+            self._pending += count
+            if count and self._oldest is None:
+                # the writer waits for max_delay from the first record on
+                self._oldest = time.monotonic()
+                self._condition.notify_all()
+            elif self._pending >= self.max_batch:
+                self._condition.notify_all()
+        return receipt
+
+    def flush(self):
+        # writes everything submitted so far and waits for the commit
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._pending or self._writing:
+                self._condition.wait()
+            self._flush_requested = False
+
+    def close(self):
+        # flushes what is left and stops the writer
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+
+    ### WRITER ###
+    def _due(self):
+        if self._pending >= self.max_batch or self._flush_requested or self._closed:
+            return True
+        return (
+            self._oldest is not None
+            and time.monotonic() - self._oldest >= self.max_delay
+        )
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._pending and self._due()):
+                    if self._closed and not self._pending:
+                        return
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = self._oldest + self.max_delay - time.monotonic()
+                    self._condition.wait(timeout)
+                # take the buffers, new records go into fresh ones while this writes
+                batch, receipts = self._buffers, self._receipts
+                self._buffers = {model: [] for model in INGEST_MODELS}
+                self._receipts = []
+                self._writing, self._pending = self._pending, 0
+                self._oldest = None
+            start = time.perf_counter()
+            error = None
+            users, duplicates, rejected = set(), 0, []
+            try:
+                users, duplicates, rejected = self._write(batch)
+            except Exception as exc:
+                error = exc
+            seconds = time.perf_counter() - start
+            with self._condition:
+                if error is None:
+                    # skipped duplicates were not written
+                    self.rows += self._writing - len(rejected) - duplicates
+                    self.failed_rows += len(rejected)
+                    self.duplicates += duplicates
+                    self.flushes += 1
+                    self._flush_seconds += seconds
+                    self._latencies.append(seconds)
+                else:
+                    self.failed_rows += self._writing
+                self._writing = 0
+                self._condition.notify_all()
+            for user_id in users:
+                self.cache.invalidate_user(user_id)
+            for receipt, row in rejected:
+                receipt.rejected.append(row)
+            for receipt in receipts:
+                receipt.error = error
+                receipt._done.set()
+
+    def _write(self, batch):
+        """
+        Writes a batch in one transaction (the group commit). If a row breaks a
+        constraint the batch is written again row by row, so only the bad rows are
+        left out. Values that cannot be sorted or written (eg. a timestamp with a UTC
+        offset among naive ones) are rejected the same way. Returns (users written,
+        duplicates skipped, rejected rows as (receipt, Rejected) pairs).
+        """
+        try:
+            for model, entries in batch.items():
+                time_column = INGEST_MODELS[model]
+                entries.sort(
+                    key=lambda entry: (entry[0]["user_id"], entry[0][time_column])
+                )
+            return self._write_rows(batch, one_by_one=False)
+        except Exception as exc:
+            if not _bad_row(exc):
+                raise
+        return self._write_rows(batch, one_by_one=True)
+
+    def _write_rows(self, batch, one_by_one):
+        keys = set()
+        duplicates = 0
+        rejected = []
+        with self.engine.begin() as connection:
+            for model, entries in batch.items():
+                if not entries:
+                    continue
+                time_column = INGEST_MODELS[model]
+                groups = [[entry] for entry in entries] if one_by_one else [entries]
+                for group in groups:
+                    rows = [row for row, _ in group]
+                    try:
+                        written = self._insert(connection, model, rows)
+                    except Exception as exc:
+                        if not one_by_one or not _bad_row(exc):
+                            raise
+                        # SQLite only undoes the failed statement, the transaction
+                        # and the rows before it are kept
+                        row, receipt = group[0]
+                        error = getattr(exc, "orig", None) or exc
+                        rejected.append((receipt, Rejected(model, row, error)))
+                        continue
+                    duplicates += len(rows) - written
+                    keys.update(
+                        (row["user_id"], _as_day(row[time_column])) for row in rows
+                    )
+            # Core inserts skip the ORM listener that keeps the rollup current
+            refresh(connection, keys)
+        return {user_id for user_id, _ in keys}, duplicates, rejected
+
+    def _insert(self, connection, model, rows):
+        # one executemany, returns the rows written (re-sent ones are skipped)
+        if model in UNIQUE_KEYS:
+            return upsert(connection, model, rows, self.update_existing)
+        connection.execute(insert(model), rows)
+        return len(rows)
+
+    def stats(self):
+        with self._condition:
+            latencies = sorted(self._latencies)
+            return IngestStats(
+                self.rows,
+                self.flushes,
+                self.failed_rows,
+                self.duplicates,
+                self._pending + self._writing,
+                self.waits,
+                1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+                1000 * latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+                1000 * latencies[-1] if latencies else 0.0,
+                self.rows / self._flush_seconds if self._flush_seconds else 0.0,
+            )
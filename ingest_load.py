@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+"""
+Load generator for the ingest server (ingest_server.py).
+
+Simulates --devices devices uploading at the same time, each on its own connection:
+every device sends --batches batches of --batch-size health metric readings taken
+--interval minutes apart and waits for the reply to each one before sending the
+next, like a real device would.
+The readings belong to user ids 1 to --users, which must exist in the server's
+database (python3 insert_data.py --users 25 creates 25). With more devices than users
+a user has several devices, their readings are a few seconds apart so that none of
+them is a duplicate (a re-sent reading) of another device's.
+
+It prints the rows per second the server accepted, the reply latency percentiles and
+the server's own flush stats. Compare runs with different --devices or with the
+server's --max-batch / --max-delay to see how group commit sizes change throughput.
+
+python3 ingest_server.py &
+python3 ingest_load.py --devices 100 --batches 20 --batch-size 50
+"""
+
+
+def readings(rng, user_id, start, count, interval):
+    # a batch of plausible readings, `interval` minutes apart
+    return [
+        {
+            "user_id": user_id,
+            "heart_rate": rng.randint(50, 110),
+            "steps_taken": rng.randint(0, 2000),
+            "stand_hours": rng.randint(0, 1),
+            "systolic_bp": rng.randint(100, 140),
+            "diastolic_bp": rng.randint(60, 90),
+            "timestamp": (start + timedelta(minutes=i * interval)).isoformat(),
+        }
+        for i in range(count)
+    ]
+
+
+async def request(reader, writer, message):
+    writer.write(json.dumps(message).encode() + b"\n")
+    await writer.drain()
+    reply = json.loads(await reader.readline())
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    return reply
+
+
+async def device(host, port, device_id, args, latencies):
+    rng = random.Random(device_id)
+    user_id = device_id % args.users + 1
+    # the readings of a device end about now, the devices of the same user are a
+    # second apart so their (user_id, timestamp) keys never collide
+    span = timedelta(minutes=args.batches * args.batch_size * args.interval)
+    offset = timedelta(seconds=device_id // args.users)
+    start = datetime.now().replace(microsecond=0) - span + offset
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for batch in range(args.batches):
+            message = {
+                "table": "health_metrics",
+                "records": readings(
+                    rng,
+                    user_id,
+                    start + timedelta(minutes=batch * args.batch_size * args.interval),
+                    args.batch_size,
+                    args.interval,
+                ),
+            }
+            sent = time.perf_counter()
+            await request(reader, writer, message)
+            latencies.append(time.perf_counter() - sent)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            device(args.host, args.port, device_id, args, latencies)
+            for device_id in range(args.devices)
+        ]
+    )
+    seconds = time.perf_counter() - start
+    rows = args.devices * args.batches * args.batch_size
+    latencies.sort()
+    print(f"{rows:,} readings from {args.devices} devices in {seconds:.2f}s")
+    print(f"{rows / seconds:,.0f} readings/sec accepted")
+    for percentile in (50, 95, 99):
+        latency = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+        print(f"p{percentile} reply latency: {latency * 1000:.1f} ms")
+
+    # the server commits within its max_delay, give it time before reading its stats
+    await asyncio.sleep(args.settle)
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    stats = (await request(reader, writer, {"stats": True}))["stats"]
+    writer.close()
+    print(
+        f"server: {stats['rows']:,} rows in {stats['flushes']} flushes, "
+        f"{stats['avg_flush_ms']:.1f} ms per flush (p95 {stats['p95_flush_ms']:.1f} ms), "
+        f"{stats['rows_per_second']:,.0f} rows/sec while flushing, "
+        f"{stats['waits']} backpressure waits, {stats['duplicates']} duplicates skipped"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the ingest server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--batches", type=int, default=20, help="batches per device")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--users", type=int, default=25)
+    parser.add_argument(
+        "--interval", type=int, default=5, help="minutes between a device's readings"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=1.0, help="seconds to wait for the last flush"
+    )
+    args = parser.parse_args()
+    # the devices of a user are offset by whole seconds within each minute
+    if args.devices > 60 * args.users:
+        parser.error("at most 60 devices per user")
+    asyncio.run(run(args))
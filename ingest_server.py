@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import json
+import signal
+from datetime import date, datetime, time
+from functools import partial
+from sqlalchemy import Date, DateTime, Float, Integer, Time, select
+from catalog import catalog_for
+from ingest import BufferFull, Ingestor, INGEST_MODELS
+from init_db import engine as default_engine, User, UserWorkout
+
+"""
+Local asyncio server for device uploads, speaking line delimited JSON over TCP.
+
+Each request is one line with a batch for one table, each reply is one line:
+
+    {"table": "health_metrics", "records": [{"user_id": 1, "heart_rate": 62,
+     "steps_taken": 340, "timestamp": "2023-11-20T08:15:00"}, ...]}
+    -> {"ok": true, "accepted": 1}
+    -> {"ok": false, "error": "record 0: unknown user_id 99"}
+    -> {"ok": false, "error": "not queued: the ingestor is closed"}
+
+    {"stats": true} -> the Ingestor's stats (see ingest.py)
+
+Tables: health_metrics, sleep_log and workout_log. Dates, times and timestamps are
+ISO strings, times and timestamps in local time without a UTC offset.
+
+Parsing and validation run on the event loop: every field is converted to its
+column's type and checked against the table's check constraints, and the users,
+user workouts and workout recommendations (the recommendation catalog, catalog.py)
+the records refer to must exist, so a record the database would refuse never
+reaches the writer. The ids found are cached. A batch with a bad record is refused
+whole. If a batch cannot be queued (eg. the Ingestor was closed), the reply says so
+and the connection stays open. Accepted records go to one Ingestor (ingest.py),
+whose writer thread is the only writer of the database and group commits the
+buffered batches, so no two requests ever fight over SQLite's write lock
+("database is locked"). A reply means the batch was accepted into the buffer; it
+is committed within the Ingestor's max_delay. When the buffer is full the
+connection waits for room before it reads its next request, so fast devices are
+slowed down instead of growing the buffer.
+
+python3 ingest_server.py --port 8765
+python3 ingest_load.py --port 8765      (load generator, see that module)
+"""
+
+TABLES = {model.__tablename__: model for model in INGEST_MODELS}
+# lines can hold big batches, asyncio's default limit is 64 KiB
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+def _number(kind, value):
+    # bools are ints to Python, but never a valid reading
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"expected a number, got {value!r}")
+    if kind is int and value != int(value):
+        raise ValueError(f"expected an integer, got {value!r}")
+    return kind(value)
+
+
+def _naive(parse, value):
+    # the database stores local times without an offset, and an aware value could
+    # not even be compared with the naive ones in the same flush
+    parsed = parse(value)
+    if parsed.tzinfo is not None:
+        raise ValueError(f"expected a local time without a UTC offset, got {value!r}")
+    return parsed
+
+
+# converts a JSON value to the python type of a column type
+_CONVERTERS = [
+    (DateTime, partial(_naive, datetime.fromisoformat)),
+    (Date, date.fromisoformat),
+    (Time, partial(_naive, time.fromisoformat)),
+    (Integer, partial(_number, int)),
+    (Float, partial(_number, float)),
+]
+
+# the check constraints of the upload tables, checked before a record is queued
+# (one record that breaks them in the database would fail the writer's whole batch)
+_CHECKS = {
+    "health_metrics": [
+        (column, lambda value: value >= 0, "must be >= 0")
+        for column in (
+            "heart_rate",
+            "steps_taken",
+            "stand_hours",
+            "systolic_bp",
+            "diastolic_bp",
+        )
+    ],
+    "sleep_log": [
+        ("duration", lambda value: value >= 0, "must be >= 0"),
+        ("quality", lambda value: 1 <= value <= 5, "must be between 1 and 5"),
+    ],
+    "workout_log": [
+        ("calories_burned", lambda value: value > 0, "must be > 0"),
+        ("heart_rate", lambda value: value > 0, "must be > 0"),
+    ],
+}
+
+
+def _converter(column):
+    for column_type, convert in _CONVERTERS:
+        if isinstance(column.type, column_type):
+            return convert
+    return lambda value: value
+
+
+# table name -> (column name, converter, nullable) of every column but id, built
+# once so parsing a record does not look at the column types again
+_FIELDS = {
+    name: [
+        (column.name, _converter(column), column.nullable)
+        for column in model.__table__.columns
+        if column.name != "id"
+    ]
+    for name, model in TABLES.items()
+}
+
+
+def parse_record(table_name, fields):
+    """
+    One JSON record -> a row (dictionary with every column but id) for
+    Ingestor.submit_rows(). Raises ValueError when it is invalid.
+    """
+    if not isinstance(fields, dict):
+        raise ValueError("a record must be an object")
+    row = {}
+    for name, convert, nullable in _FIELDS[table_name]:
+        value = fields.get(name)
+        if value is None:
+            if not nullable:
+                raise ValueError(f"{name} is required")
+            row[name] = None
+            continue
+        try:
+            row[name] = convert(value)
+        except (TypeError, ValueError) as exc:
+            raise ValueError(f"{name}: {exc}") from None
+    unknown = fields.keys() - row.keys()
+    if unknown:
+        raise ValueError(f"unknown fields {sorted(unknown)}")
+    for name, check, message in _CHECKS[table_name]:
+        if row[name] is not None and not check(row[name]):
+            raise ValueError(f"{name} {message}")
+    if table_name == "workout_log" and (row["user_workout_id"] is None) == (
+        row["recommendation_id"] is None
+    ):
+        raise ValueError("exactly one of user_workout_id and recommendation_id")
+    return row
+
+
+def parse_batch(request):
+    """
+    Parses a decoded request into (model, rows).
+    Raises ValueError with the position of the first bad record.
+    """
+    if not isinstance(request, dict) or request.get("table") not in TABLES:
+        raise ValueError(f"table must be one of {sorted(TABLES)}")
+    records = request.get("records")
+    if not isinstance(records, list):
+        raise ValueError("records must be a list")
+    rows = []
+    for position, fields in enumerate(records):
+        try:
+            rows.append(parse_record(request["table"], fields))
+        except ValueError as exc:
+            raise ValueError(f"record {position}: {exc}") from None
+    return TABLES[request["table"]], rows
+
+
+class IngestServer:
+    def __init__(self, ingestor, engine=None):
+        self.ingestor = ingestor
+        self.engine = engine or ingestor.engine
+        self.catalog = catalog_for(self.engine)
+        # ids known to exist
+        self._users = set()
+        self._user_workouts = set()
+        self._recommendations = set()
+        self.requests = self.refused = self.errors = 0
+
+    def _existing(self, column, ids):
+        # the ids found in the column (a primary key)
+        with self.engine.connect() as connection:
+            return set(
+                connection.execute(
+                    select(column).where(column.in_(list(ids)))
+                ).scalars()
+            )
+
+    def _existing_recommendations(self, ids):
+        recommendations = self.catalog.recommendations()
+        return {record_id for record_id in ids if record_id in recommendations}
+
+    async def _check_references(self, model, rows):
+        # ids the server has not seen yet are looked up off the event loop
+        references = [("user_id", self._users, partial(self._existing, User.id))]
+        if model.__tablename__ == "workout_log":
+            references += [
+                (
+                    "user_workout_id",
+                    self._user_workouts,
+                    partial(self._existing, UserWorkout.id),
+                ),
+                (
+                    "recommendation_id",
+                    self._recommendations,
+                    self._existing_recommendations,
+                ),
+            ]
+        loop = asyncio.get_running_loop()
+        for name, known, lookup in references:
+            unknown = {row[name] for row in rows if row[name] is not None} - known
+            if not unknown:
+                continue
+            known.update(await loop.run_in_executor(None, lookup, unknown))
+            for position, row in enumerate(rows):
+                if row[name] is not None and row[name] not in known:
+                    raise ValueError(f"record {position}: unknown {name} {row[name]}")
+
+    async def _submit(self, model, rows):
+        try:
+            # the common case: there is room, nothing blocks
+            return self.ingestor.submit_rows(model, rows, timeout=0)
+        except BufferFull:
+            # backpressure: wait for room in a thread, the loop keeps serving
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, self.ingestor.submit_rows, model, rows
+            )
+
+    async def handle_line(self, line):
+        # the reply (a dict) to one request line
+        self.requests += 1
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError as exc:
+                raise ValueError(f"invalid JSON: {exc}") from None
+            if isinstance(request, dict) and request.get("stats"):
+                return {"ok": True, "stats": self.ingestor.stats()._asdict()}
+            model, rows = parse_batch(request)
+            await self._check_references(model, rows)
+            receipt = await self._submit(model, rows)
+        except ValueError as exc:
+            self.refused += 1
+            return {"ok": False, "error": str(exc)}
+        except Exception as exc:
+            # the database or the Ingestor failed (eg. it was closed): the device
+            # gets a reply it can retry on, the connection stays open
+            self.errors += 1
+            return {"ok": False, "error": f"not queued: {exc}"}
+        return {"ok": True, "accepted": receipt.count}
+
+    async def handle(self, reader, writer):
+        # one connection: a reply per line until the device hangs up
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                reply = await self.handle_line(line)
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            # a broken connection or a line over LINE_LIMIT ends the connection
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8765):
+        return await asyncio.start_server(self.handle, host, port, limit=LINE_LIMIT)
+
+
+async def serve(host="127.0.0.1", port=8765, engine=None, **options):
+    """
+    Runs the server until Ctrl+C or SIGTERM (or until it is cancelled), then
+    commits what is buffered.
+    """
+    ingestor = Ingestor(engine or default_engine, **options)
+    server = await IngestServer(ingestor).start(host, port)
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, task.cancel)
+        except NotImplementedError:
+            pass  # Windows: Ctrl+C still raises KeyboardInterrupt
+    print(f"Ingesting on {host}:{port}", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        ingestor.close()
+        stats = ingestor.stats()
+        print(
+            f"{stats.rows} rows in {stats.flushes} flushes, "
+            f"{stats.avg_flush_ms:.1f} ms per flush, {stats.rows_per_second:,.0f} rows/sec"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Device ingest server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch", type=int, default=1000)
+    parser.add_argument("--max-delay", type=float, default=0.5, help="seconds")
+    parser.add_argument("--max-buffered", type=int, default=20000)
+    args = parser.parse_args()
+    try:
+        asyncio.run(
+            serve(
+                args.host,
+                args.port,
+                max_batch=args.max_batch,
+                max_delay=args.max_delay,
+                max_buffered=args.max_buffered,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
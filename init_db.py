@@ -1,3 +1,5 @@
+import os
+import warnings
 from sqlalchemy import (
     create_engine,
     Column,
@@ -6,23 +8,141 @@ from sqlalchemy import (
     Date,
     ForeignKey,
     Float,
+    Boolean,
     Time,
     CheckConstraint,
     DateTime,
+    LargeBinary,
     event,
     Index,
+    DDL,
+    UniqueConstraint,
+    inspect,
+    func,
+    select,
+    case,
+    Computed,
 )
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import relationship, backref, declarative_base
+from sqlalchemy.pool import QueuePool
+
+"""
+SQLite performance profiles. Every connection the engine opens runs the PRAGMAs of
+one named profile (through the connect hook below):
+
+ingest: bulk loads and device uploads. Large cache and synchronous=OFF, so commits do
+    not wait for the disk (a power cut can lose the last transactions).
+reporting: read heavy dashboards. Large cache and memory mapped reads.
+safe (default): every commit is flushed to disk before it returns.
+
+All profiles use WAL journaling, so readers do not block the writer and the writer
+does not block readers (device uploads and report reads no longer fight over the
+rollback journal). page_size only changes a new database (or after a VACUUM), so it
+is set before journal_mode.
+
+The profile is picked per process with the HEALTH_DB_PROFILE environment variable or
+set_profile(). cache_size is negative because SQLite then reads it as KiB.
+"""
+PROFILES = {
+    "ingest": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -262144,  # 256 MB
+        "mmap_size": 268435456,  # 256 MB
+        "temp_store": "MEMORY",
+        "busy_timeout": 10000,  # ms
+    },
+    "reporting": {
+        "page_size": 4096,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -131072,  # 128 MB
+        "mmap_size": 1073741824,  # 1 GB
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,  # ms
+    },
+    "safe": {
+        "page_size": 4096,
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -16384,  # 16 MB
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,  # ms
+    },
+}
+DEFAULT_PROFILE = "safe"
+profile = os.environ.get("HEALTH_DB_PROFILE", DEFAULT_PROFILE)
+
+
+# called with the new profile name by set_profile(), for the engines built outside
+# this module (the async engine in async_db.py)
+profile_listeners = []
+
+
+def set_profile(name):
+    # picks the profile for this process, connections opened from now on use it
+    global profile
+    if name not in PROFILES:
+        raise ValueError(f"unknown database profile: {name}")
+    profile = name
+    # connections already in the pool were opened with the old profile
+    engine.dispose()
+    for listener in profile_listeners:
+        listener(name)
+
+
+def apply_profile(dbapi_connection, name):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in PROFILES[name].items():
+        cursor.execute(f"PRAGMA {pragma}={value};")
+    cursor.close()
 
-engine = create_engine("sqlite:///health_database.db")
 
+"""
+Connection pool for file databases. Each thread (or request) checks a connection out
+of the pool and gives it back when its session closes, so pool_size is the number of
+threads that can use the database at once without opening new connections.
+max_overflow extra connections can be opened under load, and a caller waits up to
+pool_timeout seconds before giving up. In memory databases keep SQLAlchemy's default
+single connection pool (each connection would otherwise be a separate database).
+"""
+POOL_OPTIONS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,  # seconds
+}
 
-# enable foreign key support for sqlite
-@event.listens_for(engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON;")
-    cursor.close()
+
+def create_health_engine(url, profile_name=None, **pool_options):
+    """
+    Creates an engine with foreign keys enabled and a performance profile applied to
+    every connection. Without profile_name the process wide profile is used.
+    pool_options override POOL_OPTIONS for file databases.
+    """
+    if make_url(url).database in (None, "", ":memory:"):
+        new_engine = create_engine(url)
+    else:
+        options = {**POOL_OPTIONS, **pool_options}
+        new_engine = create_engine(url, poolclass=QueuePool, **options)
+
+    # enable foreign key support for sqlite
+    @event.listens_for(new_engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON;")
+        cursor.close()
+        apply_profile(dbapi_connection, profile_name or profile)
+
+    return new_engine
+
+
+if profile not in PROFILES:
+    raise ValueError(f"unknown database profile: {profile}")
+engine = create_health_engine("sqlite:///health_database.db")
 
 
 Base = declarative_base()
@@ -78,7 +198,59 @@ class HealthMetric(Base):
     # Create a composite index on user_id and timestamp
     # many of the tables have composite indexes with user_id and date because
     # habit tracking is often done by day or time period
-    Index("idx_healthmetrics_userid_timestamp", "user_id", "timestamp")
+    # (indexes must go through __table_args__ or create_all never builds them)
+    # it is unique: a device sends one reading per user per timestamp, so a re-sent
+    # upload can be skipped or updated by an upsert (see upsert.py)
+    __table_args__ = (
+        Index(
+            "idx_healthmetrics_userid_timestamp", "user_id", "timestamp", unique=True
+        ),
+    )
+
+
+# health metric aggregates are the readings older than the retention period (see
+# retention.py) rolled into one row per user per hour, then per day
+# each metric keeps its min, max, average and the number of readings that had it,
+# so buckets can be merged into exact averages over any longer range
+class MetricAggregates:
+    reading_count = Column(Integer, CheckConstraint("reading_count>=0"), default=0)
+    heart_rate_min = Column(Integer)
+    heart_rate_max = Column(Integer)
+    heart_rate_avg = Column(Float)
+    heart_rate_count = Column(Integer, default=0)
+    steps_taken_min = Column(Integer)
+    steps_taken_max = Column(Integer)
+    steps_taken_avg = Column(Float)
+    steps_taken_count = Column(Integer, default=0)
+    stand_hours_min = Column(Integer)
+    stand_hours_max = Column(Integer)
+    stand_hours_avg = Column(Float)
+    stand_hours_count = Column(Integer, default=0)
+    systolic_bp_min = Column(Integer)
+    systolic_bp_max = Column(Integer)
+    systolic_bp_avg = Column(Float)
+    systolic_bp_count = Column(Integer, default=0)
+    diastolic_bp_min = Column(Integer)
+    diastolic_bp_max = Column(Integer)
+    diastolic_bp_avg = Column(Float)
+    diastolic_bp_count = Column(Integer, default=0)
+
+
+class HealthMetricHourly(MetricAggregates, Base):
+    __tablename__ = "health_metrics_hourly"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    hour = Column(DateTime, nullable=False)  # start of the hour
+    # one row per user per hour, also the (user_id, hour) index reads search by
+    __table_args__ = (UniqueConstraint("user_id", "hour"),)
+
+
+class HealthMetricDaily(MetricAggregates, Base):
+    __tablename__ = "health_metrics_daily"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    __table_args__ = (UniqueConstraint("user_id", "day"),)
 
 
 # sleep log table tracks sleep habits and quality for users
@@ -103,7 +275,10 @@ class SleepLog(Base):
     date = Column(Date, nullable=False)
 
     # Create a composite index on user_id and date
-    Index("idx_sleeplog_userid_date", "user_id", "date")
+    # unique, one sleep record per user per night (the key upserts match on)
+    __table_args__ = (
+        Index("idx_sleeplog_userid_date", "user_id", "date", unique=True),
+    )
 
 
 # food table defines the food options available to users (new options can be added)
@@ -135,7 +310,7 @@ class FoodLog(Base):
     time = Column(Time)
 
     # Create a composite index on user_id and date
-    Index("idx_foodlog_userid_date", "user_id", "date")
+    __table_args__ = (Index("idx_foodlog_userid_date", "user_id", "date"),)
 
 
 # workout log tracks workouts completed by user and their stats
@@ -166,14 +341,14 @@ class WorkoutLog(Base):
             "(user_workout_id IS NOT NULL AND recommendation_id IS NULL)",
             name="chk_workout_recommendation_exclusive",
         ),
+        # composite key to help get user's workouts on/between a specific date
+        Index("idx_workoutlog_userid_date", "user_id", "date"),
     )
     # backrefs to make it easier to express relationship to the 2 workout tables
     workout_recommendation = relationship(
         "WorkoutRecommendation", backref="workout_log"
     )
     user_workout = relationship("UserWorkout", backref="workout_log")
-    # composite key to help get user's workouts on/between a specific date
-    Index("idx_workoutlog_userid_date", "user_id", "date")
 
 
 # user workout table holds workouts the USER defines
@@ -226,6 +401,18 @@ class WorkoutRecommendation(Base):
     )  # 1 = easy, 2 = medium, 3 = hard
 
 
+# the length classes of goals in days (Goal.span_class), each twice the one before
+GOAL_SPANS = (8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _span_class(start_date, end_date):
+    days = func.julianday(end_date) - func.julianday(start_date)
+    return case(
+        *[(days <= span, k) for k, span in enumerate(GOAL_SPANS)],
+        else_=len(GOAL_SPANS),
+    )
+
+
 # goal table tracks details of user goals and their status
 class Goal(Base):
     __tablename__ = "goals"
@@ -240,14 +427,219 @@ class Goal(Base):
     goal_type = Column(
         Integer, CheckConstraint("goal_type IN (1,2,3)")
     )  # 1 = sleep, 2 = nutrition, 3 = workout
+    # the measurable target of the goal (see goals.py), by goal type:
+    # sleep = hours per night (at least), nutrition = calories per day (at most),
+    # workout = workouts per week (at least); NULL uses the type's default target
+    target = Column(Float, CheckConstraint("target>0"))
+    # interval index: the goal's length class, 0 for goals of up to GOAL_SPANS[0] days,
+    # 1 for up to GOAL_SPANS[1] days etc. (longer goals get len(GOAL_SPANS)).
+    # A goal of class k that overlaps a date range starts at most GOAL_SPANS[k] days
+    # before the range, so "goals active on a day" is one short range of the
+    # (span_class, start_date, end_date) index per class instead of a scan (end_date
+    # is in the index so the goals that ended are skipped there, see goals.py).
+    # SQLite generates it from the dates, so every writer keeps it current
+    span_class = Column(Integer, Computed(_span_class(start_date, end_date)))
 
     __table_args__ = (
         # check goal starts before the end date
         CheckConstraint(start_date < end_date, name="check_start_date_before_end_date"),
+        # Create a composite index on user_id and end_date because people
+        # will want to query the goal status (indicated by whether the end date as passed)
+        Index("idx_user_id_end_date", "user_id", "end_date"),
+        # goals active on a date or overlapping a date range, for every user
+        Index("idx_goals_span_class", "span_class", "start_date", "end_date"),
+    )
+
+
+# progress of every goal towards its target, written by the nightly evaluation in
+# goals.py (one set based pass over every goal in progress)
+class GoalProgress(Base):
+    __tablename__ = "goal_progress"
+    goal_id = Column(
+        Integer, ForeignKey("goals.id", ondelete="CASCADE"), primary_key=True
+    )
+    user_id = Column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+    )
+    as_of = Column(Date, nullable=False)  # the last day counted
+    days = Column(Integer, nullable=False)  # days of the goal counted so far
+    # sleep hours per night, calories per day or workouts per week so far
+    # (NULL when nothing was logged that counts)
+    value = Column(Float)
+    target = Column(Float, nullable=False)
+    met = Column(Boolean, nullable=False)
+
+
+# daily user summary is a rollup of the log tables with one row per user per day
+# reports read a few of these small rows instead of scanning and joining the raw logs
+# it is kept up to date by daily_summary.py (see that module for how)
+class DailyUserSummary(Base):
+    __tablename__ = "daily_user_summary"
+    # the composite PK doubles as the (user_id, date) index the reports search by
+    # the rows are derived data, so they go away with their user
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    date = Column(Date, primary_key=True)
+    # health metrics: number of uploads that day and the average of each metric
+    # the count lets reports combine days into an exact average over a window
+    metric_count = Column(Integer, CheckConstraint("metric_count>=0"), default=0)
+    avg_heart_rate = Column(Float)
+    avg_steps_taken = Column(Float)
+    avg_stand_hours = Column(Float)
+    avg_systolic_bp = Column(Float)
+    avg_diastolic_bp = Column(Float)
+    # readings that have each metric (a reading can leave some out), the weights of
+    # the averages above when days are combined
+    heart_rate_count = Column(Integer, default=0)
+    steps_taken_count = Column(Integer, default=0)
+    stand_hours_count = Column(Integer, default=0)
+    systolic_bp_count = Column(Integer, default=0)
+    diastolic_bp_count = Column(Integer, default=0)
+    # sleep: number of records and their average duration (hours) and quality
+    sleep_count = Column(Integer, CheckConstraint("sleep_count>=0"), default=0)
+    sleep_duration = Column(Float)
+    sleep_quality = Column(Float)
+    # nutrition and workouts (calories are NULL on days without entries)
+    calories_in = Column(Integer)
+    calories_burned = Column(Float)
+    workout_count = Column(Integer, CheckConstraint("workout_count>=0"), default=0)
+
+
+# quantile sketches (t-digests, see quantiles.py) of each day's heart rate and blood
+# pressure readings, one row per user per day, so percentiles over any date range or
+# cohort merge a few small sketches instead of sorting the raw readings
+class DailyMetricSketch(Base):
+    __tablename__ = "daily_metric_sketch"
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
     )
-    # Create a composite index on user_id and end_date because people
-    # will want to query the goal status (indicated by whether the end date as passed)
-    __table_args__ = (Index("idx_user_id_end_date", "user_id", "end_date"),)
+    date = Column(Date, primary_key=True)
+    # serialized sketches, NULL when the day has no reading of the metric
+    heart_rate = Column(LargeBinary)
+    systolic_bp = Column(LargeBinary)
+    diastolic_bp = Column(LargeBinary)
 
 
+# catalog version counts the changes to each reference table (food and workout
+# recommendations), so the in memory catalogs (catalog.py) can tell when to reload
+# the counters are bumped by triggers, so every writer counts, even bulk inserts and
+# other processes
+class CatalogVersion(Base):
+    __tablename__ = "catalog_version"
+    name = Column(String(50), primary_key=True)  # table name
+    version = Column(Integer, nullable=False, default=0)
+
+
+CATALOG_TABLES = (Food.__tablename__, WorkoutRecommendation.__tablename__)
+
+
+def catalog_triggers(table_name):
+    # one trigger per kind of change, each adds one to the table's version
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table_name}_{operation.lower()}_version "
+        f"AFTER {operation} ON {table_name} BEGIN "
+        f"INSERT INTO catalog_version (name, version) VALUES ('{table_name}', 1) "
+        f"ON CONFLICT (name) DO UPDATE SET version = version + 1; END"
+        for operation in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+for table_name in CATALOG_TABLES:
+    for statement in catalog_triggers(table_name):
+        event.listen(Base.metadata.tables[table_name], "after_create", DDL(statement))
+
+
+def upgrade_columns(engine):
+    """
+    Adds the columns declared after a database was built (create_all skips the
+    tables that exist). Only nullable columns can be added this way, ALTER TABLE
+    leaves them NULL in the existing rows (generated columns are computed for them).
+    Returns {table name: names of the columns added}.
+    """
+    added = {}
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            definition = CreateColumn(column).compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN {definition}"
+                )
+            added.setdefault(table.name, []).append(column.name)
+    return added
+
+
+# the tables of an existing database, to tell which ones create_all adds below
+existing_tables = set(inspect(engine).get_table_names())
 Base.metadata.create_all(engine)
+# new columns go in before the indexes below, some of them index the new columns
+added_columns = upgrade_columns(engine)
+# create_all skips tables that already exist, so databases built before an index
+# was declared would never get it. checkfirst only builds the missing ones.
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+# the same goes for the catalog triggers (they are created IF NOT EXISTS)
+with engine.begin() as connection:
+    for table_name in CATALOG_TABLES:
+        for statement in catalog_triggers(table_name):
+            connection.exec_driver_sql(statement)
+
+
+def upgrade_unique_indexes(engine):
+    """
+    Rebuilds the indexes that were declared unique after a database was built (the
+    old index has the same name, so checkfirst keeps it as it is). A table that
+    already holds duplicate keys keeps its old index and a warning is shown, the
+    duplicates have to be removed first.
+    Runs on every start, so once every index is unique it is one query of the schema
+    and the tables are not scanned again.
+    """
+    with engine.connect() as connection:
+        unique_names = set(
+            connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'index' AND sql LIKE 'CREATE UNIQUE INDEX%'"
+            ).scalars()
+        )
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if not index.unique or index.name in unique_names:
+                continue
+            columns = list(index.columns)
+            with engine.begin() as connection:
+                duplicate = connection.execute(
+                    select(*columns).group_by(*columns).having(func.count() > 1)
+                ).first()
+                if duplicate is not None:
+                    warnings.warn(
+                        f"{table.name} has duplicate keys, "
+                        f"{index.name} is not unique yet"
+                    )
+                    continue
+                index.drop(connection)
+                index.create(connection)
+
+
+upgrade_unique_indexes(engine)
+
+# a database built before the daily summary rollup (or the quantile sketches) gets
+# them computed from its whole history when the tables are added, the reports only
+# read the rollup and would show nothing. The same goes for new rollup columns, they
+# are NULL in the rows built before them
+rollup_tables = {DailyUserSummary.__tablename__, DailyMetricSketch.__tablename__}
+if User.__tablename__ in existing_tables and (
+    not rollup_tables <= existing_tables or rollup_tables & added_columns.keys()
+):
+    import daily_summary  # imported here, daily_summary imports this module
+
+    daily_summary.backfill(engine)
@@ -0,0 +1,264 @@
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite
+from catalog import catalog_for
+from data_generator import DataGenerator
+from seeding import (
+    SeedStats,
+    load_goal_progress,
+    load_summary,
+    next_id,
+    report_stats,
+    seed_catalog,
+)
+from init_db import (
+    engine as default_engine,
+    Base,
+    User,
+    HealthMetric,
+    SleepLog,
+    FoodLog,
+    UserWorkout,
+    WorkoutLog,
+    Goal,
+)
+
+"""
+Parallel version of the seeding engine for very large test databases.
+
+Building rows is CPU bound, so one python process can only go so fast. Here the
+users are split into ranges of user ids ("tasks") and a process pool builds the rows
+for each range at the same time. SQLite only allows one writer, so the writes stay in
+one place. There are two ways to do the writing:
+
+1. writer (default): the workers send their rows back and the main process inserts
+   them, one transaction per task. The workers also convert every value into the
+   form the sqlite driver stores (eg. datetimes to strings), so the writer only has
+   to call executemany.
+2. shards: every worker writes its rows into its own temporary SQLite file. The main
+   process then attaches each shard and copies it in with INSERT ... SELECT, which
+   runs entirely inside SQLite. This scales best with the number of cores.
+
+Ids that other rows point to are decided before the workers start: users get
+consecutive ids by range, and every task gets its own block of user workout ids
+(large enough for one new workout per user per day), so no two workers can collide.
+The blocks can leave gaps in the user_workout ids, which is harmless.
+"""
+
+# the tables a task fills, in the order they are written (parents first)
+_USER_TABLES = [User, HealthMetric, SleepLog, FoodLog, UserWorkout, WorkoutLog, Goal]
+# tables whose ids are assigned by the seeder, the others get new autoincrement ids
+_KEEP_IDS = {User.__tablename__, UserWorkout.__tablename__}
+
+_dialect = sqlite.dialect()
+
+
+def _driver_rows(table, columns):
+    """
+    Converts a column batch to the INSERT statement and the list of tuples the sqlite
+    driver expects, applying each column type's bind processor (the same conversion
+    SQLAlchemy does when it runs the insert itself).
+    """
+    keys = list(columns)
+    statement = str(table.insert().compile(dialect=_dialect, column_keys=keys))
+    values = []
+    for key in keys:
+        processor = table.c[key].type.dialect_impl(_dialect).bind_processor(_dialect)
+        column = columns[key]
+        values.append([processor(v) for v in column] if processor else column)
+    return statement, list(zip(*values))
+
+
+def _build_task(task):
+    """
+    Runs in a worker process: builds every row for one range of users.
+    Returns {table name: (statement, rows)}, or writes the rows to a shard file
+    and returns its path when the task has a shard path.
+    """
+    generator = DataGenerator(task["seed"], pool_seed=task["pool_seed"])
+    user_ids = range(task["first_user"], task["last_user"])
+    start_date = task["start_date"]
+    days = task["days"]
+    user_workouts, logs = generator.workouts(
+        user_ids, start_date, days, task["recommendation_ids"], task["first_workout_id"]
+    )
+    columns = {
+        User.__tablename__: generator.users(user_ids),
+        HealthMetric.__tablename__: generator.health_metrics(
+            user_ids, start_date, days, task["readings_per_day"]
+        ),
+        SleepLog.__tablename__: generator.sleep(user_ids, start_date, days),
+        UserWorkout.__tablename__: user_workouts,
+        WorkoutLog.__tablename__: logs,
+        Goal.__tablename__: generator.goals(user_ids, task["goals_per_user"]),
+    }
+    if task["food_ids"]:
+        columns[FoodLog.__tablename__] = generator.food_log(
+            user_ids, start_date, days, task["food_entries_per_day"], task["food_ids"]
+        )
+    batches = {
+        model.__tablename__: _driver_rows(model.__table__, columns[model.__tablename__])
+        for model in _USER_TABLES
+        if model.__tablename__ in columns
+    }
+    if not task["shard"]:
+        return batches
+
+    # shard files skip the safety settings, they are thrown away after the merge
+    shard_engine = create_engine(f"sqlite:///{task['shard']}")
+    Base.metadata.create_all(shard_engine)
+    with shard_engine.begin() as connection:
+        connection.exec_driver_sql("PRAGMA synchronous=OFF")
+        for name, (statement, rows) in batches.items():
+            if rows:
+                connection.exec_driver_sql(statement, rows)
+    shard_engine.dispose()
+    return task["shard"]
+
+
+def _write_batches(connection, batches, counts):
+    for name, (statement, rows) in batches.items():
+        if rows:
+            connection.exec_driver_sql(statement, rows)
+        counts[name] += len(rows)
+
+
+def _merge_shard(engine, path, counts):
+    # copies a shard into the main database with INSERT ... SELECT
+    with engine.connect() as connection:
+        # ATTACH is not allowed inside a transaction, so it runs before any insert
+        connection.exec_driver_sql("ATTACH DATABASE ? AS shard", (path,))
+        try:
+            for model in _USER_TABLES:
+                table = model.__table__
+                # generated columns (Goal.span_class) are computed by the main
+                # database, they cannot be inserted
+                names = [
+                    column.name
+                    for column in table.columns
+                    if (column.name != "id" or table.name in _KEEP_IDS)
+                    and column.computed is None
+                ]
+                column_list = ", ".join(names)
+                result = connection.exec_driver_sql(
+                    f"INSERT INTO main.{table.name} ({column_list}) "
+                    f"SELECT {column_list} FROM shard.{table.name} ORDER BY id"
+                )
+                counts[table.name] += result.rowcount
+            connection.commit()
+        finally:
+            connection.rollback()
+            connection.exec_driver_sql("DETACH DATABASE shard")
+
+
+def parallel_seed(
+    engine=None,
+    users=25,
+    days=30,
+    readings_per_day=1,
+    food_entries_per_day=3,
+    goals_per_user=2,
+    foods=60,
+    recommendations=50,
+    workers=None,
+    users_per_task=500,
+    shards=False,
+    batch_size=10000,
+    random_seed=None,
+    report=print,
+):
+    """
+    Fills the database like seeding.seed(), building the user rows in `workers`
+    processes (default: one per core). Set shards=True to have the workers write
+    their own SQLite files that are merged in at the end. batch_size is used like in
+    seed() for the catalog tables and the goal progress.
+    Returns a SeedStats for each table.
+    """
+    engine = engine or default_engine
+    workers = workers or os.cpu_count() or 1
+    start_date = datetime.now().date() - timedelta(days=days)
+    stats = seed_catalog(
+        engine, DataGenerator(random_seed), foods, recommendations, batch_size, report
+    )
+
+    catalog = catalog_for(engine)
+    food_ids = list(catalog.foods().ids)
+    recommendation_ids = list(catalog.recommendations().ids)
+    with engine.connect() as connection:
+        first_user = next_id(connection, User)
+        first_workout_id = next_id(connection, UserWorkout)
+
+    # one independent random stream per task, reproducible from random_seed
+    task_count = -(-users // users_per_task)
+    task_seeds = np.random.SeedSequence(random_seed).spawn(task_count)
+    shard_dir = tempfile.mkdtemp(prefix="health_shards_") if shards else None
+    tasks = []
+    for i in range(task_count):
+        first = first_user + i * users_per_task
+        last = min(first + users_per_task, first_user + users)
+        tasks.append(
+            {
+                "seed": task_seeds[i],
+                "pool_seed": 0 if random_seed is None else random_seed,
+                "first_user": first,
+                "last_user": last,
+                "first_workout_id": first_workout_id + i * users_per_task * days,
+                "start_date": start_date,
+                "days": days,
+                "readings_per_day": readings_per_day,
+                "food_entries_per_day": food_entries_per_day,
+                "goals_per_user": goals_per_user,
+                "food_ids": food_ids,
+                "recommendation_ids": recommendation_ids,
+                "shard": os.path.join(shard_dir, f"shard_{i}.db") if shards else None,
+            }
+        )
+
+    counts = {model.__tablename__: 0 for model in _USER_TABLES}
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # only a few tasks are in flight at a time so finished batches waiting
+            # for the writer cannot use up all of the memory
+            pending = deque()
+            remaining = iter(tasks)
+            for task in remaining:
+                pending.append(pool.submit(_build_task, task))
+                if len(pending) >= 2 * workers:
+                    break
+            while pending:
+                result = pending.popleft().result()
+                for task in remaining:
+                    pending.append(pool.submit(_build_task, task))
+                    break
+                # results are written in task order, so rows go in by user id
+                if shards:
+                    _merge_shard(engine, result, counts)
+                    os.remove(result)
+                else:
+                    with engine.begin() as connection:
+                        _write_batches(connection, result, counts)
+    finally:
+        if shard_dir:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    # every table is written in the same pass, so they share the elapsed time
+    seconds = time.perf_counter() - start
+    for model in _USER_TABLES:
+        item = SeedStats(model.__tablename__, counts[model.__tablename__], seconds)
+        if report:
+            report_stats(report, item)
+        stats.append(item)
+    user_ids = range(first_user, first_user + users)
+    stats.append(
+        load_summary(engine, user_ids, start_date, start_date + timedelta(days), report)
+    )
+    stats.append(load_goal_progress(engine, batch_size, report))
+    return stats
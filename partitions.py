@@ -0,0 +1,301 @@
+import argparse
+import re
+from datetime import date, datetime, time
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    case,
+    delete,
+    func,
+    null,
+    select,
+    union_all,
+)
+from sqlalchemy.dialects.sqlite import insert
+from init_db import engine as default_engine, HealthMetric
+from helpers import as_datetime, for_users
+
+"""
+Monthly partitions for the health metrics.
+
+Devices upload health metrics for every user forever, so health_metrics and its
+(user_id, timestamp) index keep growing while the reports only read the last few weeks.
+Here whole months of readings are moved out of health_metrics into one table per month
+(health_metrics_2023_11 etc) in the same database file:
+
+- health_metrics keeps the months that are not archived yet (by default the current
+  month), so it stays small and every write still goes to one place
+- each partition has the same columns and its own (user_id, timestamp) index, and the
+  rows keep their ids (ids are only unique per table: once health_metrics is empty,
+  SQLite can hand out an archived id again, such a row gets a new id in the partition)
+- a reading re-sent after its month was archived is caught by upsert.py, which
+  checks the partition of the month before writing to health_metrics and skips (or
+  overwrites in the partition) a reading that is already there. A reading written to
+  health_metrics some other way is moved over the archived reading with the same
+  (user_id, timestamp) when its month is archived again, like upsert(update=True)
+
+The router (health_metrics_between) turns a timestamp window into a UNION ALL of
+health_metrics and the partitions that overlap the window, with the filters inside
+every branch so each one searches its own index. It does not de-duplicate the
+branches on (user_id, timestamp): that would take a sort or a probe of every
+partition for every row read, while the writes (upsert.py) already keep each reading
+in one table. A 30 day window reads health_metrics
+and at most one or two partitions, never the years of history. The daily summary
+rebuild (daily_summary.py) reads through the router, so rebuilding archived days works.
+
+Commands (MONTH is YYYY-MM):
+python3 partitions.py list
+python3 partitions.py archive [--before MONTH]   move every month before MONTH (default:
+                                                 the current month) into partitions
+python3 partitions.py create MONTH               create an empty partition
+python3 partitions.py compact MONTH              rebuild a partition and its index
+python3 partitions.py drop MONTH                 delete a partition and its readings
+"""
+
+PARTITION_PREFIX = "health_metrics_"
+# the natural key of health_metrics (upsert.UNIQUE_KEYS), unique in every partition
+_KEY = ("user_id", "timestamp")
+_PARTITION_PATTERN = re.compile(r"^health_metrics_(\d{4})_(\d{2})$")
+
+# the partition tables are created by these commands, not by init_db's create_all
+_metadata = MetaData()
+# stands in for the users table so the partitions can keep the foreign key
+Table("users", _metadata, Column("id", Integer, primary_key=True))
+
+
+def month_start(value):
+    # first day of the month of a date or datetime
+    return date(value.year, value.month, 1)
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def parse_month(text):
+    # "2023-11" -> date(2023, 11, 1)
+    return datetime.strptime(text, "%Y-%m").date()
+
+
+def partition_name(month):
+    return f"{PARTITION_PREFIX}{month.year:04d}_{month.month:02d}"
+
+
+def partition_table(month):
+    """
+    The Table of a month's partition: the columns of health_metrics and its unique
+    (user_id, timestamp) index. The check constraints are not copied, the rows were
+    checked when they were written to health_metrics.
+    """
+    name = partition_name(month)
+    table = _metadata.tables.get(name)
+    if table is None:
+        columns = []
+        for column in HealthMetric.__table__.columns:
+            foreign_keys = [
+                ForeignKey(key.target_fullname) for key in column.foreign_keys
+            ]
+            columns.append(
+                Column(
+                    column.name,
+                    column.type,
+                    *foreign_keys,
+                    primary_key=column.primary_key,
+                    nullable=column.nullable,
+                )
+            )
+        table = Table(
+            name,
+            _metadata,
+            *columns,
+            Index(f"idx_{name}_userid_timestamp", *_KEY, unique=True),
+        )
+    return table
+
+
+def list_partitions(connection):
+    # the months that have a partition, oldest first
+    names = connection.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ).scalars()
+    months = []
+    for name in names:
+        match = _PARTITION_PATTERN.match(name)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def _month_bounds(month):
+    # [start, end) of a month as datetimes, the form the timestamps are compared in
+    return datetime.combine(month, time.min), datetime.combine(
+        next_month(month), time.min
+    )
+
+
+### ROUTER ###
+def partitions_between(connection, start, end):
+    # the partitions that can hold readings with start <= timestamp < end
+    first = month_start(start)
+    end = as_datetime(end)
+    return [
+        month
+        for month in list_partitions(connection)
+        if first <= month and as_datetime(month) < end
+    ]
+
+
+def _window(table, start, end, user_ids):
+    query = select(*table.columns).where(
+        table.c.timestamp >= start, table.c.timestamp < end
+    )
+    return for_users(query, table.c.user_id, user_ids)
+
+
+def health_metrics_between(connection, start, end, user_ids=None):
+    """
+    The health metric readings with start <= timestamp < end (datetimes) of every user
+    (or the given user ids), from health_metrics and the partitions that overlap the
+    window. Returns a subquery with the columns of health_metrics.
+    """
+    start, end = as_datetime(start), as_datetime(end)
+    parts = [
+        _window(table, start, end, user_ids)
+        for table in tables_between(connection, start, end)
+    ]
+    if len(parts) == 1:
+        return parts[0].subquery("health_metrics_window")
+    return union_all(*parts).subquery("health_metrics_window")
+
+
+def tables_between(connection, start, end):
+    # health_metrics and the partition tables a window reads
+    return [HealthMetric.__table__] + [
+        partition_table(month) for month in partitions_between(connection, start, end)
+    ]
+
+
+### COMMANDS ###
+def create_partition(engine, month):
+    # creates an empty partition for a month (nothing happens if it exists)
+    partition_table(month_start(month)).create(engine, checkfirst=True)
+
+
+def archive_month(engine, month):
+    """
+    Moves one month of readings from health_metrics into its partition, in one
+    transaction. Returns the number of rows moved.
+    """
+    month = month_start(month)
+    table = partition_table(month)
+    start, end = _month_bounds(month)
+    source = HealthMetric.__table__
+    in_month = (source.c.timestamp >= start, source.c.timestamp < end)
+    # an id the partition already holds (handed out again by health_metrics) is left
+    # NULL, so the partition gives the row a new one
+    taken = select(table.c.id).where(table.c.id == source.c.id).exists()
+    columns = [
+        case((taken, null()), else_=column) if column.name == "id" else column
+        for column in source.columns
+    ]
+    with engine.begin() as connection:
+        table.create(connection, checkfirst=True)
+        # rows go in by user and time, the order the partition index is read in
+        statement = insert(table).from_select(
+            [column.name for column in source.columns],
+            select(*columns)
+            .where(*in_month)
+            .order_by(source.c.user_id, source.c.timestamp),
+        )
+        # a reading that is already archived (written to health_metrics without
+        # upsert.py after the last archive) is overwritten with the newer values
+        statement = statement.on_conflict_do_update(
+            index_elements=_KEY,
+            set_={
+                column.name: statement.excluded[column.name]
+                for column in source.columns
+                if column.name not in _KEY and not column.primary_key
+            },
+        )
+        result = connection.execute(statement)
+        connection.execute(delete(source).where(*in_month))
+        return result.rowcount
+
+
+def archive(engine=None, before=None):
+    """
+    Moves every month of readings before the month of `before` (default: the current
+    month) into partitions. Returns {month: rows moved}.
+    """
+    engine = engine or default_engine
+    before = month_start(before or date.today())
+    with engine.connect() as connection:
+        oldest = connection.execute(
+            select(HealthMetric.timestamp).order_by(HealthMetric.timestamp).limit(1)
+        ).scalar()
+    moved = {}
+    month = month_start(oldest) if oldest else before
+    while month < before:
+        moved[month] = archive_month(engine, month)
+        month = next_month(month)
+    return moved
+
+
+def drop_partition(engine, month):
+    # deletes a partition with all of its readings
+    partition_table(month_start(month)).drop(engine, checkfirst=True)
+
+
+def compact_partition(engine, month):
+    """
+    Rebuilds a partition (after deletes, eg. by the retention job) so its table and
+    index pages are full and in order again. The space freed inside the database file
+    is reused by later writes, run VACUUM to give it back to the file system.
+    """
+    month = month_start(month)
+    table = partition_table(month)
+    name = partition_name(month)
+    with engine.begin() as connection:
+        # the old table is renamed and its index dropped, so the new one can take
+        # both names
+        connection.exec_driver_sql(f"ALTER TABLE {name} RENAME TO {name}_old")
+        connection.exec_driver_sql(f"DROP INDEX idx_{name}_userid_timestamp")
+        table.create(connection)
+        # inserted in index order, so the index is built by appending to it
+        result = connection.exec_driver_sql(
+            f"INSERT INTO {name} SELECT * FROM {name}_old ORDER BY user_id, timestamp"
+        )
+        connection.exec_driver_sql(f"DROP TABLE {name}_old")
+        return result.rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the health metric partitions")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list")
+    archive_parser = commands.add_parser("archive")
+    archive_parser.add_argument("--before", type=parse_month, help="YYYY-MM")
+    for name in ("create", "drop", "compact"):
+        commands.add_parser(name).add_argument("month", type=parse_month)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        with default_engine.connect() as connection:
+            for month in list_partitions(connection):
+                table = partition_table(month)
+                count = connection.execute(select(func.count()).select_from(table))
+                print(f"{partition_name(month)}: {count.scalar()} readings")
+    elif args.command == "archive":
+        for month, rows in archive(before=args.before).items():
+            print(f"{partition_name(month)}: moved {rows} readings")
+    elif args.command == "create":
+        create_partition(default_engine, args.month)
+    elif args.command == "drop":
+        drop_partition(default_engine, args.month)
+    elif args.command == "compact":
+        rows = compact_partition(default_engine, args.month)
+        print(f"{partition_name(args.month)}: rebuilt with {rows} readings")
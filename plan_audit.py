@@ -0,0 +1,213 @@
+import re
+import sys
+from collections import namedtuple
+from datetime import datetime, timedelta
+from init_db import Base, engine as default_engine
+import reports
+import goals
+
+"""
+Query plan audit for the report queries in reports.py and goals.py (used by
+query_data.py).
+
+Every query is run through SQLite's EXPLAIN QUERY PLAN. A plan line such as
+"SCAN health_metrics" means SQLite reads the whole table, while
+"SEARCH health_metrics USING INDEX idx_healthmetrics_userid_timestamp (...)" means
+it jumps straight to the rows it needs through an index.
+
+The per user queries are "hot": they run every time a user opens a report, so they
+must never fall back to a full table scan. The fleet wide queries (most popular food,
+best sleeper etc) read every row by design, so their plans are reported but they do
+not fail the audit.
+
+Run from the command line to print every plan: python3 plan_audit.py
+The exit code is 1 if any hot query scans a table.
+"""
+
+# result of auditing one query
+PlanResult = namedtuple("PlanResult", ["name", "hot", "plan", "scans"])
+
+
+class PlanRegression(Exception):
+    # raised when a hot report query falls back to a full table scan
+    pass
+
+
+# matches "SCAN health_metrics" and older versions of sqlite "SCAN TABLE health_metrics"
+# (also matches "SCAN x USING INDEX", which still walks the whole index)
+_SCAN_PATTERN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+
+
+def report_queries(connection, user_id=1, today=None):
+    """
+    (name, statement, hot) for every report query in query_data.py. The connection
+    is only read to find the partitions the health metric queries go through.
+    The parameter values only need to be realistic, the plan does not depend on them.
+    """
+    today = today or datetime.now().date()
+    start_30 = today - timedelta(days=30)
+    start_7 = today - timedelta(days=7)
+    return [
+        (
+            "avg_health_metrics",
+            reports.avg_health_metrics_query(connection, user_id, start_30),
+            True,
+        ),
+        (
+            "avg_steps",
+            reports.avg_steps_query(connection, user_id, start_7),
+            True,
+        ),
+        ("avg_sleep", reports.avg_sleep_query(user_id, start_30, today), True),
+        ("best_sleeper", reports.best_sleeper_query(start_30), False),
+        ("most_popular_foods", reports.most_popular_foods_query(3), False),
+        ("foods_eaten_on", reports.foods_eaten_on_query(user_id, today), True),
+        (
+            "food_category_count",
+            reports.food_category_count_query(user_id, 4, start_7, today),
+            True,
+        ),
+        ("calories_on", reports.calories_on_query(user_id, today), True),
+        (
+            "avg_daily_calories",
+            reports.avg_daily_calories_query(user_id, start_30),
+            True,
+        ),
+        (
+            "workout_recommendations",
+            reports.workout_recommendations_query(1, 1, 0.75),
+            True,
+        ),
+        (
+            "recommendation_type_count",
+            reports.recommendation_type_count_query(2),
+            False,
+        ),
+        (
+            "most_frequent_recommendation",
+            reports.most_frequent_recommendation_query(),
+            False,
+        ),
+        ("workout_count", reports.workout_count_query(user_id, start_7, today), True),
+        ("calories_burned_on", reports.calories_burned_on_query(user_id, today), True),
+        ("user_created_workout", reports.user_created_workout_query(user_id), True),
+        (
+            "completed_goal_count",
+            reports.completed_goal_count_query(user_id, today),
+            True,
+        ),
+        (
+            "goals_completed_between",
+            reports.goals_completed_between_query(user_id, start_30, today),
+            True,
+        ),
+        ("in_progress_goals", reports.in_progress_goals_query(user_id, today), True),
+        (
+            "open_goals_of_type",
+            reports.open_goals_of_type_query(user_id, 3, today),
+            True,
+        ),
+        (
+            "monthly_report",
+            reports.monthly_report_query(connection, user_id, start_30, today),
+            True,
+        ),
+        (
+            "fleet_report",
+            reports.fleet_report_query(connection, start_30, today),
+            False,
+        ),
+        (
+            "daily_summary",
+            reports.daily_summary_query(user_id, start_30, today),
+            True,
+        ),
+        (
+            "summary_health",
+            reports.summary_health_query(user_id, start_30, today),
+            True,
+        ),
+        ("summary_sleep", reports.summary_sleep_query(user_id, start_30), True),
+        (
+            "summary_workout_count",
+            reports.summary_workout_count_query(user_id, start_7, today),
+            True,
+        ),
+        (
+            "monthly_summary",
+            reports.monthly_summary_query(user_id, start_30, today),
+            True,
+        ),
+        ("fleet_summary", reports.fleet_summary_query(start_30, today), False),
+        (
+            "trend",
+            reports.trend_query(user_id, today - timedelta(days=89), today),
+            True,
+        ),
+        ("active_goals", goals.active_goals_query(today), True),
+        (
+            "overlapping_goal_count",
+            goals.active_goal_count_query(start_30, today),
+            True,
+        ),
+    ]
+
+
+def explain(connection, statement):
+    # returns the detail column of EXPLAIN QUERY PLAN for a select() statement
+    # the values are rendered inline because the plan does not depend on them
+    compiled = statement.compile(
+        dialect=connection.dialect, compile_kwargs={"literal_binds": True}
+    )
+    rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}").all()
+    return [row[3] for row in rows]
+
+
+def full_scans(plan, tables=None):
+    # names of real tables that the plan reads from start to end
+    # subqueries show up as SCAN anon_1 etc, those are not tables and are skipped
+    tables = tables if tables is not None else set(Base.metadata.tables)
+    scans = []
+    for detail in plan:
+        match = _SCAN_PATTERN.match(detail)
+        if match and match.group(1) in tables:
+            scans.append(match.group(1))
+    return scans
+
+
+def audit(engine=None, queries=None):
+    # explains every query and returns a PlanResult for each one
+    engine = engine or default_engine
+    results = []
+    with engine.connect() as connection:
+        if queries is None:
+            queries = report_queries(connection)
+        for name, statement, hot in queries:
+            plan = explain(connection, statement)
+            results.append(PlanResult(name, hot, plan, full_scans(plan)))
+    return results
+
+
+def check(engine=None, queries=None):
+    # raises PlanRegression if any hot query does a full table scan
+    results = audit(engine, queries)
+    failures = [result for result in results if result.hot and result.scans]
+    if failures:
+        details = "; ".join(
+            f"{result.name} scans {', '.join(result.scans)}" for result in failures
+        )
+        raise PlanRegression(f"hot report queries fell back to a full scan: {details}")
+    return results
+
+
+if __name__ == "__main__":
+    failed = False
+    for result in audit():
+        status = "ok"
+        if result.scans:
+            status = "FULL SCAN" if result.hot else "full scan (fleet query)"
+        failed = failed or (result.hot and bool(result.scans))
+        print(f"{result.name}: {status}")
+        for detail in result.plan:
+            print(f"    {detail}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,469 @@
+import argparse
+import math
+import struct
+import time
+from datetime import date, timedelta
+import numpy as np
+from sqlalchemy import bindparam, delete, func, select, tuple_, union_all
+from sqlalchemy.dialects.sqlite import insert
+import analytics
+import helpers
+import partitions
+from helpers import for_users, user_id_range
+from init_db import (
+    engine as default_engine,
+    DailyMetricSketch,
+    HealthMetricDaily,
+    HealthMetricHourly,
+    User,
+)
+
+"""
+Approximate quantiles (median, p95 etc) of heart rate and blood pressure per user and
+per cohort, from t-digest sketches.
+
+An exact percentile over a date range sorts every reading in it, so a cohort's p95
+over a year reads and sorts millions of rows. Instead each day's readings of a user
+are summarized into a t-digest: at most about compression / 2 centroids (mean,
+count), small near the extremes and bigger in the middle, so the tails (p1, p95, p99)
+stay accurate. Digests merge: the digest of a range or a cohort is the day digests
+put together and compressed again, with the same accuracy.
+
+- daily_metric_sketch (DailyMetricSketch in init_db.py) keeps one serialized digest
+  per user, day and metric (heart_rate, systolic_bp, diastolic_bp), a few hundred
+  bytes each
+- the rows are recomputed from the day's raw readings whenever the daily summary
+  rows are (daily_summary.rebuild() calls rebuild() here), so the seeders, the
+  ingest writer and the ORM listener keep them current. A rebuild works through
+  the users a chunk at a time, so its memory does not grow with the number of users
+- a day whose raw readings are gone (rolled up by retention.py) keeps its sketch, so
+  quantiles over old ranges still work after the readings are deleted. A late
+  upload for such a day is merged into the sketch: the sketch holds as many
+  readings as the day's hourly and daily aggregates plus the late readings merged
+  so far, so only the late readings after those (in upload order) are added
+- the sketch of a day left without any reading is deleted
+- quantiles() and user_quantiles() read the sketches of a range and a cohort through
+  the (user_id, date) primary key and merge them: milliseconds for a user's year
+
+python3 quantiles.py query --metric heart_rate --users 1-25 --days 90 --exact
+python3 quantiles.py rebuild --start 2023-11-01 --end 2023-11-30
+"""
+
+METRICS = ("heart_rate", "systolic_bp", "diastolic_bp")
+# at most about COMPRESSION / 2 centroids per digest, the rank error is about
+# 1 / COMPRESSION in the middle and much smaller in the tails
+COMPRESSION = 100
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+# version, min, max; then the centroid means (float32) and counts (uint32)
+_HEADER = struct.Struct("<Bdd")
+_VERSION = 1
+_EPOCH = date(1970, 1, 1)
+
+
+def _compress(groups, means, weights, compression=COMPRESSION):
+    """
+    Merges the centroids of every group (eg. a user's day) into at most about
+    compression / 2 centroids, all groups at once. A centroid goes into the bin of
+    the t-digest scale function k(q) = compression / (2 pi) * asin(2q - 1) at the
+    rank q where it starts, so bins hold few values near q = 0 and q = 1 and more in
+    the middle. Returns the (groups, means, weights) of the merged centroids, sorted
+    by group and mean.
+    """
+    order = np.lexsort((means, groups))
+    groups, means, weights = groups[order], means[order], weights[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    cumulative = np.cumsum(weights)
+    before = np.r_[0, cumulative[starts[1:] - 1]]  # weight of the earlier groups
+    totals = np.r_[cumulative[starts[1:] - 1], cumulative[-1]] - before
+    sizes = np.diff(np.r_[starts, len(groups)])
+    rank = (cumulative - weights - np.repeat(before, sizes)) / np.repeat(totals, sizes)
+    scale = compression / (2 * math.pi) * np.arcsin(2 * rank - 1) + compression / 4
+    bins = np.floor(scale).astype(np.int64)
+    # a new centroid wherever the group or the bin changes
+    edges = np.flatnonzero(
+        np.r_[True, (groups[1:] != groups[:-1]) | (bins[1:] != bins[:-1])]
+    )
+    merged = np.add.reduceat(weights, edges)
+    return (
+        groups[edges],
+        np.add.reduceat(means * weights, edges) / merged,
+        merged,
+    )
+
+
+class TDigest:
+    def __init__(self, means=(), weights=(), minimum=math.nan, maximum=math.nan):
+        # centroids sorted by mean
+        self.means = np.asarray(means, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.int64)
+        self.min = minimum
+        self.max = maximum
+
+    @classmethod
+    def of(cls, values, compression=COMPRESSION):
+        # the digest of raw values (NaN values are skipped)
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return cls()
+        _, means, weights = _compress(
+            np.zeros(len(values), dtype=np.int64),
+            values,
+            np.ones(len(values), dtype=np.int64),
+            compression,
+        )
+        return cls(means, weights, float(values.min()), float(values.max()))
+
+    @classmethod
+    def merge(cls, digests, compression=COMPRESSION):
+        # one digest of everything the digests summarize
+        digests = [digest for digest in digests if digest.count]
+        if not digests:
+            return cls()
+        means = np.concatenate([digest.means for digest in digests])
+        weights = np.concatenate([digest.weights for digest in digests])
+        _, means, weights = _compress(
+            np.zeros(len(means), dtype=np.int64), means, weights, compression
+        )
+        return cls(
+            means,
+            weights,
+            min(digest.min for digest in digests),
+            max(digest.max for digest in digests),
+        )
+
+    @property
+    def count(self):
+        return int(self.weights.sum())
+
+    def __len__(self):
+        return len(self.means)
+
+    def quantile(self, q):
+        """
+        Estimated value at quantile q (0 to 1, or an array of them), interpolated
+        between the centroid centres. NaN for an empty digest.
+        """
+        if not self.count:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else math.nan
+        total = self.count
+        centres = np.cumsum(self.weights) - self.weights / 2
+        value = np.interp(
+            np.asarray(q) * total,
+            np.r_[0, centres, total],
+            np.r_[self.min, self.means, self.max],
+        )
+        return value if np.ndim(q) else float(value)
+
+    def to_bytes(self):
+        return (
+            _HEADER.pack(_VERSION, self.min, self.max)
+            + self.means.astype("<f4").tobytes()
+            + self.weights.astype("<u4").tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, minimum, maximum = _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError(f"unknown sketch version {version}")
+        size = (len(data) - _HEADER.size) // 8
+        means = np.frombuffer(data, "<f4", size, _HEADER.size)
+        weights = np.frombuffer(data, "<u4", size, _HEADER.size + 4 * size)
+        return cls(means, weights, minimum, maximum)
+
+
+### MAINTENANCE ###
+def day_sketches(health, compression=COMPRESSION):
+    """
+    The digest of every (user, day) in analytics.HealthColumns, for every metric:
+    {(user_id, day): {metric: serialized digest or None}}. The digests of all the
+    days are compressed together (_compress), only the serializing is per day.
+    """
+    days = health.timestamp // analytics.SECONDS_PER_DAY
+    if not len(days):
+        return {}
+    # one group number per (user, day), increasing: the columns are sorted by user
+    # and time
+    new_group = np.r_[
+        True, (health.user_id[1:] != health.user_id[:-1]) | (days[1:] != days[:-1])
+    ]
+    group = np.cumsum(new_group) - 1
+    starts = np.flatnonzero(new_group)
+    keys = [
+        (int(user_id), _EPOCH + timedelta(days=int(day)))
+        for user_id, day in zip(health.user_id[starts], days[starts])
+    ]
+    sketches = {key: dict.fromkeys(METRICS) for key in keys}
+    for metric in METRICS:
+        values = getattr(health, metric)
+        known = ~np.isnan(values)
+        if not known.any():
+            continue
+        groups, values = group[known], values[known]
+        first = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        minimums = np.minimum.reduceat(values, first)
+        maximums = np.maximum.reduceat(values, first)
+        found, means, weights = _compress(
+            groups, values, np.ones(len(values), dtype=np.int64), compression
+        )
+        edges = np.flatnonzero(np.r_[True, found[1:] != found[:-1]])
+        stops = np.r_[edges[1:], len(found)]
+        for i, (start, stop) in enumerate(zip(edges, stops)):
+            digest = TDigest(
+                means[start:stop],
+                weights[start:stop],
+                float(minimums[i]),
+                float(maximums[i]),
+            )
+            sketches[keys[found[start]]][metric] = digest.to_bytes()
+    return sketches
+
+
+def _user_chunks(connection, user_ids, chunk_size):
+    # the user ids in lists (or ranges) of at most chunk_size
+    if user_ids is None:
+        ids = connection.execute(select(User.id).order_by(User.id)).scalars().all()
+        # as ranges, so each chunk is read with a BETWEEN
+        return [
+            range(ids[i], ids[min(i + chunk_size, len(ids)) - 1] + 1)
+            for i in range(0, len(ids), chunk_size)
+        ]
+    if not isinstance(user_ids, (list, tuple, range)):
+        user_ids = sorted(user_ids)
+    return [user_ids[i : i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+
+
+def _as_date(value):
+    # SQLite's DATE() gives text
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+
+def rolled_counts(connection, start, end, user_ids=None):
+    """
+    The number of readings of every metric that retention rolled into the hourly and
+    daily aggregates (retention.py), for the days from start to end:
+    {(user_id, day): {metric: count}}, only the days that have aggregates.
+    """
+    parts = []
+    for table, day in (
+        (HealthMetricHourly, func.date(HealthMetricHourly.hour)),
+        (HealthMetricDaily, func.date(HealthMetricDaily.day)),
+    ):
+        query = select(
+            table.user_id,
+            day.label("day"),
+            *[getattr(table, f"{metric}_count").label(metric) for metric in METRICS],
+        ).where(day.between(start.isoformat(), end.isoformat()))
+        parts.append(for_users(query, table.user_id, user_ids))
+    counts = union_all(*parts).subquery("rolled")
+    rows = connection.execute(
+        select(
+            counts.c.user_id,
+            counts.c.day,
+            *[func.sum(counts.c[metric]) for metric in METRICS],
+        ).group_by(counts.c.user_id, counts.c.day)
+    )
+    return {
+        (user_id, _as_date(day)): dict(zip(METRICS, metric_counts))
+        for user_id, day, *metric_counts in rows
+    }
+
+
+def _merge_late(connection, keys, rolled):
+    """
+    The sketches of rolled up days (user_id, day) that got late readings: the
+    stored sketch with the late readings it does not have yet merged in.
+    """
+    stored = {
+        (row.user_id, row.date): row
+        for row in connection.execute(
+            select(DailyMetricSketch).where(
+                tuple_(DailyMetricSketch.user_id, DailyMetricSketch.date).in_(
+                    list(keys)
+                )
+            )
+        )
+    }
+    days = [day for _, day in keys]
+    raw = partitions.health_metrics_between(
+        connection, min(days), max(days) + timedelta(days=1), {user for user, _ in keys}
+    )
+    late = {}
+    # in id order, the order they were uploaded in
+    for row in connection.execute(select(raw).order_by(raw.c.id)):
+        key = (row.user_id, row.timestamp.date())
+        if key in keys:
+            late.setdefault(key, []).append(row)
+    sketches = {}
+    for key, rows in late.items():
+        sketches[key] = {}
+        for metric in METRICS:
+            data = getattr(stored.get(key), metric, None)
+            digest = TDigest.from_bytes(data) if data else TDigest()
+            values = [getattr(row, metric) for row in rows]
+            values = [value for value in values if value is not None]
+            # the first late readings are in the sketch already
+            merged = max(digest.count - (rolled[key][metric] or 0), 0)
+            if len(values) > merged:
+                digest = TDigest.merge([digest, TDigest.of(values[merged:])])
+            sketches[key][metric] = digest.to_bytes() if digest.count else None
+    return sketches
+
+
+def _rebuild_users(connection, start, end, user_ids):
+    # rebuild() of one chunk of users, returns the rows written
+    health = analytics.load_health_metrics(
+        connection, start, end + timedelta(days=1), user_ids
+    )
+    sketches = day_sketches(health)
+    del health
+    rolled = rolled_counts(connection, start, end, user_ids)
+    late = sketches.keys() & rolled.keys()
+    if late:
+        sketches.update(_merge_late(connection, late, rolled))
+    # the sketches of days that have no reading left in any tier
+    stored = connection.execute(
+        for_users(
+            select(DailyMetricSketch.user_id, DailyMetricSketch.date).where(
+                DailyMetricSketch.date.between(start, end)
+            ),
+            DailyMetricSketch.user_id,
+            user_ids,
+        )
+    )
+    emptied = [
+        {"sketch_user_id": user_id, "sketch_date": day}
+        for user_id, day in stored
+        if (user_id, day) not in sketches and (user_id, day) not in rolled
+    ]
+    if emptied:
+        connection.execute(
+            delete(DailyMetricSketch).where(
+                DailyMetricSketch.user_id == bindparam("sketch_user_id"),
+                DailyMetricSketch.date == bindparam("sketch_date"),
+            ),
+            emptied,
+        )
+    if not sketches:
+        return 0
+    rows = [
+        {"user_id": user_id, "date": day, **day_values}
+        for (user_id, day), day_values in sketches.items()
+    ]
+    statement = insert(DailyMetricSketch)
+    connection.execute(
+        statement.on_conflict_do_update(
+            index_elements=["user_id", "date"],
+            set_={metric: statement.excluded[metric] for metric in METRICS},
+        ),
+        rows,
+    )
+    return len(rows)
+
+
+def rebuild(connection, start, end, user_ids=None, chunk_size=250):
+    """
+    Recomputes the sketches of every user (or the given user ids) for the days from
+    start to end from their raw readings, in the caller's transaction, chunk_size
+    users at a time. Days without raw readings keep the sketches they have if
+    retention rolled them up and lose them if not. Returns the rows written.
+    """
+    return sum(
+        _rebuild_users(connection, start, end, chunk)
+        for chunk in _user_chunks(connection, user_ids, chunk_size)
+    )
+
+
+### QUERIES ###
+def _sketch_rows(connection, metric, start, end, user_ids):
+    column = getattr(DailyMetricSketch, metric)
+    query = select(DailyMetricSketch.user_id, column).where(
+        DailyMetricSketch.date.between(start, end), column.is_not(None)
+    )
+    return connection.execute(
+        for_users(query, DailyMetricSketch.user_id, user_ids)
+    ).all()
+
+
+def sketch(connection, metric, start, end, user_ids=None):
+    # the merged digest of a metric over the days from start to end and a cohort
+    rows = _sketch_rows(connection, metric, start, end, user_ids)
+    return TDigest.merge(TDigest.from_bytes(data) for _, data in rows)
+
+
+def quantiles(connection, metric, start, end, user_ids=None, q=DEFAULT_QUANTILES):
+    """
+    Estimated quantiles q of a metric's readings over the days from start to end
+    (inclusive) of every user (or a cohort), as an array in the order of q.
+    """
+    return sketch(connection, metric, start, end, user_ids).quantile(np.asarray(q))
+
+
+def user_quantiles(connection, metric, start, end, user_ids=None, q=DEFAULT_QUANTILES):
+    # quantiles() of every user of a cohort on its own: {user_id: array}
+    days = {}
+    for user_id, data in _sketch_rows(connection, metric, start, end, user_ids):
+        days.setdefault(user_id, []).append(TDigest.from_bytes(data))
+    return {
+        user_id: TDigest.merge(digests).quantile(np.asarray(q))
+        for user_id, digests in days.items()
+    }
+
+
+def rebuild_range(engine=None, start=None, end=None, user_ids=None):
+    # rebuild() in its own transaction, by default the last 30 days
+    return helpers.rebuild_range(
+        rebuild, engine or default_engine, start, end, user_ids
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Heart rate and blood pressure quantiles"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    query = commands.add_parser("query", help="print quantiles of a range and cohort")
+    query.add_argument("--metric", choices=METRICS, default="heart_rate")
+    query.add_argument("--users", type=user_id_range, help="eg. 1-25, default all")
+    query.add_argument("--days", type=int, default=30)
+    query.add_argument(
+        "--exact", action="store_true", help="compare with exact percentiles"
+    )
+    build = commands.add_parser("rebuild", help="recompute the sketches of a range")
+    build.add_argument("--start", type=date.fromisoformat, help="YYYY-MM-DD")
+    build.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        began = time.perf_counter()
+        rows = rebuild_range(start=args.start, end=args.end)
+        print(f"Rebuilt {rows} sketch rows in {time.perf_counter() - began:.2f}s")
+    else:
+        end = date.today()
+        start = end - timedelta(days=args.days - 1)
+        q = [0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+        with default_engine.connect() as connection:
+            began = time.perf_counter()
+            digest = sketch(connection, args.metric, start, end, args.users)
+            values = digest.quantile(np.asarray(q))
+            seconds = time.perf_counter() - began
+            print(
+                f"{args.metric}, {digest.count:,} readings, last {args.days} days: "
+                f"{seconds * 1000:.1f} ms from the sketches"
+            )
+            for quantile, value in zip(q, values):
+                print(f"p{quantile * 100:g}: {value:.1f}")
+            if args.exact:
+                began = time.perf_counter()
+                health = analytics.load_health_metrics(
+                    connection, start, end + timedelta(days=1), args.users
+                )
+                exact = analytics.percentiles(
+                    getattr(health, args.metric), [quantile * 100 for quantile in q]
+                )
+                seconds = time.perf_counter() - began
+                print(f"exact (raw readings): {seconds * 1000:.1f} ms")
+                for quantile, value in zip(q, exact):
+                    print(f"p{quantile * 100:g}: {value:.1f}")
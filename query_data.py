@@ -1,18 +1,24 @@
-from init_db import (
-    User,
-    HealthMetric,
-    SleepLog,
-    Food,
-    FoodLog,
-    WorkoutRecommendation,
-    WorkoutLog,
-    Goal,
-)
-from sqlalchemy import func, text, desc
-from db_session import session
+from init_db import User, Food
+from sqlalchemy import func
+
+# query_data only reads, so it uses the read only thread local session
+from db_session import read_only_session as session
+import reports
+import report_cache
+from catalog import catalog_for
+from recommendations import recommend
+from sampling import sample
+import partitions
+import retention
+import analytics
+import quantiles
+from goals import active_goal_count_query, user_progress_query
 from datetime import datetime, timedelta, date
 import time
 
+# the food and workout recommendation tables are read from the in memory catalog
+catalog = catalog_for()
+
 # track run time for query processing
 query_start_timestamp = time.time()
 # # Get the date 30 days ago
@@ -38,82 +44,83 @@ while not user1:
 
 ### HEALTH_METRIC TABLE QUERIES ###
 # Get average health metrics over the last 30 days
-avg_metrics = (
-    session.query(
-        func.avg(HealthMetric.heart_rate),
-        func.avg(HealthMetric.steps_taken),
-        func.avg(HealthMetric.stand_hours),
-        func.avg(HealthMetric.systolic_bp),
-        func.avg(HealthMetric.diastolic_bp),
-    )
-    .filter(
-        HealthMetric.user_id == user1.id,
-        HealthMetric.timestamp >= start_date_30,
-    )
-    .first()
-)
+# the averages over a date window read the daily summary rollup (one row per day)
+# and are kept in the report cache, so opening the dashboard again is free
+avg_metrics = report_cache.avg_health_metrics(session, user1.id, window=30)
 print(f"\nAverage health metrics for {user1.name} over the last 30 days:")
 print(
     f"Heart Rate: {avg_metrics[0]}, Steps Taken: {avg_metrics[1]}, Stand Hours: {avg_metrics[2]}"
 )
 print(f"Systolic BP: {avg_metrics[3]}, Diastolic BP: {avg_metrics[4]}")
 
+# raw readings for a window are read from health_metrics and only the monthly
+# partitions that overlap it (see partitions.py), not from the whole history
+window_tables = partitions.tables_between(
+    session.connection(), start_date_30, datetime.now()
+)
+print(f"The 30-day window reads: {', '.join(table.name for table in window_tables)}")
 
-# Get average steps taken over the last 7 days
-avg_steps = (
-    session.query(
-        func.avg(HealthMetric.steps_taken),
-    )
-    .filter(
-        HealthMetric.user_id == user1.id,
-        HealthMetric.timestamp >= start_date_7,
-    )
-    .scalar()
+# long ranges also read the hourly and daily aggregates the retention job rolls old
+# readings into (see retention.py), so the averages cover readings deleted since
+year_metrics = retention.avg_health_metrics(
+    session.connection(), user1.id, datetime.now() - timedelta(days=365), datetime.now()
 )
+print(f"Average steps per day over the last year: {year_metrics.avg_steps_taken}")
+
+# medians, spreads and trends are computed by NumPy on the user's readings, loaded
+# straight from the cursor into arrays (see analytics.py), not one ORM object per row
+health = analytics.load_health_metrics(
+    session.connection(),
+    datetime.now() - timedelta(days=90),
+    datetime.now(),
+    [user1.id],
+)
+heart_rate = analytics.summary(health.heart_rate)
+print(
+    f"Heart rate over the last 90 days: median {heart_rate.median}, "
+    f"std {heart_rate.std:.1f}"
+)
+steps_trend = analytics.trend_slope(health.timestamp, health.steps_taken)
+print(f"Steps trend: {steps_trend:+.1f} steps per day")
+drift = analytics.resting_hr_drift(health.timestamp, health.heart_rate)
+print(f"Resting heart rate drift: {drift:+.3f} bpm per day")
+
+# median and p95 from the per day quantile sketches (see quantiles.py), merged for
+# the range instead of sorting the raw readings
+for metric in quantiles.METRICS:
+    median, p95 = quantiles.quantiles(
+        session.connection(),
+        metric,
+        date.today() - timedelta(days=89),
+        date.today(),
+        [user1.id],
+        q=[0.5, 0.95],
+    )
+    print(f"{metric} over the last 90 days: median {median:.1f}, p95 {p95:.1f}")
+
+
+# Get average steps taken over the last 7 days
+avg_steps = report_cache.avg_health_metrics(session, user1.id, window=7).avg_steps_taken
 print(f"\nAverage steps per day for {user1.name} over the last 7 days: {avg_steps}")
 
 
 ### SLEEP TABLE QUERIES ###
 # get average sleep quality and duration for user 1 over the last 30 days
 end_date = datetime.now()  # today's date
-avg_sleep = (
-    session.query(
-        func.avg(SleepLog.duration),
-        func.avg(SleepLog.quality),
-    )
-    .filter(
-        SleepLog.user_id == user1.id,
-        SleepLog.date.between(start_date_30, end_date),
-    )
-    .first()
-)
+avg_sleep = report_cache.avg_sleep(session, user1.id, window=30)
 print(f"\nAverage sleep duration and quality for {user1.name} over the last 30 days:")
 print(f"Duration: {avg_sleep[0]}, Quality: {avg_sleep[1]}")
 
 
 # get user with the highest average sleep quality in the last month
-best_sleeper = (
-    session.query(User.name, func.avg(SleepLog.quality))
-    .join(User.sleep_log)  # using backref
-    .filter(SleepLog.date >= start_date_30)
-    .group_by(User.name)
-    .order_by(func.avg(SleepLog.quality).desc())
-    .first()
-)
+best_sleeper = session.execute(reports.best_sleeper_query(start_date_30)).first()
 print(f"\nUser with the highest average sleep quality over the last month:")
 print(f"{best_sleeper.name}, Quality: {best_sleeper[1]}")
 
 
 ### FOOD AND FOOD LOG QUERIES ###
 # 3 most popular foods for all users
-query = (
-    session.query(Food.name, func.count(FoodLog.food_id).label("total"))
-    .join(FoodLog)
-    .group_by(Food.name)
-    .order_by(text("total DESC"))
-    .limit(3)
-)
-most_popular_foods = query.all()
+most_popular_foods = session.execute(reports.most_popular_foods_query(3)).all()
 print("\n3 most popular foods across all users")
 for food in most_popular_foods:
     print(f"Food ID: {food.name}, Count: {food.total}")
@@ -121,61 +128,47 @@ for food in most_popular_foods:
 
 # Food log entries for user 1 yesterday
 query_date = datetime.now().date() - timedelta(days=1)  # yesterday date
-foods_user_ate_yesterday = (
-    session.query(FoodLog)
-    .join(Food)  # backref removes the need for explicit join condition
-    .filter(FoodLog.user_id == user1.id, FoodLog.date == query_date)
+foods_user_ate_yesterday = session.scalars(
+    reports.foods_eaten_on_query(user1.id, query_date)
 ).all()
 print("\nFoods user 1 ate yesterday:")
 for food_log in foods_user_ate_yesterday:
-    print(f"Food Name: {food_log.food.name}, Time: {food_log.time}")
+    # the food name comes from the catalog instead of a lazy load per entry
+    food = catalog.foods().get(food_log.food_id)
+    print(f"Food Name: {food.name}, Time: {food_log.time}")
 
 
 # Get the number of times user ate vegetables in the last week
-query = (
-    session.query(FoodLog)
-    .join(Food)  # using backref
-    .filter(
-        FoodLog.user_id == user1.id,
-        FoodLog.date.between(start_date_7, end_date),
-        Food.category == 4,  # Filter by the vegetable food category
-    )
-)
-num_vegetables_last_week = (
-    query.count()
-)  # Use count() to get the number of times from entries returned by the query
+# Filter by the vegetable food category (4)
+num_vegetables_last_week = session.execute(
+    reports.food_category_count_query(user1.id, 4, start_date_7, end_date)
+).scalar()
 print(
     f"\nNumber of times user 1 ate vegetables in the last week: {num_vegetables_last_week}"
 )
 
 # total calories eaten by user1 that day
 query_date = datetime(2023, 11, 8)
-query = (
-    session.query(func.sum(Food.calories))
-    .join(FoodLog)
-    .filter(
-        FoodLog.user_id == user1.id,
-        FoodLog.date == query_date.date(),
-    )
-)
-total_calories = query.scalar()
+total_calories = session.execute(
+    reports.calories_on_query(user1.id, query_date.date())
+).scalar()
 print(
     f"\nTotal calories consumed by user {user1.id} on {query_date.date()}: {total_calories}"
 )
 
 
+# suggest 3 random fruits (category 5) to try
+# rows are picked by probing random ids, not by sorting the table with ORDER BY random()
+fruits = sample(session, Food, 3, Food.category == 5)
+print("\nFruits to try:")
+for fruit in fruits:
+    print(f"{fruit.name} ({fruit.calories} calories)")
+
+
 ### WORKOUT RECOMMENDATION QUERIES ###
-# get a recommendation for an easy cardio workout less than 0.75 hours
-query = (
-    session.query(WorkoutRecommendation)
-    .filter(
-        WorkoutRecommendation.exercise_type == 1,
-        WorkoutRecommendation.difficulty_level == 1,
-        WorkoutRecommendation.duration <= 0.75,
-    )
-    .order_by(func.random())
-)
-workouts = query.all()
+# get 5 random easy cardio workouts less than 0.75 hours
+# (searched in the in memory recommendation index, no ORDER BY random() in SQL)
+workouts = recommend(exercise_type=1, difficulty_level=1, max_duration=0.75, k=5)
 if workouts:
     print("\nEasy cardio workouts less than 0.75 hours:")
     for workout in workouts:
@@ -184,25 +177,13 @@ else:
     print("\nNo matching workouts were found.")
 
 # number of strength workouts in recommendation table
-query = (
-    session.query(func.count(WorkoutRecommendation.id))
-    .filter(WorkoutRecommendation.exercise_type == 2)
-    .scalar()
-)
+query = len(catalog.recommendations().in_category(2))
 print(f"\nNumber of strength workouts in the recommendation table: {query}")
 
 
 ### Workout Log Queries ###
 # get the most frequent recommendation users used
-query = (
-    session.query(
-        WorkoutLog.recommendation_id,
-        func.count(WorkoutLog.recommendation_id),
-    )
-    .group_by(WorkoutLog.recommendation_id)
-    .order_by(desc(func.count(WorkoutLog.recommendation_id)))
-    .first()
-)
+query = session.execute(reports.most_frequent_recommendation_query()).first()
 most_frequent_rec_id, frequency = query
 print(
     f"\nThe most frequent recommendation the users did is workout {most_frequent_rec_id}: {frequency} times."
@@ -210,34 +191,20 @@ print(
 
 
 # Query the WorkoutLog table to get the number of workouts for a specific user this week
-end_date = start_date_7 + timedelta(days=7)
-num_workouts = (
-    session.query(func.count(WorkoutLog.id))
-    .filter(
-        WorkoutLog.user_id == user1.id,
-        WorkoutLog.date.between(start_date_7, end_date),
-    )
-    .scalar()
-)
+num_workouts = report_cache.workout_count(session, user1.id, window=7)
 print(f"\nUser {user1.name} worked out {num_workouts} times this week.")
 
 
 # Query the WorkoutLog table to get the total calories burned by user on a specific day
 workout_date = datetime.now().date() - timedelta(days=7)
-query = (
-    session.query(func.sum(WorkoutLog.calories_burned))
-    .filter(WorkoutLog.user_id == user1.id, WorkoutLog.date == workout_date)
-    .scalar()
-)
+query = session.execute(
+    reports.calories_burned_on_query(user1.id, workout_date)
+).scalar()
 print(f"\nUser {user1.name} burned {query} calories on {workout_date}.")
 
 
 # Query the WorkoutLog table to get the details of a user-created workout
-workout_log = (
-    session.query(WorkoutLog)
-    .filter(WorkoutLog.user_id == user1.id, WorkoutLog.user_workout_id.isnot(None))
-    .first()
-)
+workout_log = session.scalars(reports.user_created_workout_query(user1.id)).first()
 if workout_log is not None:
     user_workout = workout_log.user_workout  # uses backref
     print(
@@ -271,27 +238,18 @@ else:
 
 
 # get the number of completed goals for user 1
-completed_goals_count = (
-    session.query(func.count(Goal.id))  # Count the goals
-    .filter(
-        Goal.user_id == user1.id,
-        Goal.end_date < date.today(),  # Filter by end date before today
-    )
-    .scalar()
-)
+# Count the goals with an end date before today
+completed_goals_count = session.execute(
+    reports.completed_goal_count_query(user1.id, date.today())
+).scalar()
 print(f"\nNumber of completed goals by user {user1.id}: {completed_goals_count}")
 
 
 # get the details of in progress goals for user 1
-in_progress_goals = (
-    session.query(Goal)  # Select the goals
-    .filter(
-        Goal.user_id == user1.id,
-        Goal.start_date <= date.today(),  # Filter by start date
-        Goal.end_date >= date.today(),  # Filter by end date
-    )
-    .all()  # Get all matching records
-)
+# goals that started on or before today and end on or after today
+in_progress_goals = session.scalars(
+    reports.in_progress_goals_query(user1.id, date.today())
+).all()
 
 print(f"\nIn-progress goals by user {user1.id}:")
 for goal in in_progress_goals:
@@ -302,15 +260,9 @@ for goal in in_progress_goals:
 
 # get in progress fitness goals for user 1
 goal_type = 3  # fitness goal
-fitness_goals = (
-    session.query(Goal)  # Select the goals
-    .filter(
-        Goal.user_id == user1.id,
-        Goal.goal_type == goal_type,  # Filter by type
-        Goal.end_date >= date.today(),  # in progress goals
-    )
-    .all()  # Get all matching records
-)
+fitness_goals = session.scalars(
+    reports.open_goals_of_type_query(user1.id, goal_type, date.today())
+).all()
 if fitness_goals:
     print(f"\nIn progress fitness goals for user {user1.id}:")
     for goal in fitness_goals:
@@ -321,92 +273,74 @@ else:
     print("\nno in progress fitness goals for user")
 
 
+# get the progress of user 1's goals towards their targets
+# the progress of every goal in progress is evaluated in batches by goals.py (run
+# nightly, and after seeding)
+goal_progress = session.execute(user_progress_query(user1.id)).all()
+print(f"\nGoal progress for user {user1.id}:")
+for goal, progress in goal_progress:
+    print(
+        f"Goal ID: {goal.id}, Type: {goal.goal_type}, Value: {progress.value}, "
+        f"Target: {progress.target}, Met: {progress.met} (as of {progress.as_of})"
+    )
+
+# number of goals active today for every user, by type
+# read through the interval index on goals instead of scanning the table
+active_goal_counts = session.execute(active_goal_count_query(date.today())).all()
+print("\nGoals active today (all users):")
+for goal_type, count in active_goal_counts:
+    print(f"Goal type {goal_type}: {count}")
+
+
 ### COMPREHENSIVE QUERY ###
 # generate monthly health report for user 1
-# Get the current date and the date 30 days ago
-current_date = datetime.now().date()
-start_date_30 = current_date - timedelta(days=30)
-
-# Get average health metrics over the last 30 days
-avg_metrics = (
-    session.query(
-        func.round(func.avg(HealthMetric.heart_rate), 2).label(
-            "avg_resting_heart_rate"
-        ),
-        func.round(func.avg(HealthMetric.steps_taken), 2).label("avg_steps_taken"),
-        func.round(func.avg(HealthMetric.stand_hours), 2).label("avg_stand_hours"),
-        func.round(func.avg(HealthMetric.systolic_bp), 2).label("avg_systolic_bp"),
-        func.round(func.avg(HealthMetric.diastolic_bp), 2).label("avg_diastolic_bp"),
-    )
-    .filter(
-        HealthMetric.user_id == user1.id,
-        HealthMetric.timestamp >= start_date_30,
-    )
-    .first()
-)
-# Get average sleep duration and quality over the last 30 days
-avg_sleep = (
-    session.query(
-        func.round(func.avg(SleepLog.duration), 2).label("avg_sleep_duration"),
-        func.round(func.avg(SleepLog.quality), 2).label("avg_sleep_quality"),
-    )
-    .filter(
-        SleepLog.user_id == user1.id,
-        SleepLog.date >= start_date_30,
-    )
-    .first()
-)
-# Get average number of calories per day over the last 30 days
-# Get sum of calories per day over the last 30 days
-calories_per_day = (
-    session.query(FoodLog.date, func.sum(Food.calories).label("calories"))
-    .join(FoodLog, FoodLog.food_id == Food.id)
-    .filter(
-        FoodLog.user_id == user1.id,
-        FoodLog.date >= start_date_30,
-    )
-    .group_by(FoodLog.date)
-    .subquery()
-)
-# Get average calories per day
-avg_calories = (
-    session.query(
-        func.round(func.avg(calories_per_day.c.calories), 2).label("avg_calories")
-    )
-    .select_from(calories_per_day)
-    .scalar()
-)
-# Get number of goals completed this month
-goals_completed = (
-    session.query(func.count(Goal.id))
-    .filter(
-        Goal.user_id == user1.id,
-        Goal.end_date.between(start_date_30, current_date),
-    )
-    .scalar()
-)
-# Get number of workouts completed over the last 30 days
-workouts_completed = (
-    session.query(func.count(WorkoutLog.id))
-    .filter(
-        WorkoutLog.user_id == user1.id,
-        WorkoutLog.date >= start_date_30,
-    )
-    .scalar()
-)
+# the whole report (health and sleep averages, calories per day, goals and workouts
+# completed) is computed by one statement over the last 30 days of summary rows
+report = report_cache.monthly_report(session, user1.id, window=30)
 # Print the health report
 print(f"\n30-Day Health Report for {user1.name}:")
-print(f"Average Heart Rate: {avg_metrics.avg_resting_heart_rate}")
-print(f"Average Steps Taken: {avg_metrics.avg_steps_taken}")
-print(f"Average Stand Hours: {avg_metrics.avg_stand_hours}")
-print(f"Average Systolic BP: {avg_metrics.avg_systolic_bp}")
-print(f"Average Diastolic BP: {avg_metrics.avg_diastolic_bp}")
-print(f"Average Sleep Duration: {avg_sleep.avg_sleep_duration}")
-print(f"Average Sleep Quality: {avg_sleep.avg_sleep_quality}")
-print(f"Average Calories per Day: {avg_calories}")
-print(f"Goals Completed This Month: {goals_completed}")
-print(f"Workouts Completed: {workouts_completed}")
+print(f"Average Heart Rate: {report.avg_resting_heart_rate}")
+print(f"Average Steps Taken: {report.avg_steps_taken}")
+print(f"Average Stand Hours: {report.avg_stand_hours}")
+print(f"Average Systolic BP: {report.avg_systolic_bp}")
+print(f"Average Diastolic BP: {report.avg_diastolic_bp}")
+print(f"Average Sleep Duration: {report.avg_sleep_duration}")
+print(f"Average Sleep Quality: {report.avg_sleep_quality}")
+print(f"Average Calories per Day: {report.avg_calories}")
+print(f"Goals Completed This Month: {report.goals_completed}")
+print(f"Workouts Completed: {report.workouts_completed}")
+
+
+### FLEET REPORTS ###
+# the nightly 30-day reports for every user are streamed from one statement
+# (one GROUP BY user_id scan per log table instead of a set of queries per user)
+fleet_report_count = sum(1 for _ in reports.fleet_reports(session, window=30))
+print(f"\nGenerated 30-day reports for {fleet_report_count} users")
+
+
+### TRENDS ###
+# the dashboard trend chart: daily values with 7 and 30 day moving averages for the
+# last 90 days, one statement with window functions over the daily summary rows
+trend = report_cache.trend(session, user1.id, window=90)
+print(f"\nLast week of the 90-day trend for {user1.name}:")
+for day in trend[-7:]:
+    print(
+        f"{day.date}: steps {day.steps} (7d {day.steps_7d}, 30d {day.steps_30d}), "
+        f"heart rate 7d {day.resting_heart_rate_7d}, sleep 7d {day.sleep_duration_7d}, "
+        f"calories 7d {day.calories_7d}"
+    )
+
+
+### REPORT CACHE ###
+# opening the dashboard again is served from the cache
+report_cache.monthly_report(session, user1.id, window=30)
+cache_stats = report_cache.report_cache.stats()
+print(
+    f"\nReport cache: {cache_stats.hits} hits, {cache_stats.misses} misses, "
+    f"{cache_stats.entries} entries ({cache_stats.bytes} bytes)"
+)
 
 
 query_end_time = time.time()
 print(f"\nTOTAL query runtime: {query_end_time - query_start_timestamp} seconds")
+session.remove()
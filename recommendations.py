@@ -0,0 +1,152 @@
+import argparse
+import random
+import time
+from bisect import bisect_right
+from catalog import CatalogSnapshot, RecommendationRecord, catalog_for
+
+"""
+In memory search engine for workout recommendations.
+
+The search in query_data.py asks for workouts of one exercise type and difficulty up
+to a duration, in random order. In SQL that filters through one of the single column
+indexes and then ORDER BY random() sorts every candidate, which gets slow as the
+catalog grows. Here the recommendations from the catalog (catalog.py) are indexed once:
+
+- they are bucketed by (exercise_type, difficulty_level)
+- each bucket holds its records sorted by duration, plus the sorted durations
+
+A search is a dictionary lookup, one bisect on the durations (every record before the
+bisect point matches) and random.sample of k positions from that prefix, so it costs
+O(log n + k) no matter how many recommendations match.
+
+The index is rebuilt when the catalog hands out a new snapshot, which happens when the
+workout_recommendation table changes (see catalog.py).
+
+    recommend(exercise_type=1, difficulty_level=1, max_duration=0.75, k=3)
+
+Benchmark the search on a fake catalog: python3 recommendations.py --size 100000
+"""
+
+
+class RecommendationIndex:
+    # the recommendations of one catalog snapshot, bucketed and sorted by duration
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        buckets = {}
+        for record in snapshot:
+            key = (record.exercise_type, record.difficulty_level)
+            buckets.setdefault(key, []).append(record)
+        self._buckets = {}
+        for key, records in buckets.items():
+            records.sort(key=lambda record: record.duration)
+            self._buckets[key] = (
+                [record.duration for record in records],
+                tuple(records),
+            )
+
+    def count(self, exercise_type, difficulty_level, max_duration):
+        # number of matching recommendations
+        durations, _ = self._buckets.get((exercise_type, difficulty_level), ([], ()))
+        return bisect_right(durations, max_duration)
+
+    def search(self, exercise_type, difficulty_level, max_duration, k, rng=random):
+        """
+        Up to k different random recommendations of the type and difficulty that take
+        at most max_duration hours.
+        """
+        durations, records = self._buckets.get(
+            (exercise_type, difficulty_level), ([], ())
+        )
+        matches = bisect_right(durations, max_duration)
+        if k is None or k >= matches:
+            picked = records[:matches]
+            return rng.sample(picked, len(picked))
+        return [records[i] for i in rng.sample(range(matches), k)]
+
+
+class RecommendationSearch:
+    """
+    Keeps a RecommendationIndex in step with the catalog of an engine.
+    Lookups are served from the current index; a new one is built only when the
+    catalog's snapshot changed.
+    """
+
+    def __init__(self, catalog=None, rng=None):
+        self.catalog = catalog or catalog_for()
+        self.rng = rng or random.Random()
+        self._index = None
+
+    def index(self):
+        snapshot = self.catalog.recommendations()
+        index = self._index
+        if index is None or index.snapshot is not snapshot:
+            # building twice when two threads race is harmless, the result is the same
+            index = self._index = RecommendationIndex(snapshot)
+        return index
+
+    def recommend(self, exercise_type, difficulty_level, max_duration, k=5):
+        return self.index().search(
+            exercise_type, difficulty_level, max_duration, k, self.rng
+        )
+
+
+# one search per engine, shared like the catalogs
+_searches = {}
+
+
+def search_for(engine=None):
+    catalog = catalog_for(engine)
+    search = _searches.get(catalog)
+    if search is None:
+        search = _searches[catalog] = RecommendationSearch(catalog)
+    return search
+
+
+def recommend(exercise_type, difficulty_level, max_duration, k=5, engine=None):
+    """
+    k random workout recommendations of a type and difficulty that take at most
+    max_duration hours (fewer if there are not enough). Returns RecommendationRecords.
+    """
+    return search_for(engine).recommend(
+        exercise_type, difficulty_level, max_duration, k
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the recommendation index")
+    parser.add_argument("--size", type=int, default=100000, help="catalog entries")
+    parser.add_argument("--searches", type=int, default=100000)
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    records = [
+        RecommendationRecord(
+            i,
+            f"Workout {i}",
+            None,
+            rng.randint(1, 3),
+            rng.uniform(0.05, 2.0),
+            rng.randint(1, 3),
+        )
+        for i in range(1, args.size + 1)
+    ]
+    start = time.perf_counter()
+    index = RecommendationIndex(
+        CatalogSnapshot(0, records, "workout_name", "exercise_type")
+    )
+    build_seconds = time.perf_counter() - start
+
+    queries = [
+        (rng.randint(1, 3), rng.randint(1, 3), rng.uniform(0.05, 2.0))
+        for _ in range(args.searches)
+    ]
+    start = time.perf_counter()
+    for exercise_type, difficulty_level, max_duration in queries:
+        index.search(exercise_type, difficulty_level, max_duration, args.k, rng)
+    search_seconds = time.perf_counter() - start
+    print(f"index of {args.size:,} recommendations built in {build_seconds:.2f}s")
+    print(
+        f"{args.searches:,} searches: "
+        f"{search_seconds / args.searches * 1e6:.1f} microseconds per search"
+    )
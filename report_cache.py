@@ -0,0 +1,294 @@
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from dataclasses import fields, is_dataclass
+from datetime import date, timedelta
+from sqlalchemy import event, inspect
+from init_db import HealthMetric, SleepLog, Food, FoodLog, WorkoutLog, Goal
+import reports
+
+"""
+In memory cache for the per user report results (the 30 and 7 day aggregates on the
+dashboard), so opening the dashboard again does not run the same aggregates again.
+
+Entries are keyed by (report name, user_id, window in days, end date of the window).
+The end date is part of the key so yesterday's "last 30 days" is never served today.
+Entries are evicted:
+- least recently used first, when there are more than max_entries or their estimated
+  size is over max_bytes
+- when they are older than ttl seconds
+- when the user's data changes: session events drop every entry of a user as soon as
+  a flush writes one of their HealthMetric, SleepLog, FoodLog, WorkoutLog or Goal
+  rows, and again when the transaction commits (a report cached by another session
+  between the flush and the commit would still hold the old data) or rolls back (a
+  report cached after the flush would hold data that was never committed). Changing
+  a food's calories affects everyone who ate it, so that clears the whole cache.
+
+Only cache immutable results (Rows, MonthlyReport, numbers), never ORM objects, which
+belong to the session that loaded them.
+
+The counters in stats() show how well the cache is sized: lots of evictions with a low
+hit ratio means max_entries / max_bytes is too small for the number of active users.
+"""
+
+# counters and current size of a cache
+CacheStats = namedtuple(
+    "CacheStats",
+    [
+        "hits",
+        "misses",
+        "evictions",
+        "expirations",
+        "invalidations",
+        "entries",
+        "bytes",
+    ],
+)
+
+
+def hit_ratio(stats):
+    lookups = stats.hits + stats.misses
+    return stats.hits / lookups if lookups else 0.0
+
+
+def _size(value):
+    # rough size of a result in bytes: the object plus the values it holds
+    size = sys.getsizeof(value)
+    if is_dataclass(value):
+        return size + sum(
+            sys.getsizeof(getattr(value, field.name)) for field in fields(value)
+        )
+    if isinstance(value, (tuple, list)) or hasattr(value, "_mapping"):
+        return size + sum(_size(item) for item in value)
+    return size
+
+
+# the models whose rows feed the reports of their user_id
+_USER_MODELS = (HealthMetric, SleepLog, FoodLog, WorkoutLog, Goal)
+
+
+class ReportCache:
+    def __init__(
+        self, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=300, clock=None
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl  # seconds, None keeps entries until they are evicted
+        self.clock = clock or time.monotonic
+        # key -> (value, expires, size), oldest used first
+        self._entries = OrderedDict()
+        # user_id -> keys of that user, so invalidation does not scan every entry
+        self._keys_by_user = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._tracked = set()
+        self.hits = self.misses = self.evictions = 0
+        self.expirations = self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        user_keys = self._keys_by_user.get(key[1])
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._keys_by_user[key[1]]
+
+    def get(self, report, user_id, window, end=None):
+        # the cached value, or None on a miss
+        key = (report, user_id, window, end or date.today())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, report, user_id, window, value, end=None):
+        key = (report, user_id, window, end or date.today())
+        size = _size(value)
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            # a single result bigger than the whole cache is not kept
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, expires, size)
+            self._keys_by_user.setdefault(user_id, set()).add(key)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, report, user_id, window, compute, end=None):
+        """
+        The cached result of a report, or compute() (a function without arguments)
+        stored in the cache. None results are not cached.
+        """
+        value = self.get(report, user_id, window, end)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.put(report, user_id, window, value, end)
+        return value
+
+    def invalidate_user(self, user_id):
+        # drops every entry of a user, returns how many were dropped
+        with self._lock:
+            keys = list(self._keys_by_user.get(user_id, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._keys_by_user.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return CacheStats(
+                self.hits,
+                self.misses,
+                self.evictions,
+                self.expirations,
+                self.invalidations,
+                len(self._entries),
+                self._bytes,
+            )
+
+    ### INVALIDATION ###
+    def _changed_users(self, session):
+        # user ids (old and new) of the flushed report rows, or None for "everyone"
+        users = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Food):
+                # a new food has not been eaten yet
+                if (
+                    obj in session.dirty
+                    and inspect(obj).attrs.calories.history.has_changes()
+                ):
+                    return None
+            elif isinstance(obj, _USER_MODELS):
+                history = inspect(obj).attrs.user_id.history
+                users.update(value for value in history.sum() if value is not None)
+        return users
+
+    def _invalidate(self, users):
+        if users is None:
+            self.clear()
+        else:
+            for user_id in users:
+                self.invalidate_user(user_id)
+
+    def track(self, session_class):
+        """
+        Invalidates the cache from the flushes and commits of every session of
+        session_class (and its subclasses).
+        db_session.py calls this for the app's session class.
+        """
+        if session_class in self._tracked:
+            return
+        self._tracked.add(session_class)
+        # the users written by a session since its last commit, see the module notes
+        pending_key = ("report_cache", id(self))
+
+        @event.listens_for(session_class, "after_flush")
+        def invalidate_flushed(session, flush_context):
+            users = self._changed_users(session)
+            self._invalidate(users)
+            pending = session.info.setdefault(pending_key, set())
+            if users is None or pending is None:
+                session.info[pending_key] = None
+            else:
+                pending.update(users)
+
+        @event.listens_for(session_class, "after_commit")
+        @event.listens_for(session_class, "after_rollback")
+        def invalidate_pending(session):
+            if pending_key in session.info:
+                self._invalidate(session.info.pop(pending_key))
+
+
+# the cache shared by the app's report code
+report_cache = ReportCache()
+
+
+### CACHED REPORTS ###
+# the per user dashboard reports through the cache, over the `window` days up to today
+def _window_report(session, cache, report, user_id, window, build):
+    today = date.today()
+    start = today - timedelta(days=window)
+    return cache.get_or_compute(
+        report,
+        user_id,
+        window,
+        lambda: session.execute(build(user_id, start, today)).first(),
+        today,
+    )
+
+
+# average health metrics, same columns as reports.summary_health_query
+def avg_health_metrics(session, user_id, window=30, cache=report_cache):
+    return _window_report(
+        session,
+        cache,
+        "avg_health_metrics",
+        user_id,
+        window,
+        reports.summary_health_query,
+    )
+
+
+# average sleep duration and quality
+def avg_sleep(session, user_id, window=30, cache=report_cache):
+    return _window_report(
+        session, cache, "avg_sleep", user_id, window, reports.summary_sleep_query
+    )
+
+
+# number of workouts
+def workout_count(session, user_id, window=7, cache=report_cache):
+    row = _window_report(
+        session,
+        cache,
+        "workout_count",
+        user_id,
+        window,
+        reports.summary_workout_count_query,
+    )
+    return row.workouts_completed
+
+
+# the whole monthly report (reports.monthly_report)
+def monthly_report(session, user_id, window=30, cache=report_cache):
+    return cache.get_or_compute(
+        "monthly_report",
+        user_id,
+        window,
+        lambda: reports.monthly_report(session, user_id, window),
+    )
+
+
+# the daily trend lines with their moving averages (reports.trend)
+def trend(session, user_id, window=90, cache=report_cache):
+    return cache.get_or_compute(
+        "trend",
+        user_id,
+        window,
+        lambda: reports.trend(session, user_id, window),
+    )
@@ -0,0 +1,647 @@
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import Date, and_, literal, select, func, true
+from helpers import AVERAGES, for_users, weighted_avg
+from retention import bucket_averages, health_buckets
+from init_db import (
+    User,
+    SleepLog,
+    Food,
+    FoodLog,
+    WorkoutRecommendation,
+    WorkoutLog,
+    Goal,
+    DailyUserSummary,
+)
+
+"""
+This module holds the report queries used by query_data.py as reusable statements.
+Each function only BUILDS a select() statement, it does not run it. Keeping the
+statements separate from the printing code means the same query can be executed by
+the demo script, checked by the query plan audit (plan_audit.py) or reused by other
+report code without copying the filters around.
+
+Run a statement with session.execute(stmt) and read it with .first(), .scalar() etc.
+
+The health metric queries take a connection as their first argument: they read
+through retention.health_buckets(), which needs to look up the monthly partitions
+(partitions.py) a window overlaps, so readings that were archived or rolled up into
+hourly and daily aggregates (retention.py) still count. Pass session.connection()
+when working with a session.
+
+The reports over a date window (monthly_report, fleet_reports and the summary_*
+queries) read the daily_user_summary rollup (see daily_summary.py) instead of the raw
+logs. The raw log versions (monthly_report_query, fleet_report_query) are kept to
+check the rollup against. The trend lines (trend_query) are the daily summary values
+with their 7 and 30 day moving averages, computed by window functions in one pass.
+"""
+
+
+def _avg(column, label, precision=None):
+    # average of a column, optionally rounded in the database for display
+    value = func.avg(column)
+    if precision is not None:
+        value = func.round(value, precision)
+    return value.label(label)
+
+
+### HEALTH_METRIC QUERIES ###
+# no upper bound on the timestamps of a window
+_NO_END = datetime(9999, 12, 31)
+
+
+def _health_buckets(connection, start, end=None, user_ids=None):
+    # the health buckets of a window of dates, the end date included
+    end_of_window = _NO_END
+    if end is not None:
+        end_of_window = datetime.combine(end + timedelta(days=1), time.min)
+    return health_buckets(connection, start, end_of_window, user_ids)
+
+
+# average health metrics for a user since a date (and optionally up to a date)
+def avg_health_metrics_query(connection, user_id, since, end=None, precision=None):
+    buckets = _health_buckets(connection, since, end, [user_id])
+    return select(*bucket_averages(buckets, precision))
+
+
+# average steps for a user since a date
+def avg_steps_query(connection, user_id, since):
+    buckets = _health_buckets(connection, since, user_ids=[user_id])
+    count = buckets.c.steps_taken_count
+    return select(func.sum(buckets.c.steps_taken_avg * count) / func.sum(count))
+
+
+### SLEEP QUERIES ###
+# average sleep duration and quality for a user between two dates
+def avg_sleep_query(user_id, start, end=None, precision=None):
+    query = select(
+        _avg(SleepLog.duration, "avg_sleep_duration", precision),
+        _avg(SleepLog.quality, "avg_sleep_quality", precision),
+    ).where(SleepLog.user_id == user_id, SleepLog.date >= start)
+    if end is not None:
+        query = query.where(SleepLog.date <= end)
+    return query
+
+
+# user with the highest average sleep quality since a date (all users)
+def best_sleeper_query(since):
+    return (
+        select(User.name, func.avg(SleepLog.quality))
+        .join(User.sleep_log)
+        .where(SleepLog.date >= since)
+        .group_by(User.name)
+        .order_by(func.avg(SleepLog.quality).desc())
+        .limit(1)
+    )
+
+
+### FOOD AND FOOD LOG QUERIES ###
+# most popular foods across all users
+def most_popular_foods_query(limit=3):
+    total = func.count(FoodLog.food_id).label("total")
+    return (
+        select(Food.name, total)
+        .join(FoodLog)
+        .group_by(Food.name)
+        .order_by(total.desc())
+        .limit(limit)
+    )
+
+
+# food log entries for a user on a day
+def foods_eaten_on_query(user_id, day):
+    return (
+        select(FoodLog)
+        .join(Food)
+        .where(FoodLog.user_id == user_id, FoodLog.date == day)
+    )
+
+
+# number of food log entries in a food category for a user between two dates
+def food_category_count_query(user_id, category, start, end):
+    return (
+        select(func.count(FoodLog.id))
+        .join(Food)
+        .where(
+            FoodLog.user_id == user_id,
+            FoodLog.date.between(start, end),
+            Food.category == category,
+        )
+    )
+
+
+# total calories eaten by a user on a day
+def calories_on_query(user_id, day):
+    return (
+        select(func.sum(Food.calories))
+        .join(FoodLog)
+        .where(FoodLog.user_id == user_id, FoodLog.date == day)
+    )
+
+
+# sum of calories per day for a user since a date (one row per day)
+def daily_calories_query(user_id, since):
+    return (
+        select(FoodLog.date, func.sum(Food.calories).label("calories"))
+        .join(Food, FoodLog.food_id == Food.id)
+        .where(FoodLog.user_id == user_id, FoodLog.date >= since)
+        .group_by(FoodLog.date)
+    )
+
+
+# average calories per day for a user since a date
+def avg_daily_calories_query(user_id, since, precision=None):
+    calories_per_day = daily_calories_query(user_id, since).subquery()
+    return select(_avg(calories_per_day.c.calories, "avg_calories", precision))
+
+
+### WORKOUT RECOMMENDATION QUERIES ###
+# recommendations matching a type and difficulty up to a duration, random order
+def workout_recommendations_query(exercise_type, difficulty_level, max_duration):
+    return (
+        select(WorkoutRecommendation)
+        .where(
+            WorkoutRecommendation.exercise_type == exercise_type,
+            WorkoutRecommendation.difficulty_level == difficulty_level,
+            WorkoutRecommendation.duration <= max_duration,
+        )
+        .order_by(func.random())
+    )
+
+
+# number of recommendations of an exercise type
+def recommendation_type_count_query(exercise_type):
+    return select(func.count(WorkoutRecommendation.id)).where(
+        WorkoutRecommendation.exercise_type == exercise_type
+    )
+
+
+### WORKOUT LOG QUERIES ###
+# the recommendation users completed most often
+def most_frequent_recommendation_query():
+    return (
+        select(
+            WorkoutLog.recommendation_id,
+            func.count(WorkoutLog.recommendation_id),
+        )
+        .group_by(WorkoutLog.recommendation_id)
+        .order_by(func.count(WorkoutLog.recommendation_id).desc())
+        .limit(1)
+    )
+
+
+# number of workouts a user logged since a date (and optionally up to a date)
+def workout_count_query(user_id, start, end=None):
+    query = select(func.count(WorkoutLog.id)).where(
+        WorkoutLog.user_id == user_id, WorkoutLog.date >= start
+    )
+    if end is not None:
+        query = query.where(WorkoutLog.date <= end)
+    return query
+
+
+# total calories burned by a user on a day
+def calories_burned_on_query(user_id, day):
+    return select(func.sum(WorkoutLog.calories_burned)).where(
+        WorkoutLog.user_id == user_id, WorkoutLog.date == day
+    )
+
+
+# the first workout log entry that uses a workout the user created
+def user_created_workout_query(user_id):
+    return (
+        select(WorkoutLog)
+        .where(WorkoutLog.user_id == user_id, WorkoutLog.user_workout_id.isnot(None))
+        .limit(1)
+    )
+
+
+### GOAL QUERIES ###
+# number of goals a user completed before a date
+def completed_goal_count_query(user_id, today):
+    return select(func.count(Goal.id)).where(
+        Goal.user_id == user_id, Goal.end_date < today
+    )
+
+
+# number of goals a user completed between two dates
+def goals_completed_between_query(user_id, start, end):
+    return select(func.count(Goal.id)).where(
+        Goal.user_id == user_id, Goal.end_date.between(start, end)
+    )
+
+
+# goals for a user that are in progress on a date
+def in_progress_goals_query(user_id, today):
+    return select(Goal).where(
+        Goal.user_id == user_id,
+        Goal.start_date <= today,
+        Goal.end_date >= today,
+    )
+
+
+# goals of a type for a user that have not ended yet
+def open_goals_of_type_query(user_id, goal_type, today):
+    return select(Goal).where(
+        Goal.user_id == user_id,
+        Goal.goal_type == goal_type,
+        Goal.end_date >= today,
+    )
+
+
+### DAILY SUMMARY QUERIES ###
+def _weighted_avg(column, count, label, precision=None):
+    # average over the raw rows, from daily averages weighted by each day's row count
+    value = weighted_avg(column, count)
+    if precision is not None:
+        value = func.round(value, precision)
+    return value.label(label)
+
+
+def _summary_window(start, end=None):
+    conditions = [DailyUserSummary.date >= start]
+    if end is not None:
+        conditions.append(DailyUserSummary.date <= end)
+    return conditions
+
+
+def _summary_health(precision=None):
+    # every metric is weighted by the readings of each day that have it
+    return [
+        _weighted_avg(
+            DailyUserSummary.__table__.c[f"avg_{metric}"],
+            DailyUserSummary.__table__.c[f"{metric}_count"],
+            label,
+            precision,
+        )
+        for metric, label in AVERAGES
+    ]
+
+
+def _summary_sleep(precision=None):
+    count = DailyUserSummary.sleep_count
+    return [
+        _weighted_avg(
+            DailyUserSummary.sleep_duration, count, "avg_sleep_duration", precision
+        ),
+        _weighted_avg(
+            DailyUserSummary.sleep_quality, count, "avg_sleep_quality", precision
+        ),
+    ]
+
+
+def _summary_workouts():
+    return func.coalesce(func.sum(DailyUserSummary.workout_count), 0).label(
+        "workouts_completed"
+    )
+
+
+# the summary rows of a user between two dates (one row per day with any log)
+def daily_summary_query(user_id, start, end=None):
+    return (
+        select(DailyUserSummary)
+        .where(DailyUserSummary.user_id == user_id, *_summary_window(start, end))
+        .order_by(DailyUserSummary.date)
+    )
+
+
+# average health metrics for a user between two dates, same columns as
+# avg_health_metrics_query
+def summary_health_query(user_id, start, end=None, precision=None):
+    return select(*_summary_health(precision)).where(
+        DailyUserSummary.user_id == user_id, *_summary_window(start, end)
+    )
+
+
+# average sleep duration and quality for a user between two dates
+def summary_sleep_query(user_id, start, end=None, precision=None):
+    return select(*_summary_sleep(precision)).where(
+        DailyUserSummary.user_id == user_id, *_summary_window(start, end)
+    )
+
+
+# average calories per day (days with food logged) for a user between two dates
+def summary_avg_calories_query(user_id, start, end=None, precision=None):
+    return select(_avg(DailyUserSummary.calories_in, "avg_calories", precision)).where(
+        DailyUserSummary.user_id == user_id, *_summary_window(start, end)
+    )
+
+
+# number of workouts a user logged between two dates
+def summary_workout_count_query(user_id, start, end=None):
+    return select(_summary_workouts()).where(
+        DailyUserSummary.user_id == user_id, *_summary_window(start, end)
+    )
+
+
+### TREND QUERIES ###
+# the moving average windows of the trend lines, in days
+TREND_WINDOWS = (7, 30)
+
+# (daily summary column, label) of every trend line
+_TREND_METRICS = [
+    (DailyUserSummary.avg_steps_taken, "steps"),
+    (DailyUserSummary.avg_heart_rate, "resting_heart_rate"),
+    (DailyUserSummary.sleep_duration, "sleep_duration"),
+    (DailyUserSummary.calories_in, "calories"),
+]
+
+
+def _round(value, precision=None):
+    return value if precision is None else func.round(value, precision)
+
+
+def _calendar(start, end):
+    # one row per day from start to end (a recursive CTE), so the days without a
+    # summary row still count as days in the moving windows
+    calendar = select(literal(start, Date).label("day")).cte("calendar", recursive=True)
+    return calendar.union_all(
+        select(func.date(calendar.c.day, "+1 day")).where(calendar.c.day < end)
+    )
+
+
+def trend_query(user_id, start, end, precision=2):
+    """
+    One row per day from start to end with each trend metric's daily value and its
+    moving averages over the last 7 and 30 days (columns steps, steps_7d,
+    steps_30d, resting_heart_rate, ...). A moving average covers calendar days and
+    skips the days without data, it is NULL when none of them has any.
+
+    The calendar starts 29 days before `start` so the first 30 day average is full.
+    Each calendar day finds its summary row through the (user_id, date) primary key,
+    and AVG() OVER (ORDER BY day ROWS BETWEEN n PRECEDING AND CURRENT ROW) computes
+    every moving average in the same pass over the days: a 90 day chart is one
+    statement instead of a query per day.
+    """
+    calendar = _calendar(start - timedelta(days=max(TREND_WINDOWS) - 1), end)
+    day = calendar.c.day
+    columns = []
+    for column, label in _TREND_METRICS:
+        columns.append(_round(column, precision).label(label))
+        for days in TREND_WINDOWS:
+            moving_avg = func.avg(column).over(order_by=day, rows=(-(days - 1), 0))
+            columns.append(_round(moving_avg, precision).label(f"{label}_{days}d"))
+    days = (
+        select(day.label("date"), *columns)
+        .select_from(calendar)
+        .outerjoin(
+            DailyUserSummary,
+            and_(DailyUserSummary.user_id == user_id, DailyUserSummary.date == day),
+        )
+        .subquery("trend")
+    )
+    # the days before start only fill the windows, they are left out after
+    return select(days).where(days.c.date >= start).order_by(days.c.date)
+
+
+def trend(session, user_id, window=90, end=None):
+    # the trend rows of the `window` days up to `end` (default today), oldest first
+    end = end or date.today()
+    start = end - timedelta(days=window - 1)
+    return session.execute(trend_query(user_id, start, end)).all()
+
+
+### COMPREHENSIVE REPORT ###
+@dataclass(frozen=True)
+class MonthlyReport:
+    # health report for one user over a date window (averages rounded to 2 places)
+    user_id: int
+    start_date: date
+    end_date: date
+    avg_resting_heart_rate: float
+    avg_steps_taken: float
+    avg_stand_hours: float
+    avg_systolic_bp: float
+    avg_diastolic_bp: float
+    avg_sleep_duration: float
+    avg_sleep_quality: float
+    avg_calories: float
+    goals_completed: int
+    workouts_completed: int
+
+
+def monthly_report_query(connection, user_id, start, end):
+    """
+    The whole health report as one statement. Health and sleep averages are CTEs
+    (one aggregate row each), calories per day is a grouped CTE that is averaged, and
+    the goal and workout counts are scalar subqueries. Every part reads through the
+    (user_id, date) composite index of its table (the health metrics through the
+    indexes of every tier they can be in).
+    """
+    health = avg_health_metrics_query(connection, user_id, start, end, precision=2).cte(
+        "health"
+    )
+    sleep = avg_sleep_query(user_id, start, end, precision=2).cte("sleep")
+    calories_per_day = (
+        daily_calories_query(user_id, start).where(FoodLog.date <= end).cte("calories")
+    )
+    avg_calories = select(
+        _avg(calories_per_day.c.calories, "avg_calories", 2)
+    ).scalar_subquery()
+    goals_completed = goals_completed_between_query(
+        user_id, start, end
+    ).scalar_subquery()
+    workouts_completed = workout_count_query(user_id, start, end).scalar_subquery()
+    return select(
+        health,
+        sleep,
+        avg_calories.label("avg_calories"),
+        goals_completed.label("goals_completed"),
+        workouts_completed.label("workouts_completed"),
+    ).join_from(health, sleep, true())
+
+
+def monthly_summary_query(user_id, start, end):
+    """
+    The same report as monthly_report_query, read from the daily summary rollup: one
+    aggregate over the user's summary rows in the window (found through the table's
+    (user_id, date) primary key) plus the goal count.
+    """
+    goals_completed = goals_completed_between_query(
+        user_id, start, end
+    ).scalar_subquery()
+    return select(
+        *_summary_health(2),
+        *_summary_sleep(2),
+        _avg(DailyUserSummary.calories_in, "avg_calories", 2),
+        goals_completed.label("goals_completed"),
+        _summary_workouts(),
+    ).where(DailyUserSummary.user_id == user_id, *_summary_window(start, end))
+
+
+def monthly_report(session, user_id, window=30, end=None):
+    """
+    Health report for a user over the `window` days up to `end` (default today),
+    computed in a single round trip from the daily summary rollup.
+    Returns a MonthlyReport.
+    """
+    end = end or date.today()
+    start = end - timedelta(days=window)
+    row = session.execute(monthly_summary_query(user_id, start, end)).one()
+    return MonthlyReport(user_id, start, end, **row._asdict())
+
+
+### FLEET REPORTS ###
+def fleet_report_query(connection, start, end, user_ids=None):
+    """
+    The monthly report for every user (or the given user ids) as one statement.
+    Each log table (the health metrics: every tier) is aggregated once with GROUP BY
+    user_id and the results are left joined to the users, so a user without data
+    still gets a row. Rows come back in user id order.
+    """
+    buckets = _health_buckets(connection, start, end, user_ids)
+    health = (
+        select(buckets.c.user_id, *bucket_averages(buckets, 2))
+        .group_by(buckets.c.user_id)
+        .subquery("health")
+    )
+    sleep = (
+        for_users(
+            select(
+                SleepLog.user_id,
+                _avg(SleepLog.duration, "avg_sleep_duration", 2),
+                _avg(SleepLog.quality, "avg_sleep_quality", 2),
+            ).where(SleepLog.date.between(start, end)),
+            SleepLog.user_id,
+            user_ids,
+        )
+        .group_by(SleepLog.user_id)
+        .subquery("sleep")
+    )
+    daily_calories = (
+        for_users(
+            select(FoodLog.user_id, func.sum(Food.calories).label("calories"))
+            .join(Food, FoodLog.food_id == Food.id)
+            .where(FoodLog.date.between(start, end)),
+            FoodLog.user_id,
+            user_ids,
+        )
+        .group_by(FoodLog.user_id, FoodLog.date)
+        .subquery("daily_calories")
+    )
+    calories = (
+        select(
+            daily_calories.c.user_id,
+            _avg(daily_calories.c.calories, "avg_calories", 2),
+        )
+        .group_by(daily_calories.c.user_id)
+        .subquery("calories")
+    )
+    goals = (
+        for_users(
+            select(Goal.user_id, func.count(Goal.id).label("goals_completed")).where(
+                Goal.end_date.between(start, end)
+            ),
+            Goal.user_id,
+            user_ids,
+        )
+        .group_by(Goal.user_id)
+        .subquery("goals")
+    )
+    workouts = (
+        for_users(
+            select(
+                WorkoutLog.user_id,
+                func.count(WorkoutLog.id).label("workouts_completed"),
+            ).where(WorkoutLog.date.between(start, end)),
+            WorkoutLog.user_id,
+            user_ids,
+        )
+        .group_by(WorkoutLog.user_id)
+        .subquery("workouts")
+    )
+
+    query = select(
+        User.id.label("user_id"),
+        health.c.avg_resting_heart_rate,
+        health.c.avg_steps_taken,
+        health.c.avg_stand_hours,
+        health.c.avg_systolic_bp,
+        health.c.avg_diastolic_bp,
+        sleep.c.avg_sleep_duration,
+        sleep.c.avg_sleep_quality,
+        calories.c.avg_calories,
+        func.coalesce(goals.c.goals_completed, 0).label("goals_completed"),
+        func.coalesce(workouts.c.workouts_completed, 0).label("workouts_completed"),
+    )
+    for table in (health, sleep, calories, goals, workouts):
+        query = query.outerjoin(table, table.c.user_id == User.id)
+    return for_users(query, User.id, user_ids).order_by(User.id)
+
+
+def fleet_summary_query(start, end, user_ids=None):
+    """
+    The same report as fleet_report_query, read from the daily summary rollup: the
+    summary rows are grouped by user_id once and left joined to the users together
+    with the goal counts. Rows come back in user id order.
+    """
+    summary = (
+        for_users(
+            select(
+                DailyUserSummary.user_id,
+                *_summary_health(2),
+                *_summary_sleep(2),
+                _avg(DailyUserSummary.calories_in, "avg_calories", 2),
+                _summary_workouts(),
+            ).where(*_summary_window(start, end)),
+            DailyUserSummary.user_id,
+            user_ids,
+        )
+        .group_by(DailyUserSummary.user_id)
+        .subquery("summary")
+    )
+    goals = (
+        for_users(
+            select(Goal.user_id, func.count(Goal.id).label("goals_completed")).where(
+                Goal.end_date.between(start, end)
+            ),
+            Goal.user_id,
+            user_ids,
+        )
+        .group_by(Goal.user_id)
+        .subquery("goals")
+    )
+    query = (
+        select(
+            User.id.label("user_id"),
+            summary.c.avg_resting_heart_rate,
+            summary.c.avg_steps_taken,
+            summary.c.avg_stand_hours,
+            summary.c.avg_systolic_bp,
+            summary.c.avg_diastolic_bp,
+            summary.c.avg_sleep_duration,
+            summary.c.avg_sleep_quality,
+            summary.c.avg_calories,
+            func.coalesce(goals.c.goals_completed, 0).label("goals_completed"),
+            func.coalesce(summary.c.workouts_completed, 0).label("workouts_completed"),
+        )
+        .outerjoin(summary, summary.c.user_id == User.id)
+        .outerjoin(goals, goals.c.user_id == User.id)
+    )
+    return for_users(query, User.id, user_ids).order_by(User.id)
+
+
+def fleet_reports(
+    session, window=30, end=None, user_ids=None, chunk_size=500, yield_per=1000
+):
+    """
+    Streams a MonthlyReport for every user (or the given user ids) in user id order,
+    read from the daily summary rollup.
+    Rows are fetched `yield_per` at a time, so the whole fleet is never held in
+    memory. A list of user ids is sorted and sent in chunks of `chunk_size`, which
+    keeps each statement under SQLite's limit on bound parameters.
+    """
+    end = end or date.today()
+    start = end - timedelta(days=window)
+    if user_ids is None:
+        chunks = [None]
+    else:
+        ids = sorted(set(user_ids))
+        chunks = [ids[i : i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    for chunk in chunks:
+        result = session.execute(
+            fleet_summary_query(start, end, chunk),
+            execution_options={"yield_per": yield_per},
+        )
+        for row in result:
+            yield MonthlyReport(start_date=start, end_date=end, **row._asdict())
@@ -0,0 +1,338 @@
+import argparse
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import Float, case, cast, delete, func, literal, select, union_all
+from sqlalchemy.dialects.sqlite import insert
+import partitions
+from helpers import AVERAGES, as_datetime, for_users
+from init_db import (
+    engine as default_engine,
+    HealthMetric,
+    HealthMetricHourly,
+    HealthMetricDaily,
+)
+
+"""
+Retention policy for the raw health metrics.
+
+Devices upload readings all day and nobody looks at a reading from last year on its
+own, only at averages over weeks and months. So readings move through three tiers:
+
+1. raw readings (health_metrics and its monthly partitions, see partitions.py) are
+   kept for raw_days
+2. older readings are rolled into health_metrics_hourly: one row per user per hour
+   with the min, max, average and count of every metric
+3. hourly rows older than hourly_days are rolled into health_metrics_daily, one row
+   per user per day
+
+Each step works in bounded batches: one transaction rolls the next batch_size rows
+into the tier above (merged into the bucket if it already has rows, eg. a reading
+written outside upsert.py, which skips readings of rolled up hours) and deletes them,
+so a row is always in exactly one tier, a crash never counts a reading twice, and
+other writers never wait long for the lock. Partitions that end up empty are
+dropped. This bounds health_metrics and its (user_id, timestamp) index to the last
+raw_days, small enough to stay in the page cache.
+
+Reads over any range go through health_buckets(), which unions the three tiers as
+buckets (a raw reading is a bucket of one) so the min, max, average and count over a
+range are the same as before the readings were rolled up. The daily summary rebuild
+(daily_summary.py) reads through it. An hourly or daily bucket counts as inside a
+range when it starts inside it.
+
+Apply the policy (defaults: 90 days of raw readings, 365 days of hourly rows):
+python3 retention.py --raw-days 90 --hourly-days 365 --batch-size 5000
+"""
+
+METRICS = ("heart_rate", "steps_taken", "stand_hours", "systolic_bp", "diastolic_bp")
+# the statistics kept for every metric, the aggregate columns are "<metric>_<stat>"
+STATS = ("min", "max", "avg", "count")
+
+
+RetentionStats = namedtuple(
+    "RetentionStats", ["raw_rolled", "hourly_rolled", "partitions_dropped"]
+)
+
+
+def _midnight(day):
+    return datetime.combine(day, time.min)
+
+
+def _first_day(value):
+    # the first day that starts at or after a date or datetime
+    if isinstance(value, datetime):
+        return value.date() + timedelta(days=1 if value.time() != time.min else 0)
+    return value
+
+
+### BUCKETS ###
+# every tier is read as buckets with the same columns: user_id, start,
+# reading_count and the statistics of every metric
+def reading_buckets(readings):
+    # raw readings as buckets of one reading each
+    columns = [readings.c.user_id, readings.c.timestamp.label("start")]
+    columns.append(literal(1).label("reading_count"))
+    for metric in METRICS:
+        value = readings.c[metric]
+        columns += [
+            value.label(f"{metric}_min"),
+            value.label(f"{metric}_max"),
+            # REAL, so the averages of merged buckets are not integer divisions
+            cast(value, Float).label(f"{metric}_avg"),
+            case((value.is_(None), 0), else_=1).label(f"{metric}_count"),
+        ]
+    return select(*columns)
+
+
+def _aggregate_buckets(table, start):
+    columns = [table.c.user_id, start.label("start"), table.c.reading_count]
+    for metric in METRICS:
+        columns += [table.c[f"{metric}_{stat}"] for stat in STATS]
+    return select(*columns)
+
+
+def _merged(buckets):
+    """
+    Aggregates that merge buckets into one: counts add up, min of the mins, max of
+    the maxes, averages weighted by their counts.
+    """
+    values = [func.sum(buckets.c.reading_count).label("reading_count")]
+    for metric in METRICS:
+        average = buckets.c[f"{metric}_avg"]
+        count = buckets.c[f"{metric}_count"]
+        values += [
+            func.min(buckets.c[f"{metric}_min"]).label(f"{metric}_min"),
+            func.max(buckets.c[f"{metric}_max"]).label(f"{metric}_max"),
+            # the sum is NULL when no bucket has the metric, so is the average
+            (func.sum(average * count) / func.sum(count)).label(f"{metric}_avg"),
+            func.sum(count).label(f"{metric}_count"),
+        ]
+    return values
+
+
+# the hour and day a bucket starts at, in the text form SQLAlchemy stores DateTimes
+_HOUR_FORMAT = "%Y-%m-%d %H:00:00.000000"
+_DAY_FORMAT = "%Y-%m-%d 00:00:00.000000"
+
+
+def health_buckets(connection, start, end, user_ids=None):
+    """
+    The health metric buckets of every user (or the given user ids) that start at
+    start <= start < end, from every tier: raw readings (including the partitions),
+    hourly and daily aggregates. Returns a subquery, group it and select _merged()
+    or use the helpers below.
+    """
+    start, end = as_datetime(start), as_datetime(end)
+    raw = partitions.health_metrics_between(connection, start, end, user_ids)
+    hourly = HealthMetricHourly.__table__
+    daily = HealthMetricDaily.__table__
+    parts = [
+        reading_buckets(raw),
+        for_users(
+            _aggregate_buckets(hourly, hourly.c.hour).where(
+                hourly.c.hour >= start, hourly.c.hour < end
+            ),
+            hourly.c.user_id,
+            user_ids,
+        ),
+        for_users(
+            _aggregate_buckets(daily, func.strftime(_DAY_FORMAT, daily.c.day)).where(
+                daily.c.day >= _first_day(start), daily.c.day < _first_day(end)
+            ),
+            daily.c.user_id,
+            user_ids,
+        ),
+    ]
+    return union_all(*parts).subquery("health_buckets")
+
+
+def health_stats(connection, user_id, start, end):
+    # reading_count and the min, max, avg and count of every metric of a user over a
+    # range, whichever tiers the readings are in
+    buckets = health_buckets(connection, start, end, [user_id])
+    return connection.execute(select(*_merged(buckets))).first()
+
+
+def bucket_averages(buckets, precision=None):
+    # the average of every health metric over some buckets (the averages weighted by
+    # their counts), labelled like reports.avg_health_metrics_query
+    columns = []
+    for metric, label in AVERAGES:
+        count = buckets.c[f"{metric}_count"]
+        value = func.sum(buckets.c[f"{metric}_avg"] * count) / func.sum(count)
+        if precision is not None:
+            value = func.round(value, precision)
+        columns.append(value.label(label))
+    return columns
+
+
+def avg_health_metrics(connection, user_id, start, end, precision=2):
+    # average health metrics of a user over any range, same labels as
+    # reports.avg_health_metrics_query
+    buckets = health_buckets(connection, start, end, [user_id])
+    return connection.execute(select(*bucket_averages(buckets, precision))).first()
+
+
+### ROLLUPS ###
+def _merge_into(target, key_column, bucket_key, buckets):
+    """
+    INSERT ... SELECT of the buckets grouped by (user_id, bucket_key) into the target
+    table, merged with the row of the bucket when it already exists.
+    """
+    existing = target.c
+    statement = insert(target).from_select(
+        ["user_id", key_column, "reading_count"]
+        + [f"{metric}_{stat}" for metric in METRICS for stat in STATS],
+        select(buckets.c.user_id, bucket_key.label(key_column), *_merged(buckets))
+        # the WHERE keeps SQLite from reading ON CONFLICT as a join constraint
+        .where(True).group_by(buckets.c.user_id, bucket_key),
+    )
+    incoming = statement.excluded
+    merged = {"reading_count": existing.reading_count + incoming.reading_count}
+    for metric in METRICS:
+        values = {
+            stat: (existing[f"{metric}_{stat}"], incoming[f"{metric}_{stat}"])
+            for stat in STATS
+        }
+        old_count, new_count = values["count"]
+        old_avg, new_avg = values["avg"]
+        # SQLite's min(a, b) and max(a, b) are NULL when either side is
+        for stat, pick in (("min", func.min), ("max", func.max)):
+            old, new = values[stat]
+            merged[f"{metric}_{stat}"] = pick(
+                func.coalesce(old, new), func.coalesce(new, old)
+            )
+        merged[f"{metric}_avg"] = (
+            func.coalesce(old_avg * old_count, 0)
+            + func.coalesce(new_avg * new_count, 0)
+        ) / func.nullif(old_count + new_count, 0)
+        merged[f"{metric}_count"] = old_count + new_count
+    return statement.on_conflict_do_update(
+        index_elements=["user_id", key_column], set_=merged
+    )
+
+
+def _roll(
+    engine,
+    source,
+    time_column,
+    cutoff,
+    target,
+    key_column,
+    bucket_key,
+    buckets,
+    batch_size,
+):
+    """
+    Rolls the rows of source with time_column < cutoff into target and deletes them,
+    batch_size rows (in id order) per transaction. Returns the number of rows rolled.
+    """
+    rolled = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            batch_ids = (
+                select(source.c.id)
+                .where(time_column < cutoff, source.c.id > last_id)
+                .order_by(source.c.id)
+                .limit(batch_size)
+                .subquery()
+            )
+            upper = connection.execute(select(func.max(batch_ids.c.id))).scalar()
+            if upper is None:
+                return rolled
+            in_batch = (
+                time_column < cutoff,
+                source.c.id > last_id,
+                source.c.id <= upper,
+            )
+            batch = buckets.where(*in_batch).subquery("batch")
+            connection.execute(
+                _merge_into(target, key_column, bucket_key(batch.c.start), batch)
+            )
+            rolled += connection.execute(delete(source).where(*in_batch)).rowcount
+        last_id = upper
+
+
+def roll_raw(engine, cutoff, batch_size=5000):
+    """
+    Rolls the raw readings older than cutoff (health_metrics and the partitions) into
+    hourly aggregates. Returns (readings rolled, partitions dropped).
+    """
+    with engine.connect() as connection:
+        months = [
+            month
+            for month in partitions.list_partitions(connection)
+            if as_datetime(month) < cutoff
+        ]
+    tables = [HealthMetric.__table__] + [partitions.partition_table(m) for m in months]
+    rolled = 0
+    for table in tables:
+        rolled += _roll(
+            engine,
+            table,
+            table.c.timestamp,
+            cutoff,
+            HealthMetricHourly.__table__,
+            "hour",
+            lambda start: func.strftime(_HOUR_FORMAT, start),
+            reading_buckets(table),
+            batch_size,
+        )
+    # the partitions of months before the cutoff are empty now
+    dropped = [
+        month for month in months if as_datetime(partitions.next_month(month)) <= cutoff
+    ]
+    for month in dropped:
+        partitions.drop_partition(engine, month)
+    return rolled, len(dropped)
+
+
+def roll_hourly(engine, cutoff, batch_size=5000):
+    # rolls the hourly aggregates older than cutoff into daily aggregates
+    hourly = HealthMetricHourly.__table__
+    return _roll(
+        engine,
+        hourly,
+        hourly.c.hour,
+        cutoff,
+        HealthMetricDaily.__table__,
+        "day",
+        func.date,
+        _aggregate_buckets(hourly, hourly.c.hour),
+        batch_size,
+    )
+
+
+def apply(engine=None, raw_days=90, hourly_days=365, batch_size=5000, today=None):
+    """
+    Applies the retention policy: raw readings older than raw_days become hourly
+    aggregates, hourly aggregates older than hourly_days become daily aggregates.
+    The cutoffs are at midnight, so hours and days are never split between tiers.
+    """
+    if hourly_days < raw_days:
+        raise ValueError("hourly_days must be at least raw_days")
+    engine = engine or default_engine
+    today = today or date.today()
+    raw_rolled, dropped = roll_raw(
+        engine, _midnight(today - timedelta(days=raw_days)), batch_size
+    )
+    hourly_rolled = roll_hourly(
+        engine, _midnight(today - timedelta(days=hourly_days)), batch_size
+    )
+    return RetentionStats(raw_rolled, hourly_rolled, dropped)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply the health metric retention")
+    parser.add_argument("--raw-days", type=int, default=90)
+    parser.add_argument("--hourly-days", type=int, default=365)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+    stats = apply(
+        raw_days=args.raw_days,
+        hourly_days=args.hourly_days,
+        batch_size=args.batch_size,
+    )
+    print(f"Rolled {stats.raw_rolled} raw readings into hourly aggregates")
+    print(f"Rolled {stats.hourly_rolled} hourly aggregates into daily aggregates")
+    print(f"Dropped {stats.partitions_dropped} empty partitions")
@@ -0,0 +1,162 @@
+import argparse
+import random
+import time
+from sqlalchemy import Integer, func, inspect, literal_column, select
+import init_db
+
+"""
+Uniform random sampling of rows from any table in init_db.py without
+ORDER BY random(), which reads every candidate row and sorts them all on every call.
+
+sample_ids() probes the rowid range instead: it draws random ids between the
+smallest and largest rowid and keeps the ones that exist and match the filters, with
+one "WHERE rowid IN (...)" lookup per round. A single integer primary key is the
+rowid, so for most tables the ids are the primary keys. Tables with a composite key
+(like daily_user_summary) are probed through their hidden rowid column, and tables
+created WITHOUT ROWID cannot be sampled this way. Every id in the range is equally likely to be probed, so every matching row is equally likely to be picked.
+Each round draws enough new ids for the hit rate seen so far, so tables with a few
+gaps in their ids need one or two rounds.
+
+When the hits are rare (very selective filters or a mostly deleted id range) probing
+would take too many rounds, so the sampler falls back to the ID array: it reads the
+ids of the matching rows (through an index on the filter columns when there is one)
+and samples from them in Python.
+
+    sample(session, WorkoutRecommendation, 3, WorkoutRecommendation.exercise_type == 1)
+
+Compare with ORDER BY random(): python3 sampling.py --table health_metrics -k 10
+"""
+
+# ids per IN (...) lookup, well under SQLite's limit on bound parameters
+_CHUNK_SIZE = 500
+
+
+def _row_id(model):
+    # the column holding each row's rowid: the primary key when it is a single integer
+    # column (an alias of the rowid), the hidden rowid column otherwise
+    table = model.__table__
+    if table.dialect_options["sqlite"].get("with_rowid") is False:
+        raise TypeError(f"{table.name} is a WITHOUT ROWID table, it cannot be sampled")
+    primary_key = inspect(model).primary_key
+    if len(primary_key) == 1 and isinstance(primary_key[0].type, Integer):
+        return primary_key[0]
+    return literal_column(f"{table.name}.rowid")
+
+
+def _matching(connection, model, row_id, ids, where):
+    found = set()
+    for i in range(0, len(ids), _CHUNK_SIZE):
+        found.update(
+            connection.execute(
+                select(row_id)
+                .select_from(model)
+                .where(row_id.in_(ids[i : i + _CHUNK_SIZE]), *where)
+            ).scalars()
+        )
+    return found
+
+
+def sample_ids(connection, model, k, *where, rng=None, max_rounds=4, min_hit_rate=0.05):
+    """
+    Ids of up to k different rows of `model` picked uniformly at random among the
+    rows that match the `where` filters (fewer if not enough rows match), in random
+    order. `connection` can be a Connection or a Session. The ids are rowids, which
+    are the primary keys of tables with a single integer key. Raises TypeError for a
+    WITHOUT ROWID table.
+    """
+    rng = rng or random
+    row_id = _row_id(model)
+    # two queries: SQLite only reads min() or max() straight off the index when the
+    # select has just one of them, together they scan the whole table
+    low = connection.execute(select(func.min(row_id)).select_from(model)).scalar()
+    high = connection.execute(select(func.max(row_id)).select_from(model)).scalar()
+    if low is None or k <= 0:
+        return []
+    span = high - low + 1
+    picked = []
+    probed = set()
+    probes = hits = 0
+    for _ in range(max_rounds):
+        need = k - len(picked)
+        # enough new ids for the hit rate so far, plus a margin
+        hit_rate = hits / probes if probes else 1.0
+        if probes and hit_rate < min_hit_rate:
+            break
+        count = min(
+            span - len(probed), int(need / max(hit_rate, min_hit_rate) * 1.2) + 8
+        )
+        batch = []
+        for id_ in rng.sample(range(low, high + 1), min(span, count + len(probed))):
+            if id_ not in probed:
+                batch.append(id_)
+                if len(batch) == count:
+                    break
+        probed.update(batch)
+        found = _matching(connection, model, row_id, batch, where)
+        probes += len(batch)
+        hits += len(found)
+        # keep the hits in the (random) order they were drawn
+        picked.extend(id_ for id_ in batch if id_ in found)
+        if len(picked) >= k:
+            return picked[:k]
+        if len(probed) == span:
+            return picked
+
+    # ID array fallback: sample the rest from the ids of every matching row
+    picked_set = set(picked)
+    rest = [
+        id_
+        for id_ in connection.execute(
+            select(row_id).select_from(model).where(*where)
+        ).scalars()
+        if id_ not in picked_set and id_ not in probed
+    ]
+    return picked + rng.sample(rest, min(k - len(picked), len(rest)))
+
+
+def sample(session, model, k, *where, rng=None):
+    # up to k random ORM objects of `model` matching the filters, in random order
+    ids = sample_ids(session, model, k, *where, rng=rng)
+    if not ids:
+        return []
+    row_id = _row_id(model)
+    objects = {
+        id_: obj
+        for obj, id_ in session.execute(select(model, row_id).where(row_id.in_(ids)))
+    }
+    return [objects[id_] for id_ in ids if id_ in objects]
+
+
+if __name__ == "__main__":
+    tables = {
+        mapper.class_.__tablename__: mapper.class_
+        for mapper in init_db.Base.registry.mappers
+    }
+    models = {
+        name: model
+        for name, model in tables.items()
+        if model.__table__.dialect_options["sqlite"].get("with_rowid") is not False
+    }
+    parser = argparse.ArgumentParser(
+        description="Compare sampling with ORDER BY random()"
+    )
+    parser.add_argument("--table", choices=sorted(models), default="health_metrics")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    model = models[args.table]
+    row_id = _row_id(model)
+
+    with init_db.engine.connect() as connection:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            connection.execute(
+                select(row_id).select_from(model).order_by(func.random()).limit(args.k)
+            ).all()
+        order_by_seconds = (time.perf_counter() - start) / args.repeat
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            sample_ids(connection, model, args.k)
+        probe_seconds = (time.perf_counter() - start) / args.repeat
+    print(f"ORDER BY random(): {order_by_seconds * 1000:.2f} ms per sample")
+    print(f"id probing:        {probe_seconds * 1000:.2f} ms per sample")
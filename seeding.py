@@ -0,0 +1,255 @@
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from data_generator import DataGenerator, rows
+from catalog import catalog_for
+from daily_summary import rebuild
+import goals
+from init_db import (
+    engine as default_engine,
+    User,
+    HealthMetric,
+    SleepLog,
+    Food,
+    FoodLog,
+    UserWorkout,
+    WorkoutLog,
+    WorkoutRecommendation,
+    Goal,
+    GoalProgress,
+    DailyUserSummary,
+)
+
+"""
+Bulk seeding engine used by insert_data.py.
+
+The original insertions built one ORM object per row, called session.add() for each
+one and flushed after every user workout to get its id. That is fine for a few
+thousand rows, but far too slow to build databases for capacity testing.
+
+This engine writes straight to the tables with Core insert() statements. Rows are
+collected into batches of plain dictionaries and each batch is sent with one
+executemany call, so there is no identity map, no unit of work and no flush per row.
+Ids are assigned here (continuing from the current max id) instead of being read
+back from the database, which is what removes the flush per user workout.
+
+The values themselves come from the vectorized DataGenerator (data_generator.py),
+which builds each batch column by column with NumPy.
+
+Each table is still filled in its own transaction, so a crash part way through
+leaves whole tables behind instead of half a user. Last, the daily_user_summary
+rollup (daily_summary.py) is rebuilt for the new users, because Core inserts do not
+go through the ORM listener that keeps it current, and the goals in progress are
+evaluated (goals.py) so every new goal has its progress row.
+"""
+
+# rows inserted into one table and how long it took
+SeedStats = namedtuple("SeedStats", ["table", "rows", "seconds"])
+
+
+def rows_per_second(stats):
+    return stats.rows / stats.seconds if stats.seconds else float("inf")
+
+
+def next_id(connection, model):
+    # ids are assigned by the seeder so related rows can reference them without a flush
+    return (connection.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _insert_columns(connection, table, columns, batch_size):
+    # sends a column batch with one executemany per batch_size rows
+    # returns the number of rows
+    batch = rows(columns)
+    statement = table.insert()
+    for start in range(0, len(batch), batch_size):
+        connection.execute(statement, batch[start : start + batch_size])
+    return len(batch)
+
+
+def _user_chunks(user_ids, rows_per_user, batch_size):
+    # groups users so each generated column batch holds about batch_size rows
+    step = max(1, batch_size // max(1, rows_per_user))
+    for start in range(0, len(user_ids), step):
+        yield user_ids[start : start + step]
+
+
+def _load(engine, model, batches, batch_size, report):
+    """
+    Fills one table in its own transaction and reports the insert rate.
+    `batches` is called with the open connection and yields column batches.
+    """
+    start = time.perf_counter()
+    count = 0
+    with engine.begin() as connection:
+        for columns in batches(connection):
+            count += _insert_columns(connection, model.__table__, columns, batch_size)
+    stats = SeedStats(model.__tablename__, count, time.perf_counter() - start)
+    if report:
+        report_stats(report, stats)
+    return stats
+
+
+def report_stats(report, stats):
+    report(
+        f"{stats.table}: {stats.rows} rows in {stats.seconds:.2f}s "
+        f"({rows_per_second(stats):,.0f} rows/sec)"
+    )
+
+
+def load_summary(engine, user_ids, start_date, end_date, report):
+    # the bulk inserts bypass the ORM, so the daily summary of the new rows is rebuilt
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        count = rebuild(connection, start_date, end_date, user_ids)
+    stats = SeedStats(
+        DailyUserSummary.__tablename__, count, time.perf_counter() - start
+    )
+    if report:
+        report_stats(report, stats)
+    return stats
+
+
+def load_goal_progress(engine, batch_size, report):
+    # evaluates the goals in progress today, new goals included
+    result = goals.evaluate(engine, batch_size=batch_size)
+    stats = SeedStats(GoalProgress.__tablename__, result.goals, result.seconds)
+    if report:
+        report_stats(report, stats)
+    return stats
+
+
+def _load_workouts(engine, generator, user_ids, start_date, days, batch_size, report):
+    """
+    The user workouts are given ids by the generator, so each batch of user
+    workouts is inserted right before the batch of logs that reference it, with no
+    flush in between. Both tables are filled in the same transaction.
+    """
+    workout_count = 0
+    log_count = 0
+    start = time.perf_counter()
+    # read before the transaction starts, the catalog uses a connection of its own
+    recommendation_ids = catalog_for(engine).recommendations().ids
+    with engine.begin() as connection:
+        next_workout_id = next_id(connection, UserWorkout)
+        for chunk in _user_chunks(user_ids, days, batch_size):
+            user_workouts, logs = generator.workouts(
+                chunk, start_date, days, recommendation_ids, next_workout_id
+            )
+            next_workout_id += len(user_workouts["id"])
+            workout_count += _insert_columns(
+                connection, UserWorkout.__table__, user_workouts, batch_size
+            )
+            log_count += _insert_columns(
+                connection, WorkoutLog.__table__, logs, batch_size
+            )
+
+    # both tables are filled in the same pass, so they share the elapsed time
+    seconds = time.perf_counter() - start
+    stats = [
+        SeedStats(UserWorkout.__tablename__, workout_count, seconds),
+        SeedStats(WorkoutLog.__tablename__, log_count, seconds),
+    ]
+    if report:
+        for item in stats:
+            report_stats(report, item)
+    return stats
+
+
+def seed_catalog(engine, generator, foods, recommendations, batch_size, report):
+    # fills the user independent tables (food and workout recommendations)
+    def food_batches(connection):
+        # foods that are already in the table are skipped (name is unique)
+        existing = set(connection.execute(select(Food.name)).scalars())
+        columns = generator.foods(foods)
+        keep = [i for i, name in enumerate(columns["name"]) if name not in existing]
+        yield {key: [values[i] for i in keep] for key, values in columns.items()}
+
+    def recommendation_batches(connection):
+        first_id = next_id(connection, WorkoutRecommendation)
+        yield generator.workout_recommendations(first_id, recommendations)
+
+    stats = [
+        _load(engine, Food, food_batches, batch_size, report),
+        _load(
+            engine, WorkoutRecommendation, recommendation_batches, batch_size, report
+        ),
+    ]
+    # the new rows must be visible to the catalog right away
+    catalog_for(engine).invalidate()
+    return stats
+
+
+def seed(
+    engine=None,
+    users=25,
+    days=30,
+    readings_per_day=1,
+    food_entries_per_day=3,
+    goals_per_user=2,
+    foods=60,
+    recommendations=50,
+    batch_size=10000,
+    random_seed=None,
+    report=print,
+):
+    """
+    Fills the database with fake data and returns a SeedStats for each table.
+    The defaults match the original script: 25 users with 30 days of history.
+    Pass random_seed to build the same data on every run, and report=None to run
+    quietly.
+    """
+    engine = engine or default_engine
+    generator = DataGenerator(random_seed)
+    start_date = datetime.now().date() - timedelta(days=days)
+
+    stats = seed_catalog(engine, generator, foods, recommendations, batch_size, report)
+
+    with engine.connect() as connection:
+        first_user = next_id(connection, User)
+    user_ids = range(first_user, first_user + users)
+
+    def user_batches(connection):
+        for chunk in _user_chunks(user_ids, 1, batch_size):
+            yield generator.users(chunk)
+
+    def health_metric_batches(connection):
+        for chunk in _user_chunks(user_ids, days * readings_per_day, batch_size):
+            yield generator.health_metrics(chunk, start_date, days, readings_per_day)
+
+    def sleep_batches(connection):
+        for chunk in _user_chunks(user_ids, days, batch_size):
+            yield generator.sleep(chunk, start_date, days)
+
+    # the food ids come from the catalog, not from a query per log entry
+    food_ids = catalog_for(engine).foods().ids
+
+    def food_log_batches(connection):
+        if not food_ids:
+            return
+        per_user = days * food_entries_per_day
+        for chunk in _user_chunks(user_ids, per_user, batch_size):
+            yield generator.food_log(
+                chunk, start_date, days, food_entries_per_day, food_ids
+            )
+
+    def goal_batches(connection):
+        for chunk in _user_chunks(user_ids, goals_per_user, batch_size):
+            yield generator.goals(chunk, goals_per_user)
+
+    stats.append(_load(engine, User, user_batches, batch_size, report))
+    stats.append(_load(engine, HealthMetric, health_metric_batches, batch_size, report))
+    stats.append(_load(engine, SleepLog, sleep_batches, batch_size, report))
+    stats.append(_load(engine, FoodLog, food_log_batches, batch_size, report))
+    stats.extend(
+        _load_workouts(
+            engine, generator, user_ids, start_date, days, batch_size, report
+        )
+    )
+    stats.append(_load(engine, Goal, goal_batches, batch_size, report))
+    # food is logged up to today, the other logs up to yesterday
+    stats.append(
+        load_summary(engine, user_ids, start_date, start_date + timedelta(days), report)
+    )
+    stats.append(load_goal_progress(engine, batch_size, report))
+    return stats
@@ -0,0 +1,142 @@
+from collections import defaultdict
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+import partitions
+from helpers import for_users
+from init_db import HealthMetric, HealthMetricDaily, HealthMetricHourly, SleepLog
+
+"""
+Idempotent bulk writes for re-sent device uploads.
+
+Devices retry an upload when they miss the reply, so the same readings can arrive
+twice. The tables below have a natural unique key (unique indexes in init_db.py),
+so instead of reading every row before writing it, a whole batch is written with one
+INSERT ... ON CONFLICT statement (executemany): a row whose key already exists is
+skipped (DO NOTHING) or overwritten with the new values (DO UPDATE).
+
+    with engine.begin() as connection:
+        written = upsert(connection, HealthMetric, rows)
+
+Health metrics are also matched against the older tiers before they are written, so
+a reading re-sent after its month was archived (partitions.py) or rolled up
+(retention.py) is not counted twice:
+
+- a reading already in its month's partition is skipped, or with update=True
+  overwritten in the partition
+- a reading whose hour (or day) is already rolled into health_metrics_hourly (or
+  health_metrics_daily) is skipped: the aggregates do not keep the timestamps of
+  their readings, so a late reading for a rolled up hour cannot be told apart from a
+  re-sent one and is counted as a duplicate
+
+Workout logs have no natural key (the same workout can be done twice a day), they
+are always inserted.
+"""
+
+# the natural key of each table, the columns of its unique index
+UNIQUE_KEYS = {
+    HealthMetric: ("user_id", "timestamp"),
+    SleepLog: ("user_id", "date"),
+}
+
+
+def upsert_statement(model, update=False, table=None):
+    """
+    INSERT ... ON CONFLICT on the natural key of the model. update=False skips rows
+    whose key exists, update=True overwrites their other columns. `table` writes to
+    another table with the model's columns and key (a partition of health_metrics).
+    """
+    keys = UNIQUE_KEYS[model]
+    table = model.__table__ if table is None else table
+    statement = insert(table)
+    if not update:
+        return statement.on_conflict_do_nothing(index_elements=keys)
+    return statement.on_conflict_do_update(
+        index_elements=keys,
+        set_={
+            column.name: statement.excluded[column.name]
+            for column in table.columns
+            if column.name not in keys and not column.primary_key
+        },
+    )
+
+
+def _hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _stored(connection, table, key_column, keys):
+    # the (user_id, key) pairs of `keys` that table already has a row for, read
+    # through its (user_id, key) index
+    user_ids = {user_id for user_id, _ in keys}
+    values = [value for _, value in keys]
+    query = select(table.c.user_id, table.c[key_column]).where(
+        table.c[key_column].between(min(values), max(values))
+    )
+    found = connection.execute(for_users(query, table.c.user_id, user_ids))
+    return keys & {tuple(row) for row in found}
+
+
+def _older_tiers(connection, rows):
+    """
+    Splits health metric rows by where their reading already is. Returns (archived,
+    rolled_up): {month: rows} of the rows whose (user_id, timestamp) is in the
+    partition of their month, and the list of rows whose hour or day is in the hourly
+    or daily aggregates. A handful of index searches per batch.
+    """
+    keys = {(row["user_id"], row["timestamp"]) for row in rows}
+    months = {partitions.month_start(timestamp) for _, timestamp in keys}
+    in_partitions = set()
+    for month in months.intersection(partitions.list_partitions(connection)):
+        in_partitions |= _stored(
+            connection, partitions.partition_table(month), "timestamp", keys
+        )
+    hours = _stored(
+        connection,
+        HealthMetricHourly.__table__,
+        "hour",
+        {(user_id, _hour(timestamp)) for user_id, timestamp in keys},
+    )
+    days = _stored(
+        connection,
+        HealthMetricDaily.__table__,
+        "day",
+        {(user_id, timestamp.date()) for user_id, timestamp in keys},
+    )
+    archived = defaultdict(list)
+    rolled_up = []
+    for row in rows:
+        user_id, timestamp = row["user_id"], row["timestamp"]
+        hour, day = (user_id, _hour(timestamp)), (user_id, timestamp.date())
+        if (user_id, timestamp) in in_partitions:
+            archived[partitions.month_start(timestamp)].append(row)
+        elif hour in hours or day in days:
+            rolled_up.append(row)
+    return archived, rolled_up
+
+
+def upsert(connection, model, rows, update=False):
+    """
+    Writes a batch of row dictionaries (every one with the same columns) with one
+    executemany in the caller's transaction. Returns the number of rows inserted or
+    updated, so len(rows) minus the result is how many duplicates were skipped.
+    Health metrics already archived or rolled up count as duplicates (see above).
+    """
+    if not rows:
+        return 0
+    written = 0
+    if model is HealthMetric:
+        archived, rolled_up = _older_tiers(connection, rows)
+        if update:
+            # archived readings are overwritten in their partition (without the id,
+            # ids are only unique per table)
+            for month, month_rows in archived.items():
+                written += connection.execute(
+                    upsert_statement(model, update, partitions.partition_table(month)),
+                    [{k: v for k, v in row.items() if k != "id"} for row in month_rows],
+                ).rowcount
+        skipped = {id(row) for row in rolled_up}
+        skipped.update(id(row) for month in archived.values() for row in month)
+        rows = [row for row in rows if id(row) not in skipped]
+        if not rows:
+            return written
+    return written + connection.execute(upsert_statement(model, update), rows).rowcount